@@ -0,0 +1,57 @@
+"""
+DCT 水印内核 - Numba JIT 版本（可选加速）
+
+QIM 只调制每个块的 DCT 系数 (2,3)，因此无需完整 8×8 DCT/IDCT：
+  - 提取: c = Σ u[i]·X[i,j]·v[j]            (u = C[2], v = C[3])
+  - 嵌入: X += (c' - c) · outer(u, v)       (正交变换下等价于 DCT → 改系数 → IDCT)
+每块约 128 次乘加，逐块融合在一次遍历内完成，无中间 (N,8,8) 缓冲。
+
+y 为 FingerprintEngine._band 给出的整块区域，块按行优先排列（与 _grid_view 一致）。
+"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def coeff_tiles(y, n, u, v):
+    """返回前 n 个块的系数 (2,3) → float32 (min(n, 块总数),)；y 可为 uint8 或 float32"""
+    bs = u.shape[0]
+    ncols = y.shape[1] // bs
+    n = min(n, (y.shape[0] // bs) * ncols)
+    out = np.empty(n, dtype=np.float32)
+    for k in prange(n):
+        r0 = (k // ncols) * bs
+        c0 = (k % ncols) * bs
+        acc = 0.0
+        for i in range(bs):
+            row = 0.0
+            for j in range(bs):
+                row += y[r0 + i, c0 + j] * v[j]
+            acc += u[i] * row
+        out[k] = acc
+    return out
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def embed_tiles(y, bits, Q, u, v):
+    """将 bits 依次 QIM 调制进前 len(bits) 个块（原地修改 float32 区域），返回嵌入块数"""
+    bs = u.shape[0]
+    ncols = y.shape[1] // bs
+    n = min(bits.shape[0], (y.shape[0] // bs) * ncols)
+    inv_q = 1.0 / Q
+    half = Q * 0.5
+    for k in prange(n):
+        r0 = (k // ncols) * bs
+        c0 = (k % ncols) * bs
+        acc = 0.0
+        for i in range(bs):
+            row = 0.0
+            for j in range(bs):
+                row += y[r0 + i, c0 + j] * v[j]
+            acc += u[i] * row
+        delta = np.rint(acc * inv_q) * Q + bits[k] * half - acc
+        for i in range(bs):
+            du = delta * u[i]
+            for j in range(bs):
+                y[r0 + i, c0 + j] += du * v[j]
+    return n
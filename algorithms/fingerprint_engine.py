@@ -4,20 +4,31 @@
 完整实现：水印可真实嵌入、提取，支持数据库溯源比对
 
 性能优化:
-  - 批量矩阵 DCT 替代逐块 cv2.dct（numpy 矩阵乘法一次完成）
-  - 查找表加速 hex↔binary 转换
+  - 批量矩阵 DCT 替代逐块 cv2.dct（零拷贝块视图 + matmul 写入线程内复用缓冲）
+  - NumPy 查找表加速 hex↔binary 转换
+  - 指纹比对使用 XOR + popcount，支持一对多批量比对
   - quick_extract_dct 快速预检（32 位采样）
+  - 可选 Numba JIT 融合内核（algorithms/_dct_numba.py），未安装时回退 NumPy
 """
 import cv2
 import numpy as np
-import pywt
-from typing import Tuple, Optional
+from typing import List, Tuple, Optional
+from functools import lru_cache
 import hashlib
+import threading
+
+# Numba 为可选依赖：可用时 DCT 嵌入/提取走 JIT 融合内核，否则回退 NumPy 向量化路径
+try:
+    from algorithms import _dct_numba
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _dct_numba = None
+    _NUMBA_AVAILABLE = False
 
 
 def _build_dct_matrix(n: int = 8) -> np.ndarray:
     """构建 n×n 正交 DCT-II 变换矩阵（与 cv2.dct 等价）"""
-    C = np.zeros((n, n), dtype=np.float32)
+    C = np.zeros((n, n), dtype=np.float64)
     for k in range(n):
         for i in range(n):
             if k == 0:
@@ -28,13 +39,31 @@ def _build_dct_matrix(n: int = 8) -> np.ndarray:
 
 
 # ---- 模块级常量（仅计算一次） ----
-_DCT8: np.ndarray = _build_dct_matrix(8)       # (8,8) 正交 DCT 矩阵
-_DCT8T: np.ndarray = _DCT8.T.copy()            # 转置（= 逆变换矩阵）
+_DCT8: np.ndarray = np.ascontiguousarray(_build_dct_matrix(8))   # (8,8) float64 正交 DCT 矩阵
+_DCT8T: np.ndarray = np.ascontiguousarray(_DCT8.T)                # 转置（= 逆变换矩阵）
+# QIM 载波系数 (2,3) = C[2] · X · C[3]ᵀ，只需两行基向量
+_DCT_U2: np.ndarray = _DCT8[2].copy()
+_DCT_V3: np.ndarray = _DCT8[3].copy()
+
+def _blake2b_256():
+    """BLAKE2b 输出 32 字节，hexdigest 与 SHA256 同为 64 字符"""
+    return hashlib.blake2b(digest_size=32)
+
+
+# BGR → Y (Rec.601) 的 1×3 变换矩阵，供 cv2.transform 只输出亮度平面
+_BGR2Y: np.ndarray = np.array([[0.114, 0.587, 0.299]], dtype=np.float32)
+
+# 批量 DCT 的 matmul 输出缓冲（按线程复用，FastAPI 线程池下互不干扰）
+_dct_buffers = threading.local()
 
-# hex → 4-bit binary 查找表
-_HEX2BIN = {c: format(i, '04b') for i, c in enumerate('0123456789abcdef')}
-# 4-bit binary → hex 查找表
-_BIN2HEX = {format(i, '04b'): hex(i)[2:] for i in range(16)}
+# ASCII 字节 → nibble 查找表（非十六进制字符记为 0xFF，转换时丢弃）
+_HEX2NIBBLE = np.full(256, 0xFF, dtype=np.uint8)
+_HEX2NIBBLE[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+_HEX2NIBBLE[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+# nibble → hex 字符查找表
+_NIBBLE2HEX = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+# nibble 内位权重（高位在前）
+_NIBBLE_SHIFTS = np.array([3, 2, 1, 0], dtype=np.uint8)
 
 
 class FingerprintEngine:
@@ -48,16 +77,19 @@ class FingerprintEngine:
     # 旧值 Q=8 容忍度仅 ±2，导致提取相似度仅 ~0.71
     QIM_STEP = 30.0
 
-    def __init__(self, strength: float = 0.1, block_size: int = 8):
+    def __init__(self, strength: float = 0.1, block_size: int = 8, use_blake2b: bool = False):
         """
         初始化指纹引擎
 
         Args:
             strength: 水印强度 (0.05-0.2 推荐，越大越鲁棒但越可见)
             block_size: DCT 块大小 (通常为 8)
+            use_blake2b: 使用 BLAKE2b-256 生成指纹（更快，批量开户场景）；
+                默认 SHA256，与数据库中已有指纹保持一致
         """
         self.strength = strength
         self.block_size = block_size
+        self._hasher = _blake2b_256 if use_blake2b else hashlib.sha256
 
     def generate_fingerprint(self, user_id: str, timestamp: str) -> str:
         """
@@ -70,82 +102,177 @@ class FingerprintEngine:
         Returns:
             64字符十六进制指纹哈希
         """
-        data = f"{user_id}:{timestamp}"
-        return hashlib.sha256(data.encode()).hexdigest()
+        h = self._hasher()
+        h.update(user_id.encode())
+        h.update(b':')
+        h.update(timestamp.encode())
+        return h.hexdigest()
+
+    def generate_fingerprints(self, user_id: str, timestamps) -> List[str]:
+        """
+        批量生成同一用户的多个指纹：'user_id:' 前缀只哈希一次，之后复制哈希状态
+
+        Returns:
+            与 timestamps 顺序一致的指纹列表，结果与逐个 generate_fingerprint 相同
+        """
+        prefix = self._hasher()
+        prefix.update(user_id.encode())
+        prefix.update(b':')
+        fingerprints = []
+        for ts in timestamps:
+            h = prefix.copy()
+            h.update(ts.encode())
+            fingerprints.append(h.hexdigest())
+        return fingerprints
 
     # ------------------------------------------------------------------ #
-    #  hex ↔ binary 转换（查找表加速）
+    #  hex ↔ binary 转换（NumPy 查找表，全部在 C 层完成）
     # ------------------------------------------------------------------ #
 
+    @staticmethod
+    def _hex_to_nibbles(hex_str: str) -> np.ndarray:
+        """hex 字符串 → uint8 nibble 数组（非十六进制字符被丢弃）"""
+        buf = np.frombuffer(hex_str.encode('ascii', 'replace'), dtype=np.uint8)
+        nibbles = _HEX2NIBBLE[buf]
+        return nibbles[nibbles != 0xFF]
+
+    def _hex_to_bits(self, hex_str: str) -> np.ndarray:
+        """hex 字符串 → uint8 位数组 (每字符4位，高位在前)"""
+        nibbles = self._hex_to_nibbles(hex_str)
+        return ((nibbles[:, None] >> _NIBBLE_SHIFTS) & 1).ravel()
+
+    @staticmethod
+    def _bits_to_hex(bits: np.ndarray) -> str:
+        """0/1 整数位数组 → hex 字符串（不足 4 位的尾部丢弃）"""
+        n = len(bits) // 4
+        if n == 0:
+            return ''
+        quads = np.asarray(bits[:n * 4], dtype=np.uint8).reshape(n, 4)
+        nibbles = (quads << _NIBBLE_SHIFTS).sum(axis=1, dtype=np.uint8)
+        return _NIBBLE2HEX[nibbles].tobytes().decode('ascii')
+
     def _hex_to_binary(self, hex_str: str) -> str:
-        """将十六进制指纹转换为二进制序列 (每字符4位) —— 查找表版本"""
-        return ''.join(_HEX2BIN.get(c, '') for c in hex_str.lower())
+        """将十六进制指纹转换为二进制序列 (每字符4位)"""
+        return (self._hex_to_bits(hex_str) + ord('0')).tobytes().decode('ascii')
 
     def _binary_to_hex(self, binary: str) -> str:
-        """将二进制序列转回十六进制 —— 查找表版本"""
-        hex_chars = []
-        for i in range(0, len(binary) - 3, 4):
-            chunk = binary[i:i + 4]
-            h = _BIN2HEX.get(chunk)
-            if h is not None:
-                hex_chars.append(h)
-        return ''.join(hex_chars)
+        """将二进制序列转回十六进制"""
+        bits = np.frombuffer(binary.encode('ascii'), dtype=np.uint8) - ord('0')
+        return self._bits_to_hex(bits)
 
     def _hex_to_bits_array(self, hex_str: str, length: int = 256) -> np.ndarray:
         """hex 直接转为 numpy float32 位数组，供向量化 DCT 使用"""
-        binary = self._hex_to_binary(hex_str)
-        if len(binary) < length:
-            binary = binary.ljust(length, '0')
-        return np.array([float(b) for b in binary[:length]], dtype=np.float32)
+        bits = self._hex_to_bits(hex_str)[:length]
+        out = np.zeros(length, dtype=np.float32)
+        out[:len(bits)] = bits
+        return out
 
     # ------------------------------------------------------------------ #
     #  块坐标 / 块提取 工具
     # ------------------------------------------------------------------ #
 
     @staticmethod
-    def _block_positions(h: int, w: int, bs: int, n: int):
-        """返回前 n 个非重叠块的 (row, col) 坐标列表"""
-        cols_per_row = (w - bs) // bs + 1 if w > bs else 0
-        rows = (h - bs) // bs + 1 if h > bs else 0
-        # 与旧代码 range(0, h-bs, bs) 一致
-        cols_per_row = len(range(0, w - bs, bs)) if w > bs else 0
-        total = len(range(0, h - bs, bs)) * cols_per_row if h > bs else 0
-        n = min(n, total)
-        col_positions = list(range(0, w - bs, bs))
-        positions = []
-        k = 0
-        for ri in range(0, h - bs, bs):
-            for ci in col_positions:
-                if k >= n:
-                    return positions
-                positions.append((ri, ci))
-                k += 1
-        return positions
+    @lru_cache(maxsize=64)
+    def _block_positions(h: int, w: int, bs: int, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        返回前 n 个非重叠块的左上角坐标 (rows, cols)，按行优先排列
+
+        与 range(0, h-bs, bs) × range(0, w-bs, bs) 一致；按尺寸缓存，
+        返回只读的连续 int32 数组，可直接用于 NumPy gather。
+        """
+        row_starts = np.arange(0, h - bs, bs, dtype=np.int32) if h > bs else np.empty(0, np.int32)
+        col_starts = np.arange(0, w - bs, bs, dtype=np.int32) if w > bs else np.empty(0, np.int32)
+        rows, cols = np.meshgrid(row_starts, col_starts, indexing='ij')
+        rows = np.ascontiguousarray(rows.ravel()[:n])
+        cols = np.ascontiguousarray(cols.ravel()[:n])
+        rows.flags.writeable = False
+        cols.flags.writeable = False
+        return rows, cols
 
     @staticmethod
-    def _extract_blocks(y: np.ndarray, positions, bs: int) -> np.ndarray:
-        """从 Y 通道提取指定位置的块 → (N, bs, bs)"""
-        return np.stack([y[r:r + bs, c:c + bs] for r, c in positions])
+    def _grid_shape(h: int, w: int, bs: int) -> Tuple[int, int]:
+        """块网格尺寸 (nrows, ncols)，与 _block_positions 的 range(0, h-bs, bs) 一致"""
+        nrows = len(range(0, h - bs, bs)) if h > bs else 0
+        ncols = len(range(0, w - bs, bs)) if w > bs else 0
+        return nrows, ncols
+
+    @classmethod
+    @lru_cache(maxsize=64)
+    def _band(cls, h: int, w: int, bs: int, n: int) -> Tuple[int, int, int]:
+        """
+        覆盖前 n 个块所需的最小左上区域（按尺寸缓存，同尺寸批量处理时免重复计算）
+
+        Returns:
+            (实际块数, 区域高, 区域宽)，区域恰好由整块铺满
+        """
+        nrows, ncols = cls._grid_shape(h, w, bs)
+        n = min(n, nrows * ncols)
+        rows = -(-n // ncols) if n else 0
+        return n, rows * bs, ncols * bs
+
+    @staticmethod
+    def _grid_view(y: np.ndarray, bs: int) -> np.ndarray:
+        """
+        整块区域的零拷贝 4D 块视图 → (h/bs, w/bs, bs, bs)，可写
+
+        y 通常为 _band 给出的区域，块按行优先排列，
+        第 k 个块即 _block_positions 的第 k 个坐标。
+        """
+        h, w = y.shape
+        return y.reshape(h // bs, bs, w // bs, bs).swapaxes(1, 2)
 
     @staticmethod
-    def _place_blocks(y: np.ndarray, blocks: np.ndarray, positions, bs: int):
-        """将处理后的块写回 Y 通道（原地修改）"""
-        for k, (r, c) in enumerate(positions):
-            y[r:r + bs, c:c + bs] = blocks[k]
+    def _take_tiles(grid: np.ndarray, n: int) -> np.ndarray:
+        """按行优先取前 n 个块 → 连续 (n, bs, bs)"""
+        bs = grid.shape[2]
+        return grid.reshape(-1, bs, bs)[:n]
+
+    @staticmethod
+    def _put_tiles(grid: np.ndarray, tiles: np.ndarray):
+        """将 (n, bs, bs) 块按行优先写回块视图（原地修改底层 Y 通道）"""
+        ncols, bs = grid.shape[1], grid.shape[2]
+        full, rem = divmod(len(tiles), ncols)
+        np.copyto(grid[:full], tiles[:full * ncols].reshape(full, ncols, bs, bs))
+        if rem:
+            np.copyto(grid[full, :rem], tiles[full * ncols:])
 
     # ------------------------------------------------------------------ #
     #  批量矩阵 DCT / IDCT
     # ------------------------------------------------------------------ #
 
     @staticmethod
-    def _batch_dct(blocks: np.ndarray) -> np.ndarray:
-        """(N,8,8) → (N,8,8) 批量 2D-DCT（矩阵乘法）"""
-        return _DCT8 @ blocks @ _DCT8T
+    def _matmul_buffers(n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """当前线程的 (n,8,8) float64 中间/输出缓冲，按需增长，避免每次调用分配"""
+        bufs = getattr(_dct_buffers, 'bufs', None)
+        if bufs is None or bufs[0].shape[0] < n:
+            bufs = (np.empty((n, 8, 8), dtype=np.float64), np.empty((n, 8, 8), dtype=np.float64))
+            _dct_buffers.bufs = bufs
+        return bufs[0][:n], bufs[1][:n]
+
+    @classmethod
+    def _batch_dct(cls, blocks: np.ndarray) -> np.ndarray:
+        """
+        (N,8,8) → (N,8,8) 批量 2D-DCT（C·X·Cᵀ，两次 matmul 写入预分配缓冲）
+
+        返回的是线程内复用缓冲，下一次 _batch_dct/_batch_idct 调用前须用完或拷贝。
+        """
+        tmp, out = cls._matmul_buffers(len(blocks))
+        np.matmul(_DCT8, blocks, out=tmp)
+        np.matmul(tmp, _DCT8T, out=out)
+        return out
+
+    @classmethod
+    def _batch_idct(cls, blocks: np.ndarray) -> np.ndarray:
+        """(N,8,8) → (N,8,8) 批量 2D-IDCT（Cᵀ·X·C），缓冲复用规则同 _batch_dct；blocks 可为 _batch_dct 的返回值"""
+        tmp, out = cls._matmul_buffers(len(blocks))
+        np.matmul(_DCT8T, blocks, out=tmp)
+        np.matmul(tmp, _DCT8, out=out)
+        return out
 
     @staticmethod
-    def _batch_idct(blocks: np.ndarray) -> np.ndarray:
-        """(N,8,8) → (N,8,8) 批量 2D-IDCT"""
-        return _DCT8T @ blocks @ _DCT8
+    def _batch_coeff_23(blocks: np.ndarray) -> np.ndarray:
+        """(...,8,8) → (...) 仅计算 QIM 载波系数 (2,3)，比完整 DCT 少 ~64× 运算"""
+        return np.einsum('i,...ij,j->...', _DCT_U2, blocks, _DCT_V3, optimize=True)
 
     # ------------------------------------------------------------------ #
     #  DCT 嵌入（向量化版本）
@@ -155,6 +282,9 @@ class FingerprintEngine:
         """
         使用 DCT 算法嵌入水印 - 完整嵌入 256 位指纹（批量向量化）
 
+        只读写亮度 Y：YCrCb→BGR 是线性变换且 Y 列系数全为 1，
+        因此 Y 的增量可原样叠加到 B/G/R 三通道，无需完整的 YCrCb 往返。
+
         Args:
             image: 输入图像 (BGR格式)
             fingerprint: 64字符十六进制指纹
@@ -162,42 +292,56 @@ class FingerprintEngine:
         Returns:
             嵌入水印后的图像
         """
-        ycrcb = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
-        y_channel = ycrcb[:, :, 0].astype(np.float32)
-
         # 指纹转位数组
         bits = self._hex_to_bits_array(fingerprint, self.FINGERPRINT_BITS)
-        n_bits = len(bits)
 
-        h, w = y_channel.shape
         bs = self.block_size
         Q = self.QIM_STEP
 
-        # 计算块坐标
-        positions = self._block_positions(h, w, bs, n_bits)
-        n_embed = len(positions)
+        watermarked = image.copy()
+        n_embed, bh, bw = self._band(*image.shape[:2], bs, len(bits))
         if n_embed == 0:
-            ycrcb[:, :, 0] = np.clip(y_channel, 0, 255).astype(np.uint8)
-            return cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+            return watermarked
 
         bits = bits[:n_embed]
 
-        # 批量提取 → 批量 DCT
-        blocks = self._extract_blocks(y_channel, positions, bs)  # (N,8,8)
-        dct_blocks = self._batch_dct(blocks)                     # (N,8,8)
-
-        # 向量化 QIM 调制
-        coeffs = dct_blocks[:, 2, 3]          # (N,)
-        base = np.round(coeffs / Q) * Q       # (N,)
-        dct_blocks[:, 2, 3] = base + bits * (Q / 2)
-
-        # 批量 IDCT → 写回
+        # 仅对覆盖嵌入块的区域求亮度：单次 cv2.transform 直接输出单通道 Y
+        y_orig = cv2.transform(image[:bh, :bw], _BGR2Y).astype(np.float32)
+        y_band = y_orig.copy()
+        if _NUMBA_AVAILABLE:
+            # JIT 融合内核：逐块 系数投影 → QIM → 秩一回写，原地修改 y_band
+            _dct_numba.embed_tiles(y_band, bits, Q, _DCT_U2, _DCT_V3)
+        else:
+            self._embed_tiles_numpy(y_band, bits, Q, bs)
+
+        # Y 增量广播回 BGR 三通道（原地 rint/clip，仅一个临时缓冲，赋值时饱和转 uint8）
+        y_band -= y_orig
+        region = watermarked[:bh, :bw]
+        tmp = region + y_band[..., None]
+        np.rint(tmp, out=tmp)
+        np.clip(tmp, 0, 255, out=tmp)
+        region[...] = tmp
+        return watermarked
+
+    def _embed_tiles_numpy(self, y_band: np.ndarray, bits: np.ndarray, Q: float, bs: int):
+        """NumPy 向量化嵌入路径（无 Numba 时使用），原地修改 y_band"""
+        # 块视图（零拷贝），取前 len(bits) 个块
+        grid = self._grid_view(y_band, bs)
+        blocks = self._take_tiles(grid, len(bits))  # (N,8,8)
+
+        # 批量 DCT
+        dct_blocks = self._batch_dct(blocks)     # (N,8,8)
+
+        # 向量化 QIM 调制：直接在系数视图上原地 rint(c/Q)·Q + bit·Q/2
+        coeffs = dct_blocks[:, 2, 3]          # (N,) 视图
+        coeffs *= 1.0 / Q
+        np.rint(coeffs, out=coeffs)
+        coeffs *= Q
+        coeffs += bits * (Q * 0.5)
+
+        # 批量 IDCT → 经块视图原地写回 y_band
         idct_blocks = self._batch_idct(dct_blocks)
-        watermarked = y_channel.copy()
-        self._place_blocks(watermarked, idct_blocks, positions, bs)
-
-        ycrcb[:, :, 0] = np.clip(watermarked, 0, 255).astype(np.uint8)
-        return cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+        self._put_tiles(grid, idct_blocks)
 
     # ------------------------------------------------------------------ #
     #  DCT 提取（向量化版本）
@@ -214,29 +358,33 @@ class FingerprintEngine:
         Returns:
             提取的十六进制指纹
         """
-        ycrcb = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
-        y_channel = ycrcb[:, :, 0].astype(np.float32)
+        coeffs = self._extract_raw_coeffs(image, length)
+        return self._bits_to_hex(self._qim_demod(coeffs, self.QIM_STEP))
 
-        h, w = y_channel.shape
+    def _extract_raw_coeffs(self, image: np.ndarray, length: int) -> np.ndarray:
+        """提取前 length 个块的 QIM 载波系数 (2,3) → float32 (N,)，与 Q 无关"""
         bs = self.block_size
-        Q = self.QIM_STEP
-
-        positions = self._block_positions(h, w, bs, length)
-        n_extract = len(positions)
+        n_extract, bh, bw = self._band(*image.shape[:2], bs, length)
         if n_extract == 0:
-            return ''
+            return np.empty(0, dtype=np.float32)
 
-        # 批量提取 → 批量 DCT
-        blocks = self._extract_blocks(y_channel, positions, bs)
-        dct_blocks = self._batch_dct(blocks)
+        # 只需亮度且只需覆盖所取块的区域：BGR2GRAY 与 YCrCb 的 Y 同为 Rec.601 系数，
+        # 取整差异远小于 QIM 容差；保持 uint8，不整体提升为 float32
+        y_band = cv2.cvtColor(image[:bh, :bw], cv2.COLOR_BGR2GRAY)
 
-        # 向量化 QIM 解调（半步长量化：嵌入时 bit=1 偏移 Q/2，提取时按 Q/2 量化取模）
-        coeffs = dct_blocks[:, 2, 3]
-        half_quants = np.round(coeffs / (Q / 2)).astype(np.int32)
-        bit_vals = half_quants % 2  # 0 或 1
+        if _NUMBA_AVAILABLE:
+            # 内核直接读取 uint8 像素，在寄存器中累加
+            return _dct_numba.coeff_tiles(y_band, n_extract, _DCT_U2, _DCT_V3)
+        # 只把用到的 n 个块提升为 float32，再只算系数 (2,3)
+        tiles = self._take_tiles(self._grid_view(y_band, bs), n_extract).astype(np.float32)
+        return self._batch_coeff_23(tiles)
 
-        binary_str = ''.join(str(b) for b in bit_vals)
-        return self._binary_to_hex(binary_str)
+    @staticmethod
+    def _qim_demod(coeffs: np.ndarray, Q: float) -> np.ndarray:
+        """向量化 QIM 解调（半步长量化：嵌入时 bit=1 偏移 Q/2，提取时按 Q/2 量化取奇偶）"""
+        half_quants = np.rint(coeffs * (2.0 / Q)).astype(np.int32)
+        # 补码下 & 1 与 % 2 对负数结果一致（均为 0/1），但无需符号修正分支
+        return half_quants & np.int32(1)
 
     # ------------------------------------------------------------------ #
     #  快速预检提取（仅采样少量位，用于判断是否已有水印）
@@ -245,7 +393,8 @@ class FingerprintEngine:
     def quick_extract_dct(self, image: np.ndarray, sample_bits: int = 32) -> str:
         """
         快速采样提取：仅提取前 sample_bits 位，用于判断图片是否已嵌入水印。
-        相比 extract_dct(length=1024) 减少 >90% 的计算量。
+        相比 extract_dct(length=1024) 减少 >90% 的计算量；
+        每块只算单个系数，32 位采样仅需约 512 次乘加。
 
         Returns:
             提取的短十六进制指纹片段
@@ -260,29 +409,30 @@ class FingerprintEngine:
         自适应 QIM 步长提取：先用当前 Q 提取，若指纹强度过低则回退尝试旧版 Q 值。
         解决 QIM_STEP 升级后旧水印无法提取的兼容性问题。
 
+        DCT 系数与 Q 无关，只计算一次，各候选 Q 仅重做解调；
+        不修改 self.QIM_STEP，可在多线程间共享实例。
+
         Returns:
             (hex_fingerprint, used_qim_step)
         """
-        # 1. 先用当前 QIM_STEP 提取
-        fp = self.extract_dct(image, length=length)
+        coeffs = self._extract_raw_coeffs(image, length)
+
+        # 1. 先用当前 QIM_STEP 解调
+        current_q = self.QIM_STEP
+        fp = self._bits_to_hex(self._qim_demod(coeffs, current_q))
         strength = sum(1 for c in fp if c != '0')
         if strength >= 15:  # 有效指纹
-            return fp, self.QIM_STEP
+            return fp, current_q
 
         # 2. 回退尝试旧版 QIM_STEP
-        saved_q = self.QIM_STEP
-        best_fp, best_strength, best_q = fp, strength, saved_q
-        try:
-            for legacy_q in self.LEGACY_QIM_STEPS:
-                self.QIM_STEP = legacy_q
-                legacy_fp = self.extract_dct(image, length=length)
-                legacy_strength = sum(1 for c in legacy_fp if c != '0')
-                if legacy_strength > best_strength:
-                    best_fp, best_strength, best_q = legacy_fp, legacy_strength, legacy_q
-        finally:
-            self.QIM_STEP = saved_q  # 恢复
-
-        if best_q != saved_q:
+        best_fp, best_strength, best_q = fp, strength, current_q
+        for legacy_q in self.LEGACY_QIM_STEPS:
+            legacy_fp = self._bits_to_hex(self._qim_demod(coeffs, legacy_q))
+            legacy_strength = sum(1 for c in legacy_fp if c != '0')
+            if legacy_strength > best_strength:
+                best_fp, best_strength, best_q = legacy_fp, legacy_strength, legacy_q
+
+        if best_q != current_q:
             print(f"[FingerprintEngine] 使用旧版 QIM_STEP={best_q} 成功提取指纹 (强度={best_strength})")
         return best_fp, best_q
 
@@ -300,14 +450,93 @@ class FingerprintEngine:
         """
         if not extracted or not original or len(original) < 8:
             return 0.0
-        ext_bin = self._hex_to_binary(extracted)
-        orig_bin = self._hex_to_binary(original)
-        min_len = min(len(ext_bin), len(orig_bin))
-        if min_len == 0:
+        ext_nib = self._hex_to_nibbles(extracted)
+        orig_nib = self._hex_to_nibbles(original)
+        n = min(len(ext_nib), len(orig_nib))
+        if n == 0:
             return 0.0
-        matches = sum(1 for i in range(min_len) if ext_bin[i] == orig_bin[i])
-        return matches / min_len
+        # 逐 nibble XOR + popcount 统计不同位数
+        diff_bits = int(np.bitwise_count(ext_nib[:n] ^ orig_nib[:n]).sum())
+        min_len = n * 4
+        return (min_len - diff_bits) / min_len
+
+    def pack_fingerprints(self, fingerprints) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        将数据库指纹批量打包为 (N, 32) uint8 字节矩阵，供 fingerprint_similarity_batch 使用
+
+        Args:
+            fingerprints: 64 字符十六进制指纹序列
+
+        Returns:
+            (packed, valid)：不是 64 位十六进制的指纹对应行置零，valid 为 False
+        """
+        n_bytes = self.FINGERPRINT_BITS // 8
+        packed = np.zeros((len(fingerprints), n_bytes), dtype=np.uint8)
+        valid = np.zeros(len(fingerprints), dtype=bool)
+        for i, fp in enumerate(fingerprints):
+            nib = self._hex_to_nibbles(fp or '')
+            if len(nib) == n_bytes * 2 and len(fp) == n_bytes * 2:
+                packed[i] = (nib[0::2] << 4) | nib[1::2]
+                valid[i] = True
+        return packed, valid
+
+    def fingerprint_similarity_batch(self, extracted: str, packed: np.ndarray,
+                                     valid: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        一个提取指纹对 N 个库指纹的相似度（一次 XOR + popcount）
+
+        按整字节比较，覆盖提取指纹与库指纹的公共前缀；
+        对 64 字符指纹与 fingerprint_similarity 结果一致。
+
+        Args:
+            extracted: 提取的指纹
+            packed: pack_fingerprints 生成的 (N, 32) 字节矩阵
+            valid: pack_fingerprints 返回的有效行掩码，无效行相似度为 0
+
+        Returns:
+            (N,) float 相似度数组
+        """
+        sims = np.zeros(len(packed), dtype=np.float64)
+        nib = self._hex_to_nibbles(extracted or '')
+        n = min(len(nib) // 2, packed.shape[1])
+        if n == 0:
+            return sims
+        ext = (nib[0:2 * n:2] << 4) | nib[1:2 * n:2]
+        diff_bits = np.bitwise_count(packed[:, :n] ^ ext).sum(axis=1)
+        sims[:] = (n * 8 - diff_bits) / (n * 8)
+        if valid is not None:
+            sims[~valid] = 0.0
+        return sims
     
+    @staticmethod
+    def _haar_dwt2(y: np.ndarray) -> Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        一级 2D Haar 小波分解（偶数尺寸），与 pywt.dwt2(y, 'haar') 结果一致
+
+        每个 2×2 邻域 [a b; c d] 的和/差乘 1/2，纯步长 2 切片，无卷积与边界处理。
+        """
+        a, b = y[0::2, 0::2], y[0::2, 1::2]
+        c, d = y[1::2, 0::2], y[1::2, 1::2]
+        ab_sum, ab_diff = a + b, a - b
+        cd_sum, cd_diff = c + d, c - d
+        cA = (ab_sum + cd_sum) * 0.5
+        cH = (ab_sum - cd_sum) * 0.5
+        cV = (ab_diff + cd_diff) * 0.5
+        cD = (ab_diff - cd_diff) * 0.5
+        return cA, (cH, cV, cD)
+
+    @staticmethod
+    def _haar_idwt2(cA: np.ndarray, details, out: np.ndarray) -> np.ndarray:
+        """_haar_dwt2 的逆变换，写入预分配的 out (2h, 2w)"""
+        cH, cV, cD = details
+        s_hv, d_hv = cA + cH, cA - cH
+        s_vd, d_vd = cV + cD, cV - cD
+        out[0::2, 0::2] = (s_hv + s_vd) * 0.5
+        out[0::2, 1::2] = (s_hv - s_vd) * 0.5
+        out[1::2, 0::2] = (d_hv + d_vd) * 0.5
+        out[1::2, 1::2] = (d_hv - d_vd) * 0.5
+        return out
+
     def embed_dwt(self, image: np.ndarray, fingerprint: str) -> np.ndarray:
         """
         使用 DWT (小波变换) 嵌入水印
@@ -322,22 +551,22 @@ class FingerprintEngine:
         ycrcb = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
         y_channel = ycrcb[:, :, 0].astype(np.float32)
         
-        # 二级小波分解
-        coeffs = pywt.dwt2(y_channel, 'haar')
-        cA, (cH, cV, cD) = coeffs
+        # 一级 Haar 小波分解（偶数尺寸部分；奇数尺寸时末行/列保持不变）
+        h, w = y_channel.shape
+        y_even = y_channel[:h - h % 2, :w - w % 2]
+        cA, details = self._haar_dwt2(y_even)
         
-        # 在低频分量嵌入
-        binary_data = self._hex_to_binary(fingerprint)[:min(256, cA.size)]
-        for i, bit in enumerate(binary_data[:min(len(binary_data), cA.size)]):
-            row, col = divmod(i, cA.shape[1])
-            if bit == '1':
-                cA[row, col] += self.strength * abs(cA[row, col])
-            else:
-                cA[row, col] -= self.strength * abs(cA[row, col])
+        # 在低频分量嵌入（按行优先的前 n 个系数，bit=1 增强 / bit=0 削弱）
+        bits = self._hex_to_bits(fingerprint)[:min(256, cA.size)]
+        n = len(bits)
+        flat = cA.reshape(-1)
+        sign = bits * 2.0 - 1.0
+        flat[:n] += sign * self.strength * np.abs(flat[:n])
         
-        # 重构图像
-        watermarked = pywt.idwt2((cA, (cH, cV, cD)), 'haar')
-        ycrcb[:, :, 0] = np.clip(watermarked, 0, 255).astype(np.uint8)
+        # 重构图像（直接写回 y_channel，不另分配输出）
+        self._haar_idwt2(cA, details, out=y_even)
+        np.clip(y_channel, 0, 255, out=y_channel)
+        ycrcb[:, :, 0] = y_channel  # 赋值即截断转 uint8，无需额外 astype 拷贝
         result = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
         
         return result
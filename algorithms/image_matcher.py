@@ -6,7 +6,20 @@ import cv2
 import numpy as np
 import imagehash
 from PIL import Image
-from typing import Tuple
+from typing import Optional, Tuple
+import threading
+
+# FLANN KD-Tree 参数
+_FLANN_INDEX_KDTREE = 1
+_FLANN_INDEX_PARAMS = dict(algorithm=_FLANN_INDEX_KDTREE, trees=5)
+_FLANN_SEARCH_PARAMS = dict(checks=50)
+
+# SIFT / FLANN 对象按线程复用：创建开销大，且 knnMatch 会改写匹配器内部训练集，不能跨线程共享
+_cv_objects = threading.local()
+
+# cv2.dct 为正交归一化，imagehash 使用未归一化 DCT-II：二者仅首行/首列相差 √2 倍
+_SQRT2 = np.float32(np.sqrt(2.0))
+
 
 class ImageMatcher:
     """图像相似度匹配器"""
@@ -37,6 +50,38 @@ class ImageMatcher:
         """计算差分哈希 (dHash)"""
         img = Image.open(image_path)
         return str(imagehash.dhash(img))
+
+    def calculate_phash_array(self, bgr: np.ndarray) -> str:
+        """
+        由已解码的 BGR 图像计算 pHash（免去重复读文件与 JPEG 解码）
+
+        与 imagehash.phash 算法一致：灰度 → 32×32 → DCT → 取左上 8×8 与中值比较。
+        缩放用 OpenCV INTER_AREA 代替 PIL Lanczos，与 calculate_phash 结果通常
+        完全相同，个别图像在中值附近相差 1~2 位，远小于比对阈值。
+
+        Args:
+            bgr: OpenCV 读取的 BGR 图像（或单通道灰度图）
+
+        Returns:
+            哈希值字符串（16 位十六进制，与 calculate_phash 格式相同）
+        """
+        gray = bgr if bgr.ndim == 2 else cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+        low = cv2.dct(small)[:8, :8]
+        low[0, :] *= _SQRT2
+        low[:, 0] *= _SQRT2
+        bits = np.packbits(low > np.median(low))
+        return bits.tobytes().hex()
+
+    def calculate_dhash_array(self, bgr: np.ndarray) -> str:
+        """
+        由已解码的 BGR 图像计算 dHash
+
+        9×8 的极小缩放对插值核敏感，OpenCV 缩放与 PIL 结果相差较多，
+        因此仍交给 imagehash，仅省去读文件与解码。
+        """
+        rgb = bgr if bgr.ndim == 2 else cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        return str(imagehash.dhash(Image.fromarray(rgb)))
     
     def calculate_similarity(self, hash1: str, hash2: str) -> float:
         """
@@ -49,28 +94,68 @@ class ImageMatcher:
         Returns:
             相似度 (0-1, 1表示完全相同)
         """
-        hamming_distance = bin(int(hash1, 16) ^ int(hash2, 16)).count('1')
+        hamming_distance = self._hamming(hash1, hash2)
         similarity = 1 - (hamming_distance / 64.0)
         return similarity
     
     def is_match(self, hash1: str, hash2: str) -> bool:
         """判断两个哈希是否匹配"""
-        hamming_distance = bin(int(hash1, 16) ^ int(hash2, 16)).count('1')
-        return hamming_distance <= self.threshold
+        return self._hamming(hash1, hash2) <= self.threshold
+
+    @staticmethod
+    def _hamming(hash1: str, hash2: str) -> int:
+        """两个十六进制哈希的汉明距离（int.bit_count 直接 popcount，无中间字符串）"""
+        return (int(hash1, 16) ^ int(hash2, 16)).bit_count()
+
+    @staticmethod
+    def pack_hashes(hashes) -> np.ndarray:
+        """将一组 64 位十六进制哈希打包为 uint64 数组，供 hamming_many 批量比对"""
+        return np.fromiter((int(h, 16) for h in hashes), dtype=np.uint64)
+
+    @staticmethod
+    def hamming_many(query_hash: str, db_hashes: np.ndarray) -> np.ndarray:
+        """
+        一个查询哈希对多个库哈希的汉明距离（向量化 XOR + popcount）
+
+        Args:
+            query_hash: 查询哈希 (十六进制)
+            db_hashes: pack_hashes 生成的 uint64 数组
+
+        Returns:
+            与 db_hashes 等长的汉明距离数组
+        """
+        return np.bitwise_count(np.uint64(int(query_hash, 16)) ^ db_hashes)
     
-    def extract_features_sift(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    @staticmethod
+    def _get_sift():
+        sift = getattr(_cv_objects, 'sift', None)
+        if sift is None:
+            sift = cv2.SIFT_create()
+            _cv_objects.sift = sift
+        return sift
+
+    @staticmethod
+    def _get_flann():
+        flann = getattr(_cv_objects, 'flann', None)
+        if flann is None:
+            flann = cv2.FlannBasedMatcher(_FLANN_INDEX_PARAMS, _FLANN_SEARCH_PARAMS)
+            _cv_objects.flann = flann
+        return flann
+
+    def extract_features_sift(self, image: np.ndarray, gray: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
         """
         使用 SIFT 提取图像特征点
         
         Args:
             image: 输入图像
+            gray: 已转换好的灰度图（可选，传入则跳过颜色转换）
             
         Returns:
             关键点和描述符
         """
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        sift = cv2.SIFT_create()
-        keypoints, descriptors = sift.detectAndCompute(gray, None)
+        if gray is None:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        keypoints, descriptors = self._get_sift().detectAndCompute(gray, None)
         return keypoints, descriptors
     
     def match_features(self, desc1: np.ndarray, desc2: np.ndarray, ratio: float = 0.75) -> int:
@@ -88,13 +173,8 @@ class ImageMatcher:
         if desc1 is None or desc2 is None:
             return 0
         
-        # FLANN 匹配器
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-        search_params = dict(checks=50)
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        
-        matches = flann.knnMatch(desc1, desc2, k=2)
+        # FLANN 匹配器（线程内复用）
+        matches = self._get_flann().knnMatch(desc1, desc2, k=2)
         
         # Lowe's ratio test
         good_matches = []
@@ -4,6 +4,8 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from pydantic import ValidationError
 from datetime import datetime, timezone
+import sys
+import time
 
 from app.core.config import settings
 from app.schema.user import User
@@ -12,31 +14,87 @@ from app.utils.supabase import get_supabase_service_client
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/login")
 
+# ---- 用户对象内存缓存（避免每个鉴权请求都访问 Supabase profiles） ----
+_user_cache: dict = {}  # {user_id: {"user": User, "expires": float}}
+_USER_CACHE_TTL = 60  # 秒
 
-def _parse_iso_datetime(val: Optional[str]) -> Optional[datetime]:
-    if not val:
-        return None
-    try:
-        s = str(val).strip()
-        # Support both 'Z' and '+00:00'
-        if s.endswith('Z'):
-            s = s[:-1] + '+00:00'
-        dt = datetime.fromisoformat(s)
+# ---- 资产数对账节流（watermarked_assets 计数每用户最多每 N 秒一次） ----
+_assets_reconciled_at: dict = {}  # {user_id: float}
+_ASSETS_RECONCILE_INTERVAL = 600  # 秒
+
+
+# ---- profiles plan/role 内存缓存（资产列表、统计、报告等接口的管理员/套餐判断，避免每次都查 profiles） ----
+_profile_cache: dict = {}  # {user_id: {"profile": Optional[dict], "expires": float}}
+_PROFILE_CACHE_TTL = 60  # 秒
+_PROFILE_CACHE_MAX = 10000
+
+
+def invalidate_user_cache(user_id: str):
+    """清除用户对象缓存（profiles 被修改后调用，下一次请求重新查询 Supabase）"""
+    _user_cache.pop(user_id, None)
+    _profile_cache.pop(user_id, None)
+
+
+def invalidate_user_quota_cache(user_id: str):
+    """只有已用额度变化时调用：清除含额度字段的用户对象缓存，plan/role 缓存保持不变"""
+    _user_cache.pop(user_id, None)
+
+
+def get_cached_profile(sb, user_id: str) -> Optional[dict]:
+    """返回 {"plan": ..., "role": ...}，用户不存在时返回 None；结果缓存 60 秒（plan/role 变更时由 invalidate_user_cache 清除）"""
+    now = time.time()
+    entry = _profile_cache.get(user_id)
+    if entry and now < entry["expires"]:
+        return entry["profile"]
+
+    res = sb.table("profiles").select("plan, role").eq("id", user_id).execute()
+    profile = res.data[0] if res.data else None
+    if len(_profile_cache) >= _PROFILE_CACHE_MAX:
+        _profile_cache.clear()
+    _profile_cache[user_id] = {"profile": profile, "expires": now + _PROFILE_CACHE_TTL}
+    return profile
+
+
+def _set_user_cache(user_id: str, user: User):
+    _user_cache[user_id] = {"user": user, "expires": time.time() + _USER_CACHE_TTL}
+
+
+if sys.version_info >= (3, 11):
+    # 3.11+ 的 fromisoformat 原生支持 'Z' 后缀与任意位数小数秒，无需预处理字符串
+    def _parse_iso_datetime(val: Optional[str]) -> Optional[datetime]:
+        if not val:
+            return None
+        try:
+            dt = datetime.fromisoformat(val)
+        except (TypeError, ValueError):
+            return None
         if dt.tzinfo is None:
             dt = dt.replace(tzinfo=timezone.utc)
         return dt
-    except Exception:
-        return None
+else:
+    def _parse_iso_datetime(val: Optional[str]) -> Optional[datetime]:
+        if not val:
+            return None
+        try:
+            s = str(val).strip()
+            # Support both 'Z' and '+00:00'
+            if s.endswith('Z'):
+                s = s[:-1] + '+00:00'
+            dt = datetime.fromisoformat(s)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return dt
+        except Exception:
+            return None
 
 
 def _compute_remaining_days(expires_at: Optional[str]) -> Optional[int]:
     dt = _parse_iso_datetime(expires_at)
     if not dt:
         return None
-    now = datetime.now(timezone.utc)
-    delta_seconds = (dt - now).total_seconds()
-    # ceil to days, but clamp at 0
-    days = int((delta_seconds + 86400 - 1) // 86400)
+    delta = dt - datetime.now(timezone.utc)
+    # ceil to whole days (a partial day of >= 1s counts), clamp at 0 - integer math only
+    days = delta.days + (1 if delta.seconds else 0)
     return max(days, 0)
 
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
@@ -65,6 +123,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
 
     if not username:
         raise credentials_exception
+
+    cached = _user_cache.get(username)
+    if cached and time.time() < cached["expires"]:
+        return cached["user"]
     
     # 从 Supabase 获取用户完整信息 - 使用 id (UUID) 查询
     try:
@@ -101,62 +163,60 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
 
                 # Backfill: keep new quota fields aligned with legacy fields for migrated users.
                 # Many older rows only updated quota_used/quota_total.
+                # All fixes are accumulated into one patch and written with a single UPDATE.
+                patch = {}
                 try:
                     legacy_used = _safe_int(user_data.get("quota_used"), 0)
                     legacy_total = _safe_int(user_data.get("quota_total"), 10)
                     embed_used = _safe_int(user_data.get("quota_embed_used"), legacy_used)
                     embed_total = _safe_int(user_data.get("quota_embed_total"), legacy_total)
-                    detect_used = _safe_int(user_data.get("quota_detect_used"), 0)
-                    detect_total = _safe_int(user_data.get("quota_detect_total"), 20)
 
                     # If embed quota fields exist but are behind legacy, sync them forward.
                     if embed_used < legacy_used or embed_total != legacy_total:
-                        sb.table("profiles").update({
-                            "quota_embed_used": max(embed_used, legacy_used),
-                            "quota_embed_total": embed_total,
-                        }).eq("id", username).execute()
+                        patch["quota_embed_used"] = max(embed_used, legacy_used)
+                        patch["quota_embed_total"] = embed_total
 
                     # If embed_used looks suspiciously low but assets exist, optionally backfill from assets count.
-                    # This is a safe monotonic fix (never decreases used).
-                    try:
-                        assets_res = sb.table("watermarked_assets").select("id", count="exact").eq("user_id", username).execute()
-                        assets_count = int(getattr(assets_res, "count", None) or 0)
-                        if assets_count and max(embed_used, legacy_used) < assets_count:
-                            sb.table("profiles").update({
-                                "quota_embed_used": assets_count,
-                                "quota_used": assets_count,
-                            }).eq("id", username).execute()
-                            embed_used = assets_count
-                            legacy_used = assets_count
-                    except Exception:
-                        pass
+                    # This is a safe monotonic fix (never decreases used); throttled per user.
+                    now_ts = time.time()
+                    if now_ts - _assets_reconciled_at.get(username, 0) >= _ASSETS_RECONCILE_INTERVAL:
+                        _assets_reconciled_at[username] = now_ts
+                        try:
+                            assets_res = sb.table("watermarked_assets").select("id", count="exact").eq("user_id", username).execute()
+                            assets_count = int(getattr(assets_res, "count", None) or 0)
+                            if assets_count and max(embed_used, legacy_used) < assets_count:
+                                patch["quota_embed_used"] = assets_count
+                                patch["quota_used"] = assets_count
+                                embed_used = assets_count
+                                legacy_used = assets_count
+                        except Exception:
+                            pass
 
                     quota_used = max(quota_used, legacy_used, embed_used)
 
                     # Ensure detect quota fields exist (for older rows) - do not overwrite non-null values.
                     if user_data.get("quota_detect_used") is None or user_data.get("quota_detect_total") is None:
-                        sb.table("profiles").update({
-                            "quota_detect_used": _safe_int(user_data.get("quota_detect_used"), 0),
-                            "quota_detect_total": _safe_int(user_data.get("quota_detect_total"), 20),
-                        }).eq("id", username).execute()
-                        detect_used = _safe_int(user_data.get("quota_detect_used"), 0)
-                        detect_total = _safe_int(user_data.get("quota_detect_total"), 20)
+                        patch["quota_detect_used"] = _safe_int(user_data.get("quota_detect_used"), 0)
+                        patch["quota_detect_total"] = _safe_int(user_data.get("quota_detect_total"), 20)
                 except Exception:
                     pass
 
                 # Auto-expire & downgrade
-                if subscription_status == 'active' and remaining_days == 0 and subscription_expires_at:
+                expire_now = bool(subscription_status == 'active' and remaining_days == 0 and subscription_expires_at)
+                if expire_now:
+                    patch["plan"] = "free"
+                    patch["subscription_status"] = "expired"
+
+                if patch:
                     try:
-                        sb.table("profiles").update({
-                            "plan": "free",
-                            "subscription_status": "expired",
-                        }).eq("id", username).execute()
-                        user_data["plan"] = "free"
-                        subscription_status = 'expired'
+                        sb.table("profiles").update(patch).eq("id", username).execute()
+                        if expire_now:
+                            user_data["plan"] = "free"
+                            subscription_status = 'expired'
                     except Exception as e:
-                        print(f"[Subscription] downgrade failed: {e}")
+                        print(f"[Auth] profile sync failed: {e}")
 
-                return User(
+                user = User(
                     id=user_data.get("id"),
                     username=user_data.get("username", email),
                     display_name=user_data.get("display_name"),
@@ -175,6 +235,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
                     remaining_days=remaining_days,
                     created_at=user_data.get("created_at"),
                 )
+                _set_user_cache(username, user)
+                return user
             else:
                 # 记录不存在，自动创建
                 # 先从 Supabase auth 获取 user_metadata 中的 display_name
@@ -205,7 +267,9 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
                 }
                 sb.table("profiles").insert(new_profile).execute()
                 print(f"[Auth Auto-Create] Auto created profile for {email or username} with display_name={final_display_name}")
-                return User(**new_profile)
+                user = User(**new_profile)
+                _set_user_cache(username, user)
+                return user
     except Exception as e:
         print(f"[Auth Error] Failed to fetch or create user from Supabase: {e}")
     
@@ -1,52 +1,140 @@
 from typing import Any, Dict, List, Optional
+from functools import lru_cache
+import asyncio
+import hashlib
 import logging
-import os
-import urllib.parse
+import time
+from urllib.parse import quote as _quote
 
 from fastapi import APIRouter, Header, HTTPException, Form, Query
-from jose import jwt
-import httpx
-
-from app.utils.supabase import get_supabase_service_client
+from fastapi.concurrency import run_in_threadpool
+import jwt as pyjwt
+
+from app.api.deps import invalidate_user_cache
+from app.api.endpoints.watermark import invalidate_quota_caches
+from app.utils.supabase import get_supabase_service_client, get_supabase_http_client
+from app.utils import stats_cache
+from app.utils.responses import DEFAULT_RESPONSE_CLASS
 from app.core.config import settings
 
-router = APIRouter()
+router = APIRouter(default_response_class=DEFAULT_RESPONSE_CLASS)
 logger = logging.getLogger("app")
 
+# ---- 各视图所需的列（只取前端实际展示的字段） ----
+# 首页摘要卡片：仍展示兼容旧字段 quota_used/quota_total
+PROFILE_LIST_COLS = (
+    "id, username, display_name, role, plan, quota_used, quota_total, "
+    "subscription_status, subscription_expires_at, created_at"
+)
+# 用户管理表格：分项额度 + 订阅周期
+PROFILE_TABLE_COLS = (
+    "id, username, display_name, role, plan, "
+    "quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, "
+    "subscription_period, subscription_expires_at, subscription_status, created_at"
+)
+# 用户详情：全部额度与订阅字段
+PROFILE_DETAIL_COLS = (
+    "id, username, display_name, role, plan, "
+    "quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, "
+    "subscription_period, subscription_expires_at, subscription_status, subscription_started_at, created_at"
+)
+# 资产列表卡片（phash / block_height 不展示），上传者信息嵌入返回
+ASSET_LIST_COLS = (
+    "id, user_id, filename, asset_type, created_at, output_path, fingerprint, timestamp, psnr, tx_hash, "
+    "uploader:profiles(username, display_name)"
+)
+
+# ---- Supabase token → uid 缓存（避免每个管理请求都访问 /auth/v1/user） ----
+# 键为带密钥的 BLAKE2b 摘要，内存中不保存原始 token
+# 后端没有登出 / 吊销入口（前端直接调用 Supabase signOut），已登出或被吊销的 token
+# 在缓存条目过期前（最长 _TOKEN_UID_CACHE_TTL 秒）仍会被管理接口接受
+_token_uid_cache: dict = {}  # {token_key: {"uid": str, "expires": float}}
+_TOKEN_UID_CACHE_TTL = 60  # 秒
+_TOKEN_UID_CACHE_MAX = 10000
+_TOKEN_KEY_SECRET = hashlib.sha256(settings.SECRET_KEY.encode()).digest()
+
+
+def _token_cache_key(token: str) -> str:
+    return hashlib.blake2b(token.encode(), digest_size=16, key=_TOKEN_KEY_SECRET).hexdigest()
+
+
+def _get_cached_token_uid(token: str) -> Optional[str]:
+    entry = _token_uid_cache.get(_token_cache_key(token))
+    if entry and entry["expires"] > time.time():
+        return entry["uid"]
+    return None
+
+
+def _set_cached_token_uid(token: str, uid: str):
+    now = time.time()
+    if len(_token_uid_cache) >= _TOKEN_UID_CACHE_MAX:
+        for k in [k for k, v in _token_uid_cache.items() if v["expires"] <= now]:
+            del _token_uid_cache[k]
+        if len(_token_uid_cache) >= _TOKEN_UID_CACHE_MAX:
+            _token_uid_cache.clear()
+    _token_uid_cache[_token_cache_key(token)] = {"uid": uid, "expires": now + _TOKEN_UID_CACHE_TTL}
+
+
+# ---- 管理员角色缓存（角色极少变更，只缓存校验通过的 uid） ----
+_admin_role_cache: dict = {}  # {uid: expires}
+_ADMIN_ROLE_CACHE_TTL = 120  # 秒
+
+
+def invalidate_admin_role_cache(uid: Optional[str] = None):
+    """清除管理员角色缓存（uid 为空时全部清除）"""
+    if uid is None:
+        _admin_role_cache.clear()
+    else:
+        _admin_role_cache.pop(uid, None)
+
+
+_ADMIN_SECRET_ENABLED = bool(settings.ADMIN_API_SECRET)
+
+# ---- overview / summary 结果缓存（进程内 + 可选 Redis，见 app/utils/stats_cache.py） ----
+_STATS_CACHE_PREFIX = "admin:stats:v1:"
+_STATS_CACHE_TTL = 30  # 秒
+
+_BEARER_PREFIX = "Bearer "
+_BEARER_LEN = len(_BEARER_PREFIX)
+
 
 def _get_bearer_token(authorization: Optional[str]) -> str:
-    if not authorization or not authorization.startswith("Bearer "):
+    if not authorization or not authorization.startswith(_BEARER_PREFIX):
         raise HTTPException(status_code=401, detail="Not authenticated")
-    return authorization[len("Bearer ") :]
+    return authorization[_BEARER_LEN:]
 
 
 def _verify_local_jwt(token: str) -> Optional[Dict[str, Any]]:
     """Verify locally issued HS256 JWT.
 
     Returns payload if verified, otherwise None.
+    Uses PyJWT (HMAC via the C-backed hashlib) - tokens issued by python-jose decode unchanged.
     """
     try:
-        return jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-    except Exception:
+        return pyjwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    except pyjwt.PyJWTError:
         return None
 
 
-def _verify_supabase_jwt_and_get_uid(token: str) -> Optional[str]:
+async def _verify_supabase_jwt_and_get_uid(token: str) -> Optional[str]:
     """Validate Supabase access_token by calling Supabase Auth API.
 
     This avoids relying on unverified claims when ADMIN_API_SECRET is disabled.
+    Uses the shared AsyncClient so the connection to Supabase is kept alive.
     """
     if not settings.SUPABASE_URL or not settings.SUPABASE_KEY:
         return None
 
-    url = f"{settings.SUPABASE_URL.rstrip('/')}/auth/v1/user"
+    client = get_supabase_http_client()
+    if client is None:
+        return None
+
     headers = {
         "Authorization": f"Bearer {token}",
         "apikey": settings.SUPABASE_KEY,
     }
     try:
-        with httpx.Client(timeout=8.0) as client:
-            resp = client.get(url, headers=headers)
+        resp = await client.get("/auth/v1/user", headers=headers)
         if resp.status_code != 200:
             return None
         data = resp.json() if resp.content else {}
@@ -56,7 +144,7 @@ def _verify_supabase_jwt_and_get_uid(token: str) -> Optional[str]:
         return None
 
 
-def _get_verified_uid(authorization: Optional[str]) -> str:
+async def _get_verified_uid(authorization: Optional[str]) -> str:
     token = _get_bearer_token(authorization)
 
     # 1) local token
@@ -64,27 +152,36 @@ def _get_verified_uid(authorization: Optional[str]) -> str:
     if payload and payload.get("sub"):
         return str(payload.get("sub"))
 
-    # 2) supabase token
-    uid = _verify_supabase_jwt_and_get_uid(token)
+    # 2) supabase token（命中缓存则跳过 Auth 往返）
+    uid = _get_cached_token_uid(token)
     if uid:
         return uid
 
+    uid = await _verify_supabase_jwt_and_get_uid(token)
+    if uid:
+        _set_cached_token_uid(token, uid)
+        return uid
+
     raise HTTPException(status_code=401, detail="Invalid token")
 
 
-def _require_admin(authorization: Optional[str], admin_secret: Optional[str]) -> Dict[str, Any]:
-    configured_secret = os.environ.get("ADMIN_API_SECRET", "")
+async def _require_admin(authorization: Optional[str], admin_secret: Optional[str]) -> Dict[str, Any]:
+    configured_secret = settings.ADMIN_API_SECRET
     if configured_secret and admin_secret != configured_secret:
         raise HTTPException(status_code=403, detail="Forbidden - Admin secret required")
 
-    uid = _get_verified_uid(authorization)
+    uid = await _get_verified_uid(authorization)
+
+    expires = _admin_role_cache.get(uid)
+    if expires and expires > time.time():
+        return {"uid": uid}
 
     sb = get_supabase_service_client()
     if not sb:
         raise HTTPException(status_code=500, detail="Supabase service client not configured. Check SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY env vars.")
 
     try:
-        res = sb.table("profiles").select("id, role").eq("id", uid).limit(1).execute()
+        res = await run_in_threadpool(sb.table("profiles").select("id, role").eq("id", uid).limit(1).execute)
         row = res.data[0] if res and res.data else None
     except Exception as e:
         logger.error(f"Failed to query admin role: {e}")
@@ -93,251 +190,166 @@ def _require_admin(authorization: Optional[str], admin_secret: Optional[str]) ->
     if not row or (row.get("role") not in ["admin", "行政"]):
         raise HTTPException(status_code=403, detail="Forbidden - Admin role required")
 
+    _admin_role_cache[uid] = time.time() + _ADMIN_ROLE_CACHE_TTL
     return {"uid": uid}
 
 
+@lru_cache(maxsize=4096)
+def _image_preview_url(fname: str) -> str:
+    """本地图片的预览 URL（同一文件名反复出现在列表中，quote 结果直接复用）"""
+    return f"/api/image/{_quote(fname)}"
+
+
+def _admin_asset_view(a: Dict[str, Any]) -> Dict[str, Any]:
+    """管理员视角的资产条目（新 dict）：不锁定、预览 URL、展开嵌入的上传者信息"""
+    url = a.get("output_path") or ""
+    if isinstance(url, str) and url.startswith("http"):
+        preview_url = url
+    else:
+        fname = a.get("filename") or ""
+        preview_url = _image_preview_url(fname) if fname else ""
+
+    p = a.get("uploader")
+    view = {
+        **a,
+        "is_locked": False,
+        "preview_url": preview_url,
+        "uploader_username": p.get("username") if p else None,
+        "uploader_display_name": p.get("display_name") if p else None,
+    }
+    view.pop("uploader", None)
+    return view
+
+
+async def _fetch_overview(sb) -> Dict[str, Any]:
+    # 查询用户列表（包含订阅信息）
+    users_res = await run_in_threadpool(
+        sb.table("profiles")
+        .select(PROFILE_TABLE_COLS)
+        .order("id", desc=True)
+        .limit(100)
+        .execute
+    )
+    users: List[Dict[str, Any]] = users_res.data or []
+    users_count = len(users)
+
+    # 查询资产列表
+    assets_res = await run_in_threadpool(
+        sb.table("watermarked_assets")
+        .select(ASSET_LIST_COLS)
+        .order("timestamp", desc=True)
+        .limit(100)
+        .execute
+    )
+    assets: List[Dict[str, Any]] = assets_res.data or []
+    assets_count = len(assets)
+
+    # 上传者信息已随资产嵌入返回（uploader），展开并补齐预览 URL（管理员不锁定/不打码）
+    assets = [_admin_asset_view(a) for a in assets]
+
+    logger.info(f"Admin overview: {users_count} users, {assets_count} assets")
+
+    return {
+        "users_count": users_count,
+        "assets_count": assets_count,
+        "users": users,
+        "assets": assets,
+        "admin_secret_enabled": _ADMIN_SECRET_ENABLED,
+    }
+
+
+async def _fetch_summary(sb, limit_users: int, limit_assets: int) -> Dict[str, Any]:
+    # 计数、最新用户、最新资产及上传者由 admin_summary RPC 一次返回
+    # （见 supabase_migration_admin_summary_rpc.sql）
+    res = await run_in_threadpool(
+        sb.rpc("admin_summary", {"_limit_users": limit_users, "_limit_assets": limit_assets}).execute
+    )
+    data: Dict[str, Any] = res.data or {}
+
+    assets = data.get("assets") or []
+    # 上传者信息已随资产嵌入返回（uploader），展开并补齐预览 URL（管理员不锁定/不打码）
+    assets = [_admin_asset_view(a) for a in assets]
+
+    return {
+        "users_count": data.get("users_count") or 0,
+        "assets_count": data.get("assets_count") or 0,
+        "users": data.get("users") or [],
+        "assets": assets,
+        "admin_secret_enabled": _ADMIN_SECRET_ENABLED,
+    }
+
+
 @router.get("/overview")
-def admin_overview(
+async def admin_overview(
     authorization: Optional[str] = Header(None),
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
 ) -> Dict[str, Any]:
-    _require_admin(authorization, x_admin_secret)
-
-    admin_secret_enabled = bool(os.environ.get("ADMIN_API_SECRET", ""))
+    await _require_admin(authorization, x_admin_secret)
 
     sb = get_supabase_service_client()
 
     try:
-        # 查询用户列表（包含订阅信息）
-        users_res = (
-            sb.table("profiles")
-            .select(
-                "id, username, display_name, role, plan, "
-                "quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, "
-                "subscription_period, subscription_expires_at, subscription_status, subscription_started_at, created_at"
-            )
-            .order("id", desc=True)
-            .limit(100)
-            .execute()
+        return await stats_cache.get_or_set(
+            f"{_STATS_CACHE_PREFIX}overview", _STATS_CACHE_TTL, lambda: _fetch_overview(sb)
         )
-        users: List[Dict[str, Any]] = users_res.data or []
-        users_count = len(users)
-
-        # 查询资产列表
-        assets_res = (
-            sb.table("watermarked_assets")
-            .select(
-                "id, user_id, filename, asset_type, created_at, output_path, fingerprint, phash, timestamp, psnr, tx_hash, block_height"
-            )
-            .order("timestamp", desc=True)
-            .limit(100)
-            .execute()
-        )
-        assets: List[Dict[str, Any]] = assets_res.data or []
-        assets_count = len(assets)
-
-        # 补齐上传者信息 + 预览 URL（管理员不锁定/不打码）
-        user_ids = list({a.get("user_id") for a in assets if a.get("user_id")})
-        user_map: Dict[str, Dict[str, Any]] = {}
-        if user_ids:
-            try:
-                prof_res = (
-                    sb.table("profiles")
-                    .select("id, username, display_name")
-                    .in_("id", user_ids)
-                    .execute()
-                )
-                for p in (prof_res.data or []):
-                    pid = p.get("id")
-                    if pid:
-                        user_map[str(pid)] = p
-            except Exception:
-                user_map = {}
-
-        for a in assets:
-            a["is_locked"] = False
-            url = a.get("output_path") or ""
-            if isinstance(url, str) and url.startswith("http"):
-                a["preview_url"] = url
-            else:
-                fname = a.get("filename") or ""
-                a["preview_url"] = f"/api/image/{urllib.parse.quote(fname)}" if fname else ""
-
-            uid = a.get("user_id")
-            p = user_map.get(str(uid)) if uid else None
-            if p:
-                a["uploader_username"] = p.get("username")
-                a["uploader_display_name"] = p.get("display_name")
-
-        logger.info(f"Admin overview: {users_count} users, {assets_count} assets")
-
-        return {
-            "users_count": users_count,
-            "assets_count": assets_count,
-            "users": users,
-            "assets": assets,
-            "admin_secret_enabled": admin_secret_enabled,
-        }
     except Exception as e:
         logger.error(f"Admin overview query failed: {e}")
         raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
 
 
 @router.get("/summary")
-def admin_summary(
+async def admin_summary(
     authorization: Optional[str] = Header(None),
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
     limit_users: int = Query(10, ge=0, le=50),
     limit_assets: int = Query(10, ge=0, le=50),
 ) -> Dict[str, Any]:
-    _require_admin(authorization, x_admin_secret)
-
-    admin_secret_enabled = bool(os.environ.get("ADMIN_API_SECRET", ""))
+    await _require_admin(authorization, x_admin_secret)
 
     sb = get_supabase_service_client()
     if not sb:
         raise HTTPException(status_code=500, detail="Supabase service client not configured")
 
     try:
-        users_res = (
-            sb.table("profiles")
-            .select("id", count="exact")
-            .limit(1)
-            .execute()
-        )
-        assets_res = (
-            sb.table("watermarked_assets")
-            .select("id", count="exact")
-            .limit(1)
-            .execute()
+        return await stats_cache.get_or_set(
+            f"{_STATS_CACHE_PREFIX}summary:{limit_users}:{limit_assets}",
+            _STATS_CACHE_TTL,
+            lambda: _fetch_summary(sb, limit_users, limit_assets),
         )
-
-        latest_users_res = (
-            sb.table("profiles")
-            .select(
-                "id, username, display_name, role, plan, "
-                "quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, "
-                "subscription_period, subscription_expires_at, subscription_status, subscription_started_at, created_at"
-            )
-            .order("created_at", desc=True)
-            .limit(limit_users)
-            .execute()
-        )
-        latest_assets_res = (
-            sb.table("watermarked_assets")
-            .select("id, user_id, filename, asset_type, timestamp, created_at, output_path, fingerprint, psnr")
-            .order("created_at", desc=True)
-            .limit(limit_assets)
-            .execute()
-        )
-
-        assets = latest_assets_res.data or []
-        # 补齐上传者信息 + 预览 URL（管理员不锁定/不打码）
-        user_ids = list({a.get("user_id") for a in assets if a.get("user_id")})
-        user_map: Dict[str, Dict[str, Any]] = {}
-        if user_ids:
-            try:
-                prof_res = (
-                    sb.table("profiles")
-                    .select("id, username, display_name")
-                    .in_("id", user_ids)
-                    .execute()
-                )
-                for p in (prof_res.data or []):
-                    pid = p.get("id")
-                    if pid:
-                        user_map[str(pid)] = p
-            except Exception:
-                user_map = {}
-
-        for a in assets:
-            a["is_locked"] = False
-            url = a.get("output_path") or ""
-            if isinstance(url, str) and url.startswith("http"):
-                a["preview_url"] = url
-            else:
-                fname = a.get("filename") or ""
-                a["preview_url"] = f"/api/image/{urllib.parse.quote(fname)}" if fname else ""
-
-            uid = a.get("user_id")
-            p = user_map.get(str(uid)) if uid else None
-            if p:
-                a["uploader_username"] = p.get("username")
-                a["uploader_display_name"] = p.get("display_name")
-
-        return {
-            "users_count": getattr(users_res, "count", 0) or 0,
-            "assets_count": getattr(assets_res, "count", 0) or 0,
-            "users": latest_users_res.data or [],
-            "assets": assets,
-            "admin_secret_enabled": admin_secret_enabled,
-        }
     except Exception as e:
         logger.error(f"Admin summary query failed: {e}")
         raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
 
 
 @router.get("/assets")
-def list_all_assets(
+async def list_all_assets(
     limit: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
     authorization: Optional[str] = Header(None),
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
 ) -> Dict[str, Any]:
     """管理员查看全部资产（分页）"""
-    _require_admin(authorization, x_admin_secret)
+    await _require_admin(authorization, x_admin_secret)
 
     sb = get_supabase_service_client()
     if not sb:
         raise HTTPException(status_code=500, detail="Supabase service client not configured")
 
     try:
-        total_res = sb.table("watermarked_assets").select("id", count="exact").limit(1).execute()
+        total_res = await run_in_threadpool(sb.table("watermarked_assets").select("id", count="exact").limit(1).execute)
         total = getattr(total_res, "count", 0) or 0
 
-        assets_res = (
+        assets_res = await run_in_threadpool(
             sb.table("watermarked_assets")
-            .select(
-                "id, user_id, filename, asset_type, created_at, output_path, fingerprint, phash, timestamp, psnr, tx_hash, block_height"
-            )
+            .select(ASSET_LIST_COLS)
             .order("created_at", desc=True)
             .range(offset, offset + limit - 1)
-            .execute()
+            .execute
         )
         assets: List[Dict[str, Any]] = assets_res.data or []
 
-        # uploader map
-        user_ids = list({a.get("user_id") for a in assets if a.get("user_id")})
-        user_map: Dict[str, Dict[str, Any]] = {}
-        if user_ids:
-            try:
-                prof_res = (
-                    sb.table("profiles")
-                    .select("id, username, display_name")
-                    .in_("id", user_ids)
-                    .execute()
-                )
-                for p in (prof_res.data or []):
-                    pid = p.get("id")
-                    if pid:
-                        user_map[str(pid)] = p
-            except Exception:
-                user_map = {}
-
-        for a in assets:
-            a["is_locked"] = False
-            url = a.get("output_path") or ""
-            if isinstance(url, str) and url.startswith("http"):
-                a["preview_url"] = url
-            else:
-                fname = a.get("filename") or ""
-                a["preview_url"] = f"/api/image/{urllib.parse.quote(fname)}" if fname else ""
-
-            uid = a.get("user_id")
-            p = user_map.get(str(uid)) if uid else None
-            if p:
-                a["uploader_username"] = p.get("username")
-                a["uploader_display_name"] = p.get("display_name")
+        # 上传者信息已随资产嵌入返回（uploader），展开并补齐预览 URL（管理员不锁定/不打码）
+        assets = [_admin_asset_view(a) for a in assets]
 
         return {
             "success": True,
@@ -352,7 +364,7 @@ def list_all_assets(
 
 
 @router.post("/update-user-plan")
-def update_user_plan(
+async def update_user_plan(
     user_id: str = Form(...),
     plan: str = Form(...),
     subscription_period: Optional[str] = Form(None),  # 'month' 或 'year'
@@ -363,164 +375,71 @@ def update_user_plan(
     管理员手动调整用户套餐权限和订阅周期
     同步更新到 Supabase profiles 表
     """
-    _require_admin(authorization, x_admin_secret)
+    await _require_admin(authorization, x_admin_secret)
 
     sb = get_supabase_service_client()
     if not sb:
         raise HTTPException(status_code=500, detail="Supabase service client not configured")
 
-    # 根据套餐设置额度（仅4类权限）
-    quota_map = {
-        "free": 10,
-        "personal": 500,
-        "pro": 2000,
-        "enterprise": 9999999,
-    }
-    quota_total = quota_map.get(plan, 10)
-
-    embed_quota_map = {"free": 50, "personal": 500, "pro": 2000, "enterprise": 9999999}
-    detect_quota_map = {"free": 20, "personal": 200, "pro": 1000, "enterprise": 9999999}
-    
-    # 计算订阅到期时间
-    from datetime import datetime, timedelta, timezone
-    now = datetime.now(timezone.utc)
-    expires_at = None
-    sub_status = 'inactive'
-
-    # 续费/顺延仅在管理员显式传入周期（month/year）时发生。
-    # 仅修改套餐（plan）时，不应隐式顺延到期时间，避免误操作造成“多续费”。
-    effective_period = subscription_period if subscription_period in ['month', 'year'] else None
-
-    def _parse_iso_datetime(val: Optional[str]) -> Optional[datetime]:
-        if not val:
-            return None
-        try:
-            s = str(val).strip()
-            if s.endswith('Z'):
-                s = s[:-1] + '+00:00'
-            dt = datetime.fromisoformat(s)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            return dt
-        except Exception:
-            return None
-
     try:
-        existing_res = (
-            sb.table("profiles")
-            .select(
-                "id, quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, subscription_period, subscription_status, subscription_expires_at, subscription_started_at"
-            )
-            .eq("id", user_id)
-            .limit(1)
-            .execute()
+        # 读取现有额度/订阅、计算新额度与到期时间、写回，均在 admin_update_user_plan RPC 中
+        # 以 SELECT ... FOR UPDATE 在同一事务内完成（见 supabase_migration_admin_update_user_plan_rpc.sql），
+        # 避免与并发的额度扣减/支付回调互相覆盖
+        res = await run_in_threadpool(
+            sb.rpc(
+                "admin_update_user_plan",
+                {"_uid": user_id, "_plan": plan, "_period": subscription_period},
+            ).execute
         )
-        existing_row = existing_res.data[0] if existing_res and existing_res.data else None
-        if not existing_row:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        existing_quota_used = int(existing_row.get("quota_used") or 0)
-        existing_quota_embed_used = int(existing_row.get("quota_embed_used") or 0)
-        existing_quota_detect_used = int(existing_row.get("quota_detect_used") or 0)
-
-        # 续费顺延：如果当前订阅未到期，则在原到期时间基础上延长；否则从现在开始
-        base_time = now
-        if effective_period in ['month', 'year'] and plan != 'free':
-            prev_expires = _parse_iso_datetime(existing_row.get('subscription_expires_at'))
-            prev_status = existing_row.get('subscription_status')
-            if prev_expires and prev_status == 'active' and prev_expires > now:
-                base_time = prev_expires
-
-            if effective_period == 'month':
-                expires_at = base_time + timedelta(days=30)
-            else:  # year
-                expires_at = base_time + timedelta(days=365)
-            sub_status = 'active'
-
-        # 构建更新数据
-        new_quota_embed_total = embed_quota_map.get(plan, 50)
-        new_quota_detect_total = detect_quota_map.get(plan, 20)
-
-        # total 不能小于已用，避免出现 used > total 导致前端/后端逻辑异常
-        new_quota_embed_total = max(int(new_quota_embed_total), existing_quota_embed_used)
-        new_quota_detect_total = max(int(new_quota_detect_total), existing_quota_detect_used)
-        quota_total = max(int(quota_total), existing_quota_used)
-
-        update_data = {
-            "plan": plan,
-            # 兼容旧字段
-            "quota_total": quota_total,
-            "quota_used": existing_quota_used,
-            # 新字段：分开限制嵌入/检测
-            "quota_embed_total": new_quota_embed_total,
-            "quota_embed_used": existing_quota_embed_used,
-            "quota_detect_total": new_quota_detect_total,
-            "quota_detect_used": existing_quota_detect_used,
-        }
-        
-        # 添加订阅相关字段
-        if effective_period:
-            update_data["subscription_period"] = effective_period
-            update_data["subscription_status"] = sub_status
-            update_data["subscription_started_at"] = now.isoformat()
-            if expires_at:
-                update_data["subscription_expires_at"] = expires_at.isoformat()
-        
-        # 如果是免费版，清除订阅信息
-        if plan == 'free':
-            update_data["subscription_period"] = None
-            update_data["subscription_status"] = 'inactive'
-            update_data["subscription_expires_at"] = None
-            update_data["subscription_started_at"] = None
-        
-        # 更新用户套餐和额度
-        res = sb.table("profiles").update(update_data).eq("id", user_id).execute()
-
-        updated = res.data[0] if res and res.data else None
+        updated = res.data if res else None
         if not updated:
             raise HTTPException(status_code=404, detail="User not found")
 
+        invalidate_user_cache(user_id)
+        await invalidate_quota_caches(user_id)
+        invalidate_admin_role_cache(user_id)
+        await stats_cache.invalidate(_STATS_CACHE_PREFIX)
+
         return {
             "success": True,
             "message": f"User {user_id} upgraded to {plan} ({subscription_period or 'one-time'})",
             "user": updated
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to update user plan: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @router.get("/users/{user_id}")
-def get_user_detail(
+async def get_user_detail(
     user_id: str,
     authorization: Optional[str] = Header(None),
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
 ) -> Dict[str, Any]:
     """获取单个用户的详细信息"""
-    _require_admin(authorization, x_admin_secret)
+    await _require_admin(authorization, x_admin_secret)
     
     sb = get_supabase_service_client()
     if not sb:
         raise HTTPException(status_code=500, detail="Supabase service client not configured")
     
     try:
-        user_res = sb.table("profiles").select(
-            "id, username, display_name, role, plan, "
-            "quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, "
-            "subscription_period, subscription_expires_at, subscription_status, subscription_started_at, "
-            "created_at"
-        ).eq("id", user_id).limit(1).execute()
+        # 用户资料与资产数、检测记录数、举报数互不依赖，四个查询并发执行
+        # 计数只需 count，head=True 不返回任何行
+        user_res, assets_count, detections_count, reports_count = await asyncio.gather(
+            run_in_threadpool(sb.table("profiles").select(PROFILE_DETAIL_COLS).eq("id", user_id).limit(1).execute),
+            run_in_threadpool(sb.table("watermarked_assets").select("id", count="exact", head=True).eq("user_id", user_id).execute),
+            run_in_threadpool(sb.table("detection_records").select("id", count="exact", head=True).eq("user_id", user_id).execute),
+            run_in_threadpool(sb.table("infringement_reports").select("id", count="exact", head=True).eq("reporter_id", user_id).execute),
+        )
         
         if not user_res.data:
             raise HTTPException(status_code=404, detail="User not found")
         
         user = user_res.data[0]
         
-        # 统计该用户的资产数、检测记录数、举报数
-        assets_count = sb.table("watermarked_assets").select("id", count="exact").eq("user_id", user_id).limit(1).execute()
-        detections_count = sb.table("detection_records").select("id", count="exact").eq("user_id", user_id).limit(1).execute()
-        reports_count = sb.table("infringement_reports").select("id", count="exact").eq("reporter_id", user_id).limit(1).execute()
-        
         user["stats"] = {
             "assets_count": getattr(assets_count, "count", 0) or 0,
             "detections_count": getattr(detections_count, "count", 0) or 0,
@@ -536,7 +455,7 @@ def get_user_detail(
 
 
 @router.get("/users/{user_id}/assets")
-def get_user_assets(
+async def get_user_assets(
     user_id: str,
     limit: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
@@ -545,7 +464,7 @@ def get_user_assets(
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
 ) -> Dict[str, Any]:
     """获取用户上传的资产列表（分页）"""
-    _require_admin(authorization, x_admin_secret)
+    await _require_admin(authorization, x_admin_secret)
     
     sb = get_supabase_service_client()
     if not sb:
@@ -553,18 +472,16 @@ def get_user_assets(
     
     try:
         query = sb.table("watermarked_assets").select(
-            "id, filename, fingerprint, phash, timestamp, psnr, asset_type, output_path, tx_hash, block_height, created_at"
+            "id, filename, fingerprint, phash, timestamp, psnr, asset_type, output_path, tx_hash, block_height, created_at",
+            count="exact",
         ).eq("user_id", user_id)
         
         if asset_type:
             query = query.eq("asset_type", asset_type)
         
-        # 先获取总数
-        count_res = query.execute()
-        total = len(count_res.data) if count_res.data else 0
-        
-        # 分页查询
-        res = query.order("created_at", desc=True).limit(limit).offset(offset).execute()
+        # 分页查询，总数由 count="exact" 随同一请求返回（不再拉取全部行再 len）
+        res = await run_in_threadpool(query.order("created_at", desc=True).range(offset, offset + limit - 1).execute)
+        total = getattr(res, "count", 0) or 0
         
         return {
             "success": True,
@@ -579,7 +496,7 @@ def get_user_assets(
 
 
 @router.get("/users/{user_id}/detection-records")
-def get_user_detection_records(
+async def get_user_detection_records(
     user_id: str,
     limit: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
@@ -590,7 +507,7 @@ def get_user_detection_records(
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
 ) -> Dict[str, Any]:
     """获取用户的检测记录列表（分页+筛选）"""
-    _require_admin(authorization, x_admin_secret)
+    await _require_admin(authorization, x_admin_secret)
     
     sb = get_supabase_service_client()
     if not sb:
@@ -599,7 +516,8 @@ def get_user_detection_records(
     try:
         query = sb.table("detection_records").select(
             "id, user_id, created_at, input_filename, has_watermark, confidence, "
-            "matched_asset_id, matched_asset, candidates, fingerprint_prefix, metadata"
+            "matched_asset_id, matched_asset, candidates, fingerprint_prefix, metadata",
+            count="exact",
         ).eq("user_id", user_id)
         
         if has_watermark is not None:
@@ -610,12 +528,9 @@ def get_user_detection_records(
         if end_date:
             query = query.lte("created_at", end_date)
         
-        # 获取总数（简化：用 count="exact" 但 Supabase Python 客户端可能不支持，这里用 len）
-        count_res = query.execute()
-        total = len(count_res.data) if count_res.data else 0
-        
-        # 分页查询
-        res = query.order("created_at", desc=True).limit(limit).offset(offset).execute()
+        # 分页查询，总数由 count="exact" 随同一请求返回（不再拉取全部行再 len）
+        res = await run_in_threadpool(query.order("created_at", desc=True).range(offset, offset + limit - 1).execute)
+        total = getattr(res, "count", 0) or 0
         
         return {
             "success": True,
@@ -630,7 +545,7 @@ def get_user_detection_records(
 
 
 @router.get("/users/{user_id}/infringement-reports")
-def get_user_infringement_reports(
+async def get_user_infringement_reports(
     user_id: str,
     limit: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
@@ -639,7 +554,7 @@ def get_user_infringement_reports(
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
 ) -> Dict[str, Any]:
     """获取用户的侵权举报/维权记录（分页+筛选）"""
-    _require_admin(authorization, x_admin_secret)
+    await _require_admin(authorization, x_admin_secret)
     
     sb = get_supabase_service_client()
     if not sb:
@@ -648,16 +563,16 @@ def get_user_infringement_reports(
     try:
         query = sb.table("infringement_reports").select(
             "id, reporter_id, asset_id, infringing_url, similarity, status, "
-            "analysis, dmca_text, created_at, updated_at"
+            "analysis, dmca_text, created_at, updated_at",
+            count="exact",
         ).eq("reporter_id", user_id)
         
         if status:
             query = query.eq("status", status)
         
-        count_res = query.execute()
-        total = len(count_res.data) if count_res.data else 0
-        
-        res = query.order("created_at", desc=True).limit(limit).offset(offset).execute()
+        # 分页查询，总数由 count="exact" 随同一请求返回（不再拉取全部行再 len）
+        res = await run_in_threadpool(query.order("created_at", desc=True).range(offset, offset + limit - 1).execute)
+        total = getattr(res, "count", 0) or 0
         
         return {
             "success": True,
@@ -671,8 +586,19 @@ def get_user_infringement_reports(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _timeline_item(row: Dict[str, Any]) -> Dict[str, Any]:
+    """视图行 → 时间线条目（补图标；仅检测记录带 confidence）"""
+    kind = row.get("type")
+    if kind == "detection":
+        row["icon"] = "🔍" if row.get("subtype") == "hit" else "❓"
+    else:
+        row.pop("confidence", None)
+        row["icon"] = "📁" if kind == "asset" else "⚠️"
+    return row
+
+
 @router.get("/users/{user_id}/timeline")
-def get_user_timeline(
+async def get_user_timeline(
     user_id: str,
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
@@ -680,72 +606,31 @@ def get_user_timeline(
     x_admin_secret: Optional[str] = Header(None, alias="X-Admin-Secret"),
 ) -> Dict[str, Any]:
     """获取用户的时间线（合并资产、检测、举报记录，按时间排序）"""
-    _require_admin(authorization, x_admin_secret)
+    await _require_admin(authorization, x_admin_secret)
     
     sb = get_supabase_service_client()
     if not sb:
         raise HTTPException(status_code=500, detail="Supabase service client not configured")
     
     try:
-        # 获取各类记录
-        assets_res = sb.table("watermarked_assets").select(
-            "id, filename, asset_type, created_at"
-        ).eq("user_id", user_id).order("created_at", desc=True).limit(100).execute()
-        
-        detections_res = sb.table("detection_records").select(
-            "id, input_filename, has_watermark, confidence, created_at"
-        ).eq("user_id", user_id).order("created_at", desc=True).limit(100).execute()
-        
-        reports_res = sb.table("infringement_reports").select(
-            "id, infringing_url, status, created_at"
-        ).eq("reporter_id", user_id).order("created_at", desc=True).limit(100).execute()
-        
-        # 合并时间线
-        timeline = []
-        
-        for a in (assets_res.data or []):
-            timeline.append({
-                "type": "asset",
-                "subtype": a.get("asset_type", "image"),
-                "id": a["id"],
-                "title": a.get("filename", "未知文件"),
-                "timestamp": a.get("created_at"),
-                "icon": "📁"
-            })
-        
-        for d in (detections_res.data or []):
-            timeline.append({
-                "type": "detection",
-                "subtype": "hit" if d.get("has_watermark") else "miss",
-                "id": d["id"],
-                "title": d.get("input_filename", "检测任务"),
-                "timestamp": d.get("created_at"),
-                "confidence": d.get("confidence"),
-                "icon": "🔍" if d.get("has_watermark") else "❓"
-            })
-        
-        for r in (reports_res.data or []):
-            timeline.append({
-                "type": "report",
-                "subtype": r.get("status", "pending"),
-                "id": r["id"],
-                "title": r.get("infringing_url", "侵权举报")[:50] + "..." if r.get("infringing_url") else "侵权举报",
-                "timestamp": r.get("created_at"),
-                "icon": "⚠️"
-            })
-        
-        # 按时间倒序
-        timeline.sort(key=lambda x: x.get("timestamp") or "", reverse=True)
+        # 合并、排序、分页均在数据库视图 user_timeline_v 中完成，只取当前页
+        res = await run_in_threadpool(
+            sb.table("user_timeline_v")
+            .select("type, subtype, id, title, timestamp, confidence", count="exact")
+            .eq("user_id", user_id)
+            .order("timestamp", desc=True)
+            .range(offset, offset + limit - 1)
+            .execute
+        )
         
-        total = len(timeline)
-        paginated = timeline[offset:offset+limit]
+        timeline = [_timeline_item(row) for row in (res.data or [])]
         
         return {
             "success": True,
-            "total": total,
+            "total": getattr(res, "count", 0) or 0,
             "limit": limit,
             "offset": offset,
-            "timeline": paginated
+            "timeline": timeline
         }
     except Exception as e:
         logger.error(f"Failed to get user timeline: {e}")
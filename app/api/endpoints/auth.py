@@ -1,14 +1,15 @@
 from datetime import timedelta
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from starlette.responses import RedirectResponse
-import httpx
 
 from app.core.config import settings
 from app.schema.token import Token
 from app.service.auth import AuthService
 from app.utils.security import create_access_token
+from app.utils.supabase import get_supabase_http_client
 
 router = APIRouter()
 
@@ -24,7 +25,8 @@ async def proxy_supabase_verify(request: Request):
 
     verify_url = settings.SUPABASE_URL.rstrip("/") + "/auth/v1/verify"
 
-    params = dict(request.query_params)
+    # 直接转发原始查询参数（保留重复键），不再复制成 dict
+    params = request.query_params.multi_items()
 
     headers = {}
     if settings.SUPABASE_KEY:
@@ -33,15 +35,22 @@ async def proxy_supabase_verify(request: Request):
             "Authorization": f"Bearer {settings.SUPABASE_KEY}",
         }
 
-    async with httpx.AsyncClient(follow_redirects=False, timeout=20.0) as client:
-        resp = await client.get(verify_url, params=params, headers=headers)
+    # 复用进程级 AsyncClient；邮件验证不跟随重定向，需要把 Location 交给浏览器
+    # 以流式方式发送：成功时只读响应头（Location），不读取响应体
+    client = get_supabase_http_client()
+    req = client.build_request("GET", verify_url, params=params, headers=headers, timeout=20.0)
+    resp = await client.send(req, stream=True, follow_redirects=False)
+    try:
+        location = resp.headers.get("location")
+        if location:
+            return RedirectResponse(url=location, status_code=302)
 
-    location = resp.headers.get("location") or resp.headers.get("Location")
-    if location:
-        return RedirectResponse(url=location, status_code=302)
-
-    # If Supabase doesn't redirect, pass through a meaningful error.
-    raise HTTPException(status_code=resp.status_code, detail=resp.text or "Verification failed")
+        # If Supabase doesn't redirect, pass through a meaningful error.
+        body = await resp.aread()
+        detail = body.decode(resp.encoding or "utf-8", errors="replace") if body else ""
+        raise HTTPException(status_code=resp.status_code, detail=detail or "Verification failed")
+    finally:
+        await resp.aclose()
 
 
 @router.get("/auth/verify")
@@ -50,7 +59,8 @@ async def proxy_supabase_verify_alias(request: Request):
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    user = AuthService.authenticate_user(form_data.username, form_data.password)
+    # authenticate_user 同步调用 Supabase Auth + profiles 查询，放到线程池执行，避免阻塞事件循环
+    user = await run_in_threadpool(AuthService.authenticate_user, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
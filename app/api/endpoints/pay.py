@@ -1,33 +1,36 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Form, Header
-from typing import Optional, Dict, Any
-from app.api.deps import get_current_user
+from fastapi.concurrency import run_in_threadpool
+from typing import Annotated, Optional, Dict, Any, NamedTuple, Tuple
+from functools import lru_cache
+from types import MappingProxyType
+from app.api.deps import get_current_user, invalidate_user_cache
+from app.api.endpoints.watermark import invalidate_quota_caches
+from app.schema.pay import PlanName, Period, UpgradeForm
+from app.utils.supabase import get_supabase_http_client
 from alipay import AliPay
 import os
+import time
 import uuid
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime
+from urllib.parse import quote_plus
 from dotenv import load_dotenv
-import httpx
-from jose import jwt as jose_jwt
-
-router = APIRouter()
-
-
-def _get_frontend_url() -> str:
-    return os.environ.get("FRONTEND_URL", "http://localhost:5173").rstrip("/")
-
-
-def _get_backend_url() -> str:
-    return os.environ.get("BACKEND_URL", "http://localhost:8000").rstrip("/")
+import jwt as pyjwt
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
 
+# 模块导入时加载一次 .env（之后每次请求不再重复读取文件）
+load_dotenv()
 
-def _get_alipay_gateway() -> str:
-    return os.environ.get(
-        "ALIPAY_GATEWAY",
-        "https://openapi-sandbox.dl.alipaydev.com/gateway.do",
-    ).rstrip("?").rstrip("/")
+router = APIRouter()
 
 
-def _get_alipay_debug() -> bool:
-    v = os.environ.get("ALIPAY_DEBUG", "").strip().lower()
+def _parse_alipay_debug(v: str) -> bool:
+    v = v.strip().lower()
     if v in {"1", "true", "yes", "y", "on"}:
         return True
     if v in {"0", "false", "no", "n", "off"}:
@@ -36,74 +39,141 @@ def _get_alipay_debug() -> bool:
     return True
 
 
-def _apply_subscription_upgrade(
+# ---- 环境配置（导入时读取并规范化一次，请求中不再查 os.environ） ----
+_FRONTEND_URL = os.environ.get("FRONTEND_URL", "http://localhost:5173").rstrip("/")
+_BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8000").rstrip("/")
+_ALIPAY_GATEWAY = os.environ.get(
+    "ALIPAY_GATEWAY",
+    "https://openapi-sandbox.dl.alipaydev.com/gateway.do",
+).rstrip("?").rstrip("/")
+_ALIPAY_DEBUG = _parse_alipay_debug(os.environ.get("ALIPAY_DEBUG", ""))
+_SUPABASE_URL = os.environ.get("SUPABASE_URL", "").rstrip("/")
+# Prefer anon key; service role would also work but should not be required.
+_SUPABASE_AUTH_KEY = os.environ.get("SUPABASE_KEY", "") or os.environ.get("SUPABASE_ANON_KEY", "")
+_SYNC_SECRET = os.environ.get("SYNC_QUOTA_SECRET", "").encode()
+
+
+def _sync_secret_ok(x_sync_secret: Optional[str]) -> bool:
+    """校验 X-Sync-Secret（常量时间比较，避免计时侧信道）"""
+    return bool(_SYNC_SECRET) and x_sync_secret is not None and hmac.compare_digest(_SYNC_SECRET, x_sync_secret.encode())
+
+# ---- 套餐常量（模块级只读，每个套餐一行，一次查表取齐额度与价格） ----
+class PlanRow(NamedTuple):
+    quota: int            # 总额度（兼容旧字段 quota_total）
+    embed: int            # 嵌入额度
+    detect: int           # 检测额度
+    monthly_price: float  # 月付价格
+    yearly_price: float   # 年付折扣价（约85折）
+
+
+# 额度须与 apply_subscription_upgrade RPC 中的 CASE 保持一致
+PLANS = MappingProxyType({
+    "free": PlanRow(10, 50, 20, 0.0, 0.0),
+    "personal": PlanRow(500, 500, 200, 19.0, 199.0),               # 原价 19*12=228，折扣后 199
+    "pro": PlanRow(2000, 2000, 1000, 99.0, 999.0),                 # 原价 99*12=1188，折扣后 999
+    "enterprise": PlanRow(9999999, 9999999, 9999999, 299.0, 2999.0),  # 原价 299*12=3588，折扣后 2999
+})
+_VALID_PLANS = frozenset(PLANS)
+_PERIODS = frozenset({"month", "year"})
+# 验签时需从回调参数中剔除的字段
+_SIGN_KEYS = frozenset({"sign", "sign_type"})
+
+# ---- token → uid 缓存（同一会话重复发货/续费时跳过 JWT 解码与 /auth/v1/user 往返） ----
+# 键为 sha256(token)，内存中不保存原始 token；只缓存校验成功的结果
+_token_uid_cache: dict = {}  # {sha256(token): {"uid": str, "expires": float}}
+_TOKEN_UID_CACHE_TTL = 30  # 秒，远小于 token 有效期
+_TOKEN_UID_CACHE_MAX = 10000
+
+
+def _set_cached_token_uid(key: str, uid: str, exp: Optional[float] = None):
+    now = time.time()
+    expires = now + _TOKEN_UID_CACHE_TTL
+    if exp is not None:
+        # 不超过 token 自身的过期时间
+        expires = min(expires, float(exp))
+        if expires <= now:
+            return
+    if len(_token_uid_cache) >= _TOKEN_UID_CACHE_MAX:
+        for k in [k for k, v in _token_uid_cache.items() if v["expires"] <= now]:
+            del _token_uid_cache[k]
+        if len(_token_uid_cache) >= _TOKEN_UID_CACHE_MAX:
+            _token_uid_cache.clear()
+    _token_uid_cache[key] = {"uid": uid, "expires": expires}
+
+
+async def _apply_subscription_upgrade(
     *,
     sb,
-    username: str,
     plan: str,
-    period: str,
-) -> None:
-    from datetime import datetime, timedelta, timezone
-
-    user_res = sb.table("profiles").select(
-        "id, quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, subscription_status, subscription_expires_at"
-    ).eq("username", username).limit(1).execute()
-    if not user_res.data:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_row = user_res.data[0]
-    user_id = user_row.get("id")
-    if not user_id:
-        raise HTTPException(status_code=500, detail="Invalid user profile")
-
-    embed_quota_map = {"free": 50, "personal": 500, "pro": 2000, "enterprise": 9999999}
-    detect_quota_map = {"free": 20, "personal": 200, "pro": 1000, "enterprise": 9999999}
-    quota_map = {"free": 10, "personal": 500, "pro": 2000, "enterprise": 9999999}
-    if plan not in quota_map:
+    period: Optional[str],
+    username: Optional[str] = None,
+    user_id: Optional[str] = None,
+    out_trade_no: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """发货：更新套餐额度并顺延订阅，返回更新后的 profiles 行；用户不存在（或 uid 与 username 不匹配）时返回 None
+
+    读取现有订阅、计算到期时间、写回均在 apply_subscription_upgrade RPC 中以 SELECT ... FOR UPDATE
+    一次完成（见 supabase_migration_pay_subscription_rpc.sql），只需一次往返且不会与并发发货互相覆盖。
+    传入 out_trade_no 时由 payment_orders 主键保证同一订单只发货一次（见 supabase_migration_payment_orders.sql）。
+    """
+    if plan not in _VALID_PLANS:
         raise HTTPException(status_code=400, detail="Invalid plan")
 
-    now = datetime.now(timezone.utc)
-    prev_expires = _parse_iso_datetime(user_row.get("subscription_expires_at"))
-    prev_status = user_row.get("subscription_status")
-    base_time = now
-    if prev_expires and prev_status == "active" and prev_expires > now:
-        base_time = prev_expires
+    res = await run_in_threadpool(
+        sb.rpc(
+            "apply_subscription_upgrade",
+            {
+                "p_plan": plan,
+                "p_period": period,
+                "p_username": username,
+                "p_user_id": user_id,
+                "p_out_trade_no": out_trade_no,
+            },
+        ).execute
+    )
+    row = res.data if res else None
+    if not row:
+        return None
 
-    effective_period = period if period in ["month", "year"] else "month"
-    new_expires = base_time + (timedelta(days=30) if effective_period == "month" else timedelta(days=365))
+    invalidate_user_cache(row.get("id"))
+    await invalidate_quota_caches(row.get("id"))
+    if out_trade_no:
+        _mark_order_processed(out_trade_no)
+    return row
 
-    update_data = {
-        "plan": plan,
-        "quota_total": int(quota_map.get(plan) or 10),
-        "quota_used": int(user_row.get("quota_used") or 0),
-        "quota_embed_total": int(embed_quota_map.get(plan) or 50),
-        "quota_embed_used": int(user_row.get("quota_embed_used") or 0),
-        "quota_detect_total": int(detect_quota_map.get(plan) or 20),
-        "quota_detect_used": int(user_row.get("quota_detect_used") or 0),
-        "subscription_period": effective_period,
-        "subscription_status": "active",
-        "subscription_started_at": now.isoformat(),
-        "subscription_expires_at": new_expires.isoformat(),
-    }
 
-    sb.table("profiles").update(update_data).eq("id", user_id).execute()
+# ---- 已发货订单缓存：支付宝异步通知 25 小时内最多重试 8 次，重复到达时直接应答，不再访问 Supabase ----
+# 仅是性能优化，幂等性由 payment_orders.out_trade_no 主键保证
+_processed_orders: dict = {}  # {out_trade_no: expires}
+_PROCESSED_ORDERS_TTL = 26 * 3600  # 秒，覆盖支付宝的重试窗口
+_PROCESSED_ORDERS_MAX = 100000
 
 
-def _parse_iso_datetime(val: Optional[str]):
-    if not val:
-        return None
-    try:
-        from datetime import datetime, timezone
-
-        s = str(val).strip()
-        if s.endswith('Z'):
-            s = s[:-1] + '+00:00'
-        dt = datetime.fromisoformat(s)
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt
-    except Exception:
+def _is_order_processed(out_trade_no: str) -> bool:
+    expires = _processed_orders.get(out_trade_no)
+    return bool(expires and expires > time.time())
+
+
+def _mark_order_processed(out_trade_no: str):
+    now = time.time()
+    if len(_processed_orders) >= _PROCESSED_ORDERS_MAX:
+        for k in [k for k, v in _processed_orders.items() if v <= now]:
+            del _processed_orders[k]
+        if len(_processed_orders) >= _PROCESSED_ORDERS_MAX:
+            _processed_orders.clear()
+    _processed_orders[out_trade_no] = now + _PROCESSED_ORDERS_TTL
+
+
+def _split_out_trade_no(out_trade_no: str) -> Optional[Tuple[str, str, str]]:
+    """解析 out_trade_no -> (username, plan, period)；格式不符返回 None
+
+    格式: {username}_{plan}_{period}_{rand}
+    注意：username 可能包含 '_'，因此必须从右侧拆分
+    """
+    parts = out_trade_no.rsplit("_", 3)
+    if len(parts) != 4:
         return None
+    return parts[0], parts[1], parts[2]
 
 
 async def _get_verified_user_id_from_authorization(authorization: Optional[str]) -> Optional[str]:
@@ -114,52 +184,58 @@ async def _get_verified_user_id_from_authorization(authorization: Optional[str])
     if not token:
         return None
 
+    # 0) 命中缓存直接返回（只缓存成功结果，失败每次都重新校验）
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    entry = _token_uid_cache.get(cache_key)
+    if entry and entry["expires"] > time.time():
+        return entry["uid"]
+
     # 1) Try local JWT (platform issued)
+    # PyJWT 走 hashlib/cryptography 原生实现；python-jose 签发的 HS256 token 可原样解码
     try:
         from app.core.config import settings
 
-        payload = jose_jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = pyjwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         sub = payload.get("sub")
         if sub:
+            _set_cached_token_uid(cache_key, str(sub), payload.get("exp"))
             return str(sub)
-    except Exception:
+    except pyjwt.PyJWTError:
         pass
 
     # 2) Try Supabase: validate token server-side via /auth/v1/user
-    supabase_url = os.environ.get("SUPABASE_URL", "").rstrip("/")
-    if not supabase_url:
+    if not _SUPABASE_URL or not _SUPABASE_AUTH_KEY:
         return None
 
-    # Prefer anon key; service role would also work but should not be required.
-    api_key = os.environ.get("SUPABASE_KEY", "") or os.environ.get("SUPABASE_ANON_KEY", "")
-    if not api_key:
+    # 复用进程级 AsyncClient（保持与 Supabase 的长连接）
+    client = get_supabase_http_client()
+    if client is None:
         return None
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            res = await client.get(
-                f"{supabase_url}/auth/v1/user",
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "apikey": api_key,
-                },
-            )
-            if res.status_code != 200:
-                return None
-            data = res.json()
-            uid = data.get("id")
-            if uid:
-                return str(uid)
+        res = await client.get(
+            f"{_SUPABASE_URL}/auth/v1/user",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "apikey": _SUPABASE_AUTH_KEY,
+            },
+        )
+        if res.status_code != 200:
+            return None
+        data = res.json()
+        uid = data.get("id")
+        if uid:
+            _set_cached_token_uid(cache_key, str(uid))
+            return str(uid)
     except Exception:
         return None
 
     return None
 
 
-def get_alipay() -> AliPay:
-    # 强制动态加载 .env 环境变量（避免因启动顺序导致变量没吃进去）
-    load_dotenv()
-    
+@lru_cache(maxsize=1)
+def _load_alipay_keys() -> Tuple[str, str, str]:
+    """读取支付宝配置，返回 (app_id, 私钥 PEM, 支付宝公钥 PEM)；配置缺失时抛错且不缓存"""
     ALIPAY_APP_ID = os.environ.get("ALIPAY_APP_ID", "")
     ALIPAY_PRIVATE_KEY = os.environ.get("ALIPAY_PRIVATE_KEY", "").replace("\\n", "\n")
     ALIPAY_PUBLIC_KEY = os.environ.get("ALIPAY_PUBLIC_KEY", "").replace("\\n", "\n")
@@ -181,66 +257,159 @@ def get_alipay() -> AliPay:
     if "-----BEGIN PUBLIC KEY-----" not in full_public_key:
         full_public_key = f"-----BEGIN PUBLIC KEY-----\n{full_public_key}\n-----END PUBLIC KEY-----"
 
+    return ALIPAY_APP_ID, full_private_key, full_public_key
+
+
+@lru_cache(maxsize=1)
+def _build_alipay() -> AliPay:
+    """构造 AliPay 客户端（每个 worker 只解析一次 RSA 密钥）"""
+    app_id, full_private_key, full_public_key = _load_alipay_keys()
     return AliPay(
-        appid=ALIPAY_APP_ID,
+        appid=app_id,
         app_notify_url=None,  # 默认回调 URL
         app_private_key_string=full_private_key,
         alipay_public_key_string=full_public_key,
         sign_type="RSA2",
-        debug=_get_alipay_debug(),
+        debug=_ALIPAY_DEBUG,
+    )
+
+
+@lru_cache(maxsize=1)
+def _alipay_public_key():
+    """预加载的支付宝公钥（cryptography RSAPublicKey，验签走 OpenSSL）"""
+    return serialization.load_pem_public_key(_load_alipay_keys()[2].encode())
+
+
+def get_alipay() -> AliPay:
+    return _build_alipay()
+
+
+def reset_alipay_cache():
+    """清除已缓存的 AliPay 客户端与密钥（修改支付宝环境变量后调用）"""
+    _build_alipay.cache_clear()
+    _alipay_public_key.cache_clear()
+    _alipay_private_key.cache_clear()
+    _page_pay_template.cache_clear()
+    _load_alipay_keys.cache_clear()
+
+
+@lru_cache(maxsize=1)
+def _alipay_private_key():
+    """预加载的应用私钥（cryptography，签名走 OpenSSL）；PEM 无法被 cryptography 解析时返回 None"""
+    try:
+        return serialization.load_pem_private_key(_load_alipay_keys()[1].encode(), password=None)
+    except (ValueError, TypeError):
+        return None
+
+
+@lru_cache(maxsize=1)
+def _page_pay_template() -> Tuple[str, str, str, str, str, str]:
+    """alipay.trade.page.pay 待签字符串 / 签名后查询串中的固定片段
+
+    与 AliPay.api_alipay_trade_page_pay 的结果逐字节一致：参数按 key 排序为
+    app_id, biz_content, charset, method, notify_url, return_url, sign_type, timestamp, version，
+    其中只有 biz_content 与 timestamp 随订单变化，其余部分每个 worker 只拼接一次。
+    返回 (raw_head, raw_mid, raw_tail, quoted_head, quoted_mid, quoted_tail)。
+    """
+    app_id = _load_alipay_keys()[0]
+    notify_url = f"{_BACKEND_URL}/api/pay/alipay-notify"
+    return_url = f"{_BACKEND_URL}/api/pay/alipay-return"
+    mid = [
+        ("charset", "utf-8"),
+        ("method", "alipay.trade.page.pay"),
+        ("notify_url", notify_url),
+        ("return_url", return_url),
+        ("sign_type", "RSA2"),
+    ]
+    raw_mid = "".join(f"&{k}={v}" for k, v in mid)
+    quoted_mid = "".join(f"&{k}={quote_plus(v)}" for k, v in mid)
+    return (
+        f"app_id={app_id}&biz_content=",
+        f"{raw_mid}&timestamp=",
+        "&version=1.0",
+        f"app_id={quote_plus(app_id)}&biz_content=",
+        f"{quoted_mid}&timestamp=",
+        "&version=1.0",
+    )
+
+
+def _page_pay_order_string(*, subject: str, out_trade_no: str, total_amount: float) -> str:
+    """生成电脑网站支付的签名查询串（等价于 AliPay.api_alipay_trade_page_pay）
+
+    固定参数取自 _page_pay_template，只对 biz_content / timestamp 做拼接与 URL 编码，
+    并用预加载的 cryptography 私钥签名；私钥无法被 cryptography 解析时回退到 SDK。
+    """
+    key = _alipay_private_key()
+    if key is None:
+        return get_alipay().api_alipay_trade_page_pay(
+            out_trade_no=out_trade_no,
+            total_amount=total_amount,
+            subject=subject,
+            return_url=f"{_BACKEND_URL}/api/pay/alipay-return",
+            notify_url=f"{_BACKEND_URL}/api/pay/alipay-notify",
+        )
+
+    biz_content = json.dumps(
+        {
+            "subject": subject,
+            "out_trade_no": out_trade_no,
+            "total_amount": total_amount,
+            "product_code": "FAST_INSTANT_TRADE_PAY",
+        },
+        separators=(",", ":"),
     )
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    raw_head, raw_mid, raw_tail, q_head, q_mid, q_tail = _page_pay_template()
+
+    raw = f"{raw_head}{biz_content}{raw_mid}{timestamp}{raw_tail}"
+    sign = base64.b64encode(key.sign(raw.encode(), padding.PKCS1v15(), hashes.SHA256())).decode()
+    return f"{q_head}{quote_plus(biz_content)}{q_mid}{quote_plus(timestamp)}{q_tail}&sign={quote_plus(sign)}"
+
+
+def _verify_alipay_signature(params: Dict[str, str], sign: str, sign_type: Optional[str] = None) -> bool:
+    """校验支付宝回调签名（RSA2 / SHA256withRSA）
+
+    与 AliPay.verify 的待签字符串规则一致（按 key 排序后 k=v 以 & 拼接，params 已剔除 sign/sign_type），
+    但用预加载的 cryptography 公钥验签，比 SDK 内置的 pycryptodome 实现快一个数量级。
+    回调带了 sign_type 且不是 RSA2 时直接判定失败（SDK 对此抛 AliPayException）。
+    """
+    if sign_type is not None and sign_type != "RSA2":
+        return False
+    message = "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+    try:
+        _alipay_public_key().verify(
+            base64.b64decode(sign), message.encode(), padding.PKCS1v15(), hashes.SHA256()
+        )
+        return True
+    except (InvalidSignature, ValueError):
+        return False
 
 @router.post("/alipay-create")
-async def create_alipay_order(
-    plan: str = Form(...),
-    period: str = Form(...),  # 'month' 或 'year'
-    username: str = Form(...)
-):
+async def create_alipay_order(form: Annotated[UpgradeForm, Form()]):
     """
     创建支付宝沙箱支付订单，支持月付/年付，生成跳转链接
+    plan / period 的取值由 UpgradeForm 的 Literal 类型校验（非法值返回 422）
     """
-    # 月付价格
-    monthly_prices = {
-        "personal": 19.00,
-        "pro": 99.00,
-        "enterprise": 299.00
-    }
-    # 年付折扣价（约85折）
-    yearly_prices = {
-        "personal": 199.00,      # 原价 19*12=228，折扣后 199
-        "pro": 999.00,           # 原价 99*12=1188，折扣后 999
-        "enterprise": 2999.00    # 原价 299*12=3588，折扣后 2999
-    }
-    
-    if plan not in monthly_prices:
-        raise HTTPException(status_code=400, detail="未知的订阅套餐")
-    
-    if period not in ['month', 'year']:
-        raise HTTPException(status_code=400, detail="订阅周期必须是 'month'(月付) 或 'year'(年付)")
-    
-    # 计算价格
-    total_amount = monthly_prices[plan] if period == 'month' else yearly_prices[plan]
+    plan, period, username = form.plan, form.period, form.username
 
-    try:
-        alipay = get_alipay()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # 计算价格
+    p = PLANS[plan]
+    total_amount = p.monthly_price if period == 'month' else p.yearly_price
 
     out_trade_no = f"{username}_{plan}_{period}_{uuid.uuid4().hex[:8]}"
     period_text = "月付" if period == 'month' else "年付"
 
-    # 调用支付宝接口生成支付链接
-    backend_url = _get_backend_url()
-    order_string = alipay.api_alipay_trade_page_pay(
-        out_trade_no=out_trade_no,
-        total_amount=total_amount,
-        subject=f"AIGC Guard - {plan.upper()} 计划 ({period_text})",
-        return_url=f"{backend_url}/api/pay/alipay-return",
-        notify_url=f"{backend_url}/api/pay/alipay-notify",
-    )
+    # 生成支付链接（固定参数预拼接，只对订单相关字段编码并签名）
+    try:
+        order_string = _page_pay_order_string(
+            out_trade_no=out_trade_no,
+            total_amount=total_amount,
+            subject=f"AIGC Guard - {plan.upper()} 计划 ({period_text})",
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    gateway = _get_alipay_gateway()
-    payment_url = f"{gateway}?" + order_string
+    payment_url = f"{_ALIPAY_GATEWAY}?" + order_string
     
     return {
         "payment_url": payment_url,
@@ -261,11 +430,11 @@ async def alipay_return(request: Request):
     - 验签成功后，再按 out_trade_no 解析 username/plan/period，更新订阅（顺延、不清零用量）。
     """
     from fastapi.responses import RedirectResponse
-    frontend_url = _get_frontend_url()
+    frontend_url = _FRONTEND_URL
 
-    params = dict(request.query_params)
-    sign = params.pop("sign", None)
-    params.pop("sign_type", None)
+    qp = request.query_params
+    sign = qp.get("sign")
+    params = {k: v for k, v in qp.multi_items() if k not in _SIGN_KEYS}
     out_trade_no = params.get("out_trade_no")
 
     if not sign or not out_trade_no:
@@ -273,22 +442,22 @@ async def alipay_return(request: Request):
         return RedirectResponse(url=f"{frontend_url}/pricing?pay=fail&reason=missing_params")
 
     try:
-        alipay = get_alipay()
-        ok = alipay.verify(params, sign)
+        ok = _verify_alipay_signature(params, sign, qp.get("sign_type"))
         if not ok:
             return RedirectResponse(url=f"{frontend_url}/pricing?pay=fail&reason=bad_sign")
 
-        # out_trade_no 格式: {username}_{plan}_{period}_{rand}
-        # 注意：username 可能包含 '_'，因此必须从右侧拆分
-        parts = out_trade_no.rsplit("_", 3)
-        if len(parts) != 4:
+        parsed = _split_out_trade_no(out_trade_no)
+        if parsed is None:
             return RedirectResponse(url=f"{frontend_url}/pricing?pay=fail&reason=bad_out_trade_no")
 
-        username = parts[0]
-        plan = parts[1]
-        period = parts[2]
-        if period not in ["month", "year"]:
+        username, plan, period = parsed
+        if period not in _PERIODS:
             period = "month"
+        success_url = f"{frontend_url}/pricing?pay=success&plan={plan}&period={period}&out_trade_no={out_trade_no}"
+
+        # 异步通知已先到达并发货（或用户刷新了回跳页）
+        if _is_order_processed(out_trade_no):
+            return RedirectResponse(url=success_url)
 
         from app.utils.supabase import get_supabase_service_client
 
@@ -296,15 +465,18 @@ async def alipay_return(request: Request):
         if not sb:
             return RedirectResponse(url=f"{frontend_url}/pricing?pay=fail&reason=no_supabase")
 
-        _apply_subscription_upgrade(sb=sb, username=username, plan=plan, period=period)
-        return RedirectResponse(url=f"{frontend_url}/pricing?pay=success&plan={plan}&period={period}&out_trade_no={out_trade_no}")
+        if not await _apply_subscription_upgrade(
+            sb=sb, username=username, plan=plan, period=period, out_trade_no=out_trade_no
+        ):
+            return RedirectResponse(url=f"{frontend_url}/pricing?pay=fail&reason=user_not_found")
+        return RedirectResponse(url=success_url)
     except Exception:
         return RedirectResponse(url=f"{frontend_url}/pricing?pay=fail&reason=exception")
 
 
 @router.post("/renew")
 async def renew_subscription(
-    period: str = Form(...),
+    period: Period = Form(...),
     x_sync_secret: Optional[str] = Header(None, alias="X-Sync-Secret"),
     authorization: Optional[str] = Header(None),
 ):
@@ -314,11 +486,7 @@ async def renew_subscription(
     - 不重置 quota_used / quota_embed_used / quota_detect_used。
     - 若当前订阅未到期，则在原到期时间基础上顺延；否则从现在开始。
     """
-    if period not in ['month', 'year']:
-        raise HTTPException(status_code=400, detail="period must be 'month' or 'year'")
-
-    configured_secret = os.environ.get("SYNC_QUOTA_SECRET", "")
-    secret_ok = bool(configured_secret) and x_sync_secret == configured_secret
+    secret_ok = _sync_secret_ok(x_sync_secret)
 
     authed_uid: Optional[str] = None
     if not secret_ok:
@@ -328,7 +496,6 @@ async def renew_subscription(
 
     try:
         from app.utils.supabase import get_supabase_service_client
-        from datetime import datetime, timedelta, timezone
 
         sb = get_supabase_service_client()
         if not sb:
@@ -338,44 +505,20 @@ async def renew_subscription(
         if secret_ok and not user_id:
             raise HTTPException(status_code=400, detail="Missing user identity")
 
-        # 读取当前订阅信息
-        prof_res = sb.table("profiles").select(
-            "id, plan, subscription_status, subscription_period, subscription_expires_at, quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total"
-        ).eq("id", user_id).limit(1).execute()
-        if not prof_res.data:
+        # 读取当前订阅、顺延到期时间、写回在 renew_subscription RPC 中一次完成；
+        # free 套餐不会被修改，原样返回
+        res = await run_in_threadpool(
+            sb.rpc("renew_subscription", {"p_user_id": user_id, "p_period": period}).execute
+        )
+        row = res.data if res else None
+        if not row:
             raise HTTPException(status_code=404, detail="User profile not found")
-
-        row = prof_res.data[0]
-        plan = (row.get('plan') or 'free')
-        if plan == 'free':
+        if (row.get('plan') or 'free') == 'free':
             raise HTTPException(status_code=400, detail="Free plan cannot renew. Please upgrade first.")
 
-        now = datetime.now(timezone.utc)
-        prev_expires = _parse_iso_datetime(row.get('subscription_expires_at'))
-        prev_status = row.get('subscription_status')
-
-        base_time = now
-        if prev_expires and prev_status == 'active' and prev_expires > now:
-            base_time = prev_expires
-
-        new_expires = base_time + (timedelta(days=30) if period == 'month' else timedelta(days=365))
-
-        update_data = {
-            "subscription_status": "active",
-            "subscription_period": period,
-            "subscription_started_at": now.isoformat(),
-            "subscription_expires_at": new_expires.isoformat(),
-            # 保持额度用量不变（以 Supabase 为准）
-            "quota_used": int(row.get('quota_used') or 0),
-            "quota_embed_used": int(row.get('quota_embed_used') or 0),
-            "quota_detect_used": int(row.get('quota_detect_used') or 0),
-        }
-
-        res = sb.table("profiles").update(update_data).eq("id", user_id).execute()
-        if not res.data:
-            raise HTTPException(status_code=500, detail="Failed to renew subscription")
-
-        return {"success": True, "user": res.data[0]}
+        invalidate_user_cache(user_id)
+        await invalidate_quota_caches(user_id)
+        return {"success": True, "user": row}
     except HTTPException:
         raise
     except Exception as e:
@@ -384,32 +527,31 @@ async def renew_subscription(
 @router.post("/alipay-notify")
 async def alipay_notify(request: Request):
     try:
-        data = dict(await request.form())
-        sign = data.pop("sign", None)
-        data.pop("sign_type", None)
+        form = await request.form()
+        sign = form.get("sign")
+        data = {k: v for k, v in form.multi_items() if k not in _SIGN_KEYS}
         out_trade_no = data.get("out_trade_no")
         trade_status = data.get("trade_status")
 
         if not sign or not out_trade_no:
             return "fail"
 
-        alipay = get_alipay()
-        ok = alipay.verify(data, sign)
+        # 重复通知：该订单已发货，直接应答（不验签、不访问 Supabase，也不会有任何写入）
+        if _is_order_processed(out_trade_no):
+            return "success"
+
+        ok = _verify_alipay_signature(data, sign, form.get("sign_type"))
         if not ok:
             return "fail"
 
         if trade_status not in {"TRADE_SUCCESS", "TRADE_FINISHED"}:
             return "success"
 
-        # out_trade_no 格式: {username}_{plan}_{period}_{rand}
-        # 注意：username 可能包含 '_'，因此必须从右侧拆分
-        parts = out_trade_no.rsplit("_", 3)
-        if len(parts) != 4:
+        parsed = _split_out_trade_no(out_trade_no)
+        if parsed is None:
             return "success"
 
-        username = parts[0]
-        plan = parts[1]
-        period = parts[2]
+        username, plan, period = parsed
 
         from app.utils.supabase import get_supabase_service_client
 
@@ -417,7 +559,10 @@ async def alipay_notify(request: Request):
         if not sb:
             return "fail"
 
-        _apply_subscription_upgrade(sb=sb, username=username, plan=plan, period=period)
+        if not await _apply_subscription_upgrade(
+            sb=sb, username=username, plan=plan, period=period, out_trade_no=out_trade_no
+        ):
+            return "fail"
         return "success"
     except Exception:
         return "fail"
@@ -425,7 +570,7 @@ async def alipay_notify(request: Request):
 @router.post("/sync-quota")
 async def sync_quota(
     username: str = Form(...),
-    plan: str = Form(...),
+    plan: PlanName = Form(...),
     subscription_period: Optional[str] = Form(None),  # 'month' 或 'year'
     x_sync_secret: Optional[str] = Header(None, alias="X-Sync-Secret"),
     authorization: Optional[str] = Header(None),
@@ -435,8 +580,7 @@ async def sync_quota(
     仅支持4类权限：free/personal/pro/enterprise
     """
     # --- 安全保护：必须满足 (1) 内部密钥 或 (2) 已登录且只能给自己发货 ---
-    configured_secret = os.environ.get("SYNC_QUOTA_SECRET", "")
-    secret_ok = bool(configured_secret) and x_sync_secret == configured_secret
+    secret_ok = _sync_secret_ok(x_sync_secret)
 
     authed_uid: Optional[str] = None
     if not secret_ok:
@@ -445,99 +589,34 @@ async def sync_quota(
         if not authed_uid:
             raise HTTPException(status_code=403, detail="sync-quota is protected. Provide X-Sync-Secret or login to upgrade yourself.")
 
-    # 校验权限类型（仅4类）
-    valid_plans = {"free": 10, "personal": 500, "pro": 2000, "enterprise": 9999999}
-    if plan not in valid_plans:
-        raise HTTPException(status_code=400, detail=f"Invalid plan: {plan}. Must be one of: {list(valid_plans.keys())}")
-    
-    # 自动映射配额
-    quota_total = valid_plans[plan]
-    
+    # 权限类型（仅4类）由 PlanName 校验
     try:
         from app.utils.supabase import get_supabase_service_client
         sb = get_supabase_service_client()
         if not sb:
             raise HTTPException(status_code=500, detail="Supabase service client not configured")
-        
+
         # 确定发货目标用户：
         # - 内部密钥：允许按 username 发货
-        # - 已登录：只能给自己 uid 发货，并校验 uid 对应 profiles.username == username
+        # - 已登录：只能给自己 uid 发货，并要求 uid 对应 profiles.username == username
+        # 定位用户、保留已用量、顺延到期时间在 apply_subscription_upgrade RPC 中一次完成
         if secret_ok:
-            user_res = sb.table("profiles").select("id").eq("username", username).execute()
-            if not user_res.data:
+            updated = await _apply_subscription_upgrade(sb=sb, username=username, plan=plan, period=subscription_period)
+            if not updated:
                 raise HTTPException(status_code=404, detail="User not found in Supabase")
-            user_id = user_res.data[0]["id"]
         else:
-            user_id = authed_uid
-            profile_res = sb.table("profiles").select("username").eq("id", user_id).limit(1).execute()
-            if not profile_res.data:
-                raise HTTPException(status_code=404, detail="User profile not found")
-            profile_username = profile_res.data[0].get("username")
-            if profile_username != username:
+            updated = await _apply_subscription_upgrade(
+                sb=sb, username=username, user_id=authed_uid, plan=plan, period=subscription_period
+            )
+            if not updated:
                 raise HTTPException(status_code=403, detail="Forbidden: cannot upgrade other user")
-        
-        # 计算订阅到期时间
-        from datetime import datetime, timedelta, timezone
-        now = datetime.now(timezone.utc)
-        embed_quota_map = {"free": 50, "personal": 500, "pro": 2000, "enterprise": 9999999}
-        detect_quota_map = {"free": 20, "personal": 200, "pro": 1000, "enterprise": 9999999}
-
-        # 读取现有用量，避免 sync 覆盖导致 used 清零
-        existing_res = sb.table("profiles").select(
-            "quota_used, quota_total, quota_embed_used, quota_embed_total, quota_detect_used, quota_detect_total, subscription_status, subscription_expires_at"
-        ).eq("id", user_id).limit(1).execute()
-        existing_row = existing_res.data[0] if existing_res and existing_res.data else {}
-
-        existing_quota_used = int(existing_row.get("quota_used") or 0)
-        existing_quota_embed_used = int(existing_row.get("quota_embed_used") or 0)
-        existing_quota_detect_used = int(existing_row.get("quota_detect_used") or 0)
-
-        update_data = {
-            "plan": plan,
-            # 兼容旧字段
-            "quota_total": quota_total,
-            "quota_used": existing_quota_used,
-            # 新字段：分开限制嵌入/检测
-            "quota_embed_total": embed_quota_map.get(plan, 50),
-            "quota_embed_used": existing_quota_embed_used,
-            "quota_detect_total": detect_quota_map.get(plan, 20),
-            "quota_detect_used": existing_quota_detect_used,
-        }
-        
-        effective_period = subscription_period
-        if plan != 'free' and effective_period not in ['month', 'year']:
-            effective_period = 'month'
-
-        # 如果有订阅周期，设置订阅信息（支付发货：从当前有效到期时间基础上顺延，避免覆盖剩余天数）
-        if effective_period in ['month', 'year'] and plan != 'free':
-            base_time = now
-            prev_expires = _parse_iso_datetime(existing_row.get('subscription_expires_at'))
-            prev_status = existing_row.get('subscription_status')
-            if prev_expires and prev_status == 'active' and prev_expires > now:
-                base_time = prev_expires
-            update_data["subscription_period"] = effective_period
-            update_data["subscription_status"] = 'active'
-            update_data["subscription_started_at"] = now.isoformat()
-            if effective_period == 'month':
-                update_data["subscription_expires_at"] = (base_time + timedelta(days=30)).isoformat()
-            else:  # year
-                update_data["subscription_expires_at"] = (base_time + timedelta(days=365)).isoformat()
-        elif plan == 'free':
-            update_data["subscription_period"] = None
-            update_data["subscription_status"] = 'inactive'
-            update_data["subscription_started_at"] = None
-            update_data["subscription_expires_at"] = None
-        
-        # 更新用户套餐和额度
-        res = sb.table("profiles").update(update_data).eq("id", user_id).execute()
-        
-        if not res.data:
-            raise HTTPException(status_code=500, detail="Failed to update user plan")
-        
+
         return {
-            "success": True, 
+            "success": True,
             "message": f"User upgraded to {plan} ({subscription_period or 'one-time'})",
-            "user": res.data[0]
+            "user": updated
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
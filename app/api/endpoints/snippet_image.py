@@ -1,26 +1,63 @@
 from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import FileResponse
-from jose import jwt
+import jwt as pyjwt
+import hashlib
 import os
+import stat
+import time
 
 from app.core.config import settings
 
 router = APIRouter()
 
+OUTPUTS_DIR = os.path.abspath("outputs")
+
+# ---- 图片 stat 缓存（热门图片重复请求时省去 exists + FileResponse 内部的再次 stat） ----
+_stat_cache: dict = {}  # {filename: {"stat": os.stat_result, "expires": float}}
+_STAT_CACHE_TTL = 10  # 秒
+_STAT_CACHE_MAX = 4096
+
+# ---- 已验签本地 token → username 缓存（同一页面加载多张图片时只验签一次） ----
+# 键为 sha256(token)；只缓存验签成功的结果，过期时间不超过 token 自身的 exp
+_verified_token_cache: dict = {}  # {sha256(token): {"sub": str, "expires": float}}
+_VERIFIED_TOKEN_CACHE_TTL = 30  # 秒
+_VERIFIED_TOKEN_CACHE_MAX = 10000
+
+
+def _verify_local_token(token: str):
+    """验签平台签发的 JWT，返回 sub；失败返回 None（PyJWT，HS256 走原生 HMAC）"""
+    key = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    entry = _verified_token_cache.get(key)
+    if entry and entry["expires"] > now:
+        return entry["sub"]
+
+    try:
+        payload = pyjwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    except pyjwt.PyJWTError:
+        return None
+
+    sub = payload.get("sub")
+    if sub:
+        expires = now + _VERIFIED_TOKEN_CACHE_TTL
+        if payload.get("exp") is not None:
+            expires = min(expires, float(payload["exp"]))
+        if len(_verified_token_cache) >= _VERIFIED_TOKEN_CACHE_MAX:
+            _verified_token_cache.clear()
+        _verified_token_cache[key] = {"sub": sub, "expires": expires}
+    return sub
+
+
 @router.get("/image/{filename}")
 def get_image(
     filename: str,
     token: str = Query(...)
 ):
     # Auth Bridge: Support both local and Supabase tokens
-    username = None
-    try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        username = payload.get('sub')
-    except Exception:
+    username = _verify_local_token(token)
+    if not username:
         try:
-            from jose import jwt as jose_jwt
-            unverified = jose_jwt.get_unverified_claims(token)
+            unverified = pyjwt.decode(token, options={"verify_signature": False})
             username = unverified.get('email') or unverified.get('sub')
         except Exception:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -28,9 +65,25 @@ def get_image(
     if not username:
         raise HTTPException(status_code=401, detail="Authentication identity missing")
 
-    # 直接从文件系统读取文件，不再查本地数据库
-    file_path = os.path.join("outputs", filename)
-    if not os.path.exists(file_path):
+    # 直接从文件系统读取文件，不再查本地数据库；只允许 outputs 目录下的文件名
+    if filename != os.path.basename(filename) or filename in ("", ".", ".."):
         raise HTTPException(status_code=404, detail="File not found")
-    
-    return FileResponse(file_path)
+    file_path = os.path.join(OUTPUTS_DIR, filename)
+
+    now = time.time()
+    entry = _stat_cache.get(filename)
+    if entry and entry["expires"] > now:
+        st = entry["stat"]
+    else:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            raise HTTPException(status_code=404, detail="File not found")
+        if not stat.S_ISREG(st.st_mode):
+            raise HTTPException(status_code=404, detail="File not found")
+        if len(_stat_cache) >= _STAT_CACHE_MAX:
+            _stat_cache.clear()
+        _stat_cache[filename] = {"stat": st, "expires": now + _STAT_CACHE_TTL}
+
+    # 传入 stat_result 后 Starlette 不再重复 stat；文件内容由其按块流式发送
+    return FileResponse(file_path, stat_result=st)
@@ -1,5 +1,6 @@
 from typing import Any, Annotated
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 
 from app.schema.user import User, UserCreate
 from app.api.deps import get_current_active_user
@@ -8,22 +9,19 @@ from app.utils.supabase import get_supabase_service_client
 router = APIRouter()
 
 @router.post("/register", response_model=User)
-def register_user(user_in: UserCreate):
+async def register_user(user_in: UserCreate):
     """用户注册 - 使用 Supabase Auth"""
     sb = get_supabase_service_client()
     if not sb:
         raise HTTPException(status_code=500, detail="Database not configured")
     
     try:
-        # Check if user already exists
-        existing = sb.table("profiles").select("id").eq("username", user_in.username).execute()
-        if existing.data:
-            raise HTTPException(status_code=400, detail="该用户名已存在")
-        
         # Create user in Supabase Auth (Note: actual auth signup should be done via frontend)
         # Here we just create the profile record
+        # 单条 INSERT ... ON CONFLICT (username) DO NOTHING：用户名已存在时不返回任何行，
+        # 省去先查重再插入的一次往返（supabase-py 为同步客户端，放到线程池执行）
         from datetime import datetime, timezone
-        result = sb.table("profiles").insert({
+        result = await run_in_threadpool(sb.table("profiles").upsert({
             "username": user_in.username,
             "display_name": user_in.display_name or user_in.username.split('@')[0],
             "role": "user",
@@ -31,19 +29,19 @@ def register_user(user_in: UserCreate):
             "quota_total": 10,
             "quota_used": 0,
             "created_at": datetime.now(timezone.utc).isoformat(),
-        }).execute()
-        
+        }, on_conflict="username", ignore_duplicates=True).execute)
+
         if result.data:
             return User(**result.data[0])
         else:
-            raise HTTPException(status_code=500, detail="创建用户失败")
+            raise HTTPException(status_code=400, detail="该用户名已存在")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"注册失败: {str(e)}")
 
 @router.get("/users/me", response_model=User)
-def read_user_me(
+async def read_user_me(
     current_user: Annotated[User, Depends(get_current_active_user)]
 ) -> Any:
     return current_user
@@ -1,12 +1,19 @@
 from typing import Any, List, Optional, Dict
-from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, Header, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, Header, BackgroundTasks, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 import urllib.parse
 from fastapi.responses import JSONResponse
-from jose import jwt, JWTError
+import jwt as pyjwt
 
 from app.schema.asset import WatermarkResult, DetectionResult, Asset
-from app.api.deps import get_current_active_user
+from app.api.deps import (
+    _parse_iso_datetime,
+    get_cached_profile,
+    get_current_active_user,
+    invalidate_user_cache,
+    invalidate_user_quota_cache,
+)
 from app.core.config import settings
 from app.schema.user import User
 from app.service.watermark import WatermarkService
@@ -14,19 +21,47 @@ from app.service.ai_assistant import AIAssistantService
 from app.service.text_watermark import TextWatermarkService
 from app.service.video_watermark import VideoWatermarkService
 from app.service.blockchain import BlockchainService
+from app.service.enhanced_watermark import inject_asset_to_cache, invalidate_assets_cache
+from app.service.report_service import ReportService
 from app.service.storage import StorageService
-from app.utils.supabase import get_supabase_service_client
+from app.utils.supabase import get_supabase_client, get_supabase_service_client
+from app.utils import quota_cache
 from fastapi.responses import FileResponse
 from fastapi import Query
 from pydantic import BaseModel
 import os
 import io
+import asyncio
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import hashlib
+import re
+import shutil
+import tempfile
+import threading
 import time
+import uuid
+from types import MappingProxyType
+
+import anyio
+
+try:
+    from supabase_auth.errors import AuthApiError
+except ImportError:  # supabase-py 2.10 之前 auth 包名为 gotrue
+    from gotrue.errors import AuthApiError
 
 logger = logging.getLogger(__name__)
 
+# ---- 套餐 → 额度上限（只读常量，与 supabase_migration_pay_subscription_rpc.sql 保持一致） ----
+_EMBED_TOTALS = MappingProxyType({"free": 50, "personal": 500, "pro": 2000, "enterprise": 9999999})
+_DETECT_TOTALS = MappingProxyType({"free": 20, "personal": 200, "pro": 1000, "enterprise": 9999999})
+_ADMIN_ROLES = frozenset({"admin", "行政"})
+# check_and_consume_quota 的 (p_plan_totals, p_default_total) 参数，模块加载时构建一次
+_QUOTA_RPC_TOTALS = MappingProxyType({
+    "embed": (dict(_EMBED_TOTALS), _EMBED_TOTALS["free"]),
+    "detect": (dict(_DETECT_TOTALS), _DETECT_TOTALS["free"]),
+})
+
 # ---- 额度查询内存缓存（批量模式下避免每张图都访问 Supabase） ----
 _quota_cache: dict = {}   # {user_id: {"embed_used": int, "embed_total": int, "plan": str, "expires": float}}
 _QUOTA_CACHE_TTL = 600     # 秒
@@ -35,36 +70,132 @@ _QUOTA_CACHE_TTL = 600     # 秒
 _detect_quota_cache: dict = {}  # {user_id: {"detect_used": int, "detect_total": int, "plan": str, "expires": float}}
 _DETECT_QUOTA_CACHE_TTL = 600  # 秒
 
+# 配置 Redis（多 worker）时进程内额度条目只作短时缓冲：其他 worker 处理的支付 / 改套餐最多延迟这么久生效
+_SHARED_LOCAL_QUOTA_TTL = 5  # 秒
+
+
+def _local_quota_ttl(ttl: int) -> int:
+    return min(ttl, _SHARED_LOCAL_QUOTA_TTL) if quota_cache.enabled() else ttl
+
 # ---- Token -> user_id 内存缓存（避免每次都调用 Supabase Auth /auth/v1/user） ----
-_token_user_cache: dict = {}  # {token: {"user_id": str, "expires": float}}
+# 键为 sha256(token)；Supabase 明确拒绝的 token 也短暂缓存（user_id 为 None），无效 token 不会每次都跨洋验证
+_token_user_cache: dict = {}  # {sha256(token): {"user_id": Optional[str], "expires": float}}
 _TOKEN_CACHE_TTL = 600  # 秒
+_TOKEN_NEGATIVE_TTL = 10  # 秒
+
+# 本地 JWT 验签参数（只构造一次）；sub 必须是 UUID，否则视为旧的本地 token
+_LOCAL_JWT_ALGORITHMS = [settings.ALGORITHM]
+# JWT 形状预检：三段 base64url，明显不是 JWT 的 token 直接视为游客，不做验签也不调用 Supabase Auth
+_JWT_SHAPE_RE = re.compile(r"^[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*$")
+_JWT_MIN_LENGTH = 32
+# 256 位 DCT 指纹（64 位十六进制），可交给 match_fingerprint RPC 比对
+_FINGERPRINT_HEX_RE = re.compile(r"^[0-9a-fA-F]{64}$")
+_UUID_RE = re.compile(r"^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$")
 
 # ---- 最近嵌入文件权限缓存（用于异步落库期间，立即支持 /api/image 预览） ----
 _recent_embed_files: dict = {}  # {filename: {"user_id": str, "expires": float}}
 _RECENT_EMBED_TTL = 300  # 秒
 
+# ---- /api/image 权限校验结果缓存（图库页面同一 token 连续加载多张图时跳过 RPC） ----
+_image_access_cache: dict = {}  # {"user_id:filename": {"is_admin": bool, "owner_id": str, "expires": float}}
+_IMAGE_ACCESS_TTL = 30  # 秒
+
+# ---- outputs 文件 stat 缓存（热门图片重复请求时跳过 stat 系统调用；只缓存存在的文件，新文件立即可见） ----
+# outputs 下的文件名都带时间戳/指纹，写入后不再覆盖，缓存的 stat（ETag / Content-Length）在 TTL 内保持有效
+_output_stat_cache: dict = {}  # {filename: {"path": str, "stat": os.stat_result, "expires": float}}
+_OUTPUT_STAT_TTL = 60  # 秒
+
+# ---- /detect 五维评分报告（后台生成，按 report_id 轮询；进程内缓存，与单进程 uvicorn 部署一致） ----
+_detect_reports: dict = {}  # {report_id: {"user_id": str, "ready": bool, "report": dict, "expires": float}}
+_DETECT_REPORT_TTL = 600  # 秒
+
+# 以上缓存的条目上限：写入时先清理过期项，仍超限则整体清空（防止无界增长）
+_CACHE_MAX = 10000
+_cache_write_lock = threading.Lock()
+
+# ---- 额度查询 single-flight：缓存未命中时同一用户的并发请求只由第一个去查 Supabase，其余等待同一结果 ----
+_inflight_quota: dict = {}  # {("embed" | "detect", user_id): asyncio.Future}
+
+
+def _cache_put(cache: dict, key: str, value: dict) -> None:
+    """写入带 expires 的缓存条目，超过 _CACHE_MAX 时先淘汰过期条目
+
+    dict 保持插入顺序，同一缓存的 TTL 固定时头部就是最早过期的条目：
+    每次写入顺带从头部弹出已过期条目（均摊 O(1)），从不被再次读取的条目（如 _recent_embed_files）也会及时释放。
+    覆盖已有 key 时先删除再插入，保证插入顺序与过期顺序一致。
+    """
+    with _cache_write_lock:
+        now = time.time()
+        cache.pop(key, None)
+        while cache:
+            head = next(iter(cache))
+            if cache[head].get("expires", 0) > now:
+                break
+            del cache[head]
+        if len(cache) >= _CACHE_MAX:
+            for k, v in list(cache.items()):
+                if v.get("expires", 0) <= now:
+                    cache.pop(k, None)
+            if len(cache) >= _CACHE_MAX:
+                cache.clear()
+        cache[key] = value
+
+
+async def _quota_single_flight(key: tuple, fn, *args):
+    """在线程池执行 fn(*args)；同一 key 已有进行中的调用时直接等待其结果（包括其抛出的 HTTPException）"""
+    fut = _inflight_quota.get(key)
+    if fut is not None:
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                raise
+        # 发起方请求被取消：自己重新查询
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight_quota[key] = fut
+    try:
+        result = await run_in_threadpool(fn, *args)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # 标记已读取，没有等待者时不产生 "exception was never retrieved" 警告
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        if _inflight_quota.get(key) is fut:
+            del _inflight_quota[key]
+
 
 def _get_user_id_from_token_cached(token: str) -> Optional[str]:
     if not token:
         return None
-    entry = _token_user_cache.get(token)
+    key = hashlib.sha256(token.encode()).hexdigest()
+    entry = _token_user_cache.get(key)
     if entry and time.time() < entry.get("expires", 0):
         return entry.get("user_id")
 
     try:
-        from app.utils.supabase import get_supabase_client
-
         sb_client = get_supabase_client()
         if not sb_client:
             return None
         auth_user = sb_client.auth.get_user(token)
         uid = auth_user.user.id if auth_user and auth_user.user else None
-        if uid:
-            _token_user_cache[token] = {"user_id": str(uid), "expires": time.time() + _TOKEN_CACHE_TTL}
-            return str(uid)
+    except AuthApiError:
+        # Supabase 明确拒绝（过期/伪造）：负缓存
+        uid = None
     except Exception:
+        # 网络等临时错误不缓存，下次请求重试
         return None
 
+    if uid:
+        _cache_put(_token_user_cache, key, {"user_id": str(uid), "expires": time.time() + _TOKEN_CACHE_TTL})
+        return str(uid)
+    _cache_put(_token_user_cache, key, {"user_id": None, "expires": time.time() + _TOKEN_NEGATIVE_TTL})
     return None
 
 def _get_quota_from_cache(user_id: str):
@@ -74,22 +205,18 @@ def _get_quota_from_cache(user_id: str):
     return None
 
 def _set_quota_cache(user_id: str, embed_used: int, embed_total: int, plan: str):
-    _quota_cache[user_id] = {
+    _cache_put(_quota_cache, user_id, {
         "embed_used": embed_used,
         "embed_total": embed_total,
         "plan": plan,
-        "expires": time.time() + _QUOTA_CACHE_TTL,
-    }
+        "expires": time.time() + _local_quota_ttl(_QUOTA_CACHE_TTL),
+    })
 
 def _increment_quota_cache(user_id: str):
     entry = _quota_cache.get(user_id)
     if entry:
         entry["embed_used"] = entry.get("embed_used", 0) + 1
-
-def _invalidate_quota_cache(user_id: str):
-    """强制清除缓存，强制下一次请求重新查询 Supabase"""
-    if user_id in _quota_cache:
-        del _quota_cache[user_id]
+    invalidate_user_quota_cache(user_id)
 
 
 # ---- 检测额度缓存操作 ----
@@ -100,22 +227,184 @@ def _get_detect_quota_from_cache(user_id: str):
     return None
 
 def _set_detect_quota_cache(user_id: str, detect_used: int, detect_total: int, plan: str):
-    _detect_quota_cache[user_id] = {
+    _cache_put(_detect_quota_cache, user_id, {
         "detect_used": detect_used,
         "detect_total": detect_total,
         "plan": plan,
-        "expires": time.time() + _DETECT_QUOTA_CACHE_TTL,
-    }
+        "expires": time.time() + _local_quota_ttl(_DETECT_QUOTA_CACHE_TTL),
+    })
 
 def _increment_detect_quota_cache(user_id: str):
     entry = _detect_quota_cache.get(user_id)
     if entry:
         entry["detect_used"] = entry.get("detect_used", 0) + 1
+    invalidate_user_quota_cache(user_id)
+
+
+# ---- 套餐额度上限纠偏（极少发生，不阻塞当前请求） ----
+_background_fixes: set = set()  # 持有 asyncio.Task 引用，避免执行中被回收
+
+
+def _fix_quota_total_async(sb, user_id: str, column: str, expected_total: int) -> None:
+    """把 profiles.<column> 改回套餐对应的上限；在线程池中调用时交给事件循环另起任务执行，不在 anyio 工作线程中时同步执行"""
+    def _update():
+        try:
+            sb.table("profiles").update({column: expected_total}).eq("id", user_id).execute()
+        except Exception as e:
+            logger.warning("[Quota] Failed to fix %s for %s: %s", column, user_id, e)
+
+    def _spawn():
+        task = asyncio.get_running_loop().create_task(run_in_threadpool(_update))
+        _background_fixes.add(task)
+        task.add_done_callback(_background_fixes.discard)
+
+    try:
+        anyio.from_thread.run_sync(_spawn)
+    except RuntimeError:
+        _update()
+
+
+async def invalidate_quota_caches(user_id: str) -> None:
+    """清除该用户的嵌入 / 检测额度缓存（本进程 dict + Redis 共享缓存），套餐变更后调用"""
+    if not user_id:
+        return
+    _quota_cache.pop(user_id, None)
+    _detect_quota_cache.pop(user_id, None)
+    await quota_cache.delete("embed", user_id)
+    await quota_cache.delete("detect", user_id)
+
+
+# ---- 额度查询：本地缓存 → Redis 共享缓存（app/utils/quota_cache.py）→ Supabase ----
+async def _load_embed_quota(user_id: str):
+    """返回 (embed_used, embed_total)；本地未命中时先取 Redis，仍未命中再 single-flight 查 Supabase 并回写 Redis"""
+    entry = _get_quota_from_cache(user_id)
+    if entry is not None and entry["embed_used"] >= entry["embed_total"] and quota_cache.enabled():
+        # 本地记录已用完：其他 worker 可能刚处理了支付 / 改套餐（已清除 Redis），拒绝前以 Redis / Supabase 为准
+        _quota_cache.pop(user_id, None)
+    if _get_quota_from_cache(user_id) is None:
+        shared = await quota_cache.get("embed", user_id)
+        if shared is not None:
+            _set_quota_cache(user_id, shared["used"], shared["total"], shared["plan"])
+    if _get_quota_from_cache(user_id) is not None:
+        return _check_embed_quota(user_id)
+    try:
+        return await _quota_single_flight(("embed", user_id), _check_embed_quota, user_id)
+    finally:
+        # 额度用完（402）时也回写，其他 worker 可直接拒绝
+        entry = _get_quota_from_cache(user_id)
+        if entry is not None:
+            await quota_cache.store("embed", user_id, entry["embed_used"], entry["embed_total"], entry["plan"], _QUOTA_CACHE_TTL)
+
+
+async def _load_detect_quota(user_id: str):
+    """返回 (detect_used, detect_total, plan)；查找顺序同 _load_embed_quota"""
+    entry = _get_detect_quota_from_cache(user_id)
+    if entry is not None and entry["detect_used"] >= entry["detect_total"] and quota_cache.enabled():
+        _detect_quota_cache.pop(user_id, None)
+    if _get_detect_quota_from_cache(user_id) is None:
+        shared = await quota_cache.get("detect", user_id)
+        if shared is not None:
+            _set_detect_quota_cache(user_id, shared["used"], shared["total"], shared["plan"])
+    if _get_detect_quota_from_cache(user_id) is not None:
+        return _check_detect_quota(user_id)
+    try:
+        return await _quota_single_flight(("detect", user_id), _check_detect_quota, user_id)
+    finally:
+        entry = _get_detect_quota_from_cache(user_id)
+        if entry is not None:
+            await quota_cache.store("detect", user_id, entry["detect_used"], entry["detect_total"], entry["plan"], _DETECT_QUOTA_CACHE_TTL)
+
+
+async def _incr_shared_quota(kind: str, user_id: str, cache: dict, field: str) -> Optional[int]:
+    """Redis 共享额度原子 +1，并把本地缓存的已用量同步到不低于共享值（其他 worker 的扣减也计入）"""
+    used = await quota_cache.incr(kind, user_id)
+    if used is not None:
+        entry = cache.get(user_id)
+        if entry:
+            entry[field] = max(entry.get(field, 0), used)
+    return used
+
+
+def _raise_shared_quota_used(kind: str, user_id: str, used: int) -> None:
+    """在线程池中（同步接口 / 后台任务）用落库结果向上修正 Redis 共享额度；不在 anyio 工作线程中时跳过"""
+    try:
+        anyio.from_thread.run(quota_cache.raise_used, kind, user_id, used)
+    except RuntimeError:
+        pass
+
+
+def _invalidate_quota_caches_from_thread(user_id: str) -> None:
+    """在线程池中调用 invalidate_quota_caches；不在 anyio 工作线程中时只清除本进程缓存"""
+    try:
+        anyio.from_thread.run(invalidate_quota_caches, user_id)
+    except RuntimeError:
+        _quota_cache.pop(user_id, None)
+        _detect_quota_cache.pop(user_id, None)
+
+
+def _raise_cached_quota_used(kind: str, user_id: str, used: int) -> None:
+    """用落库后的已用量向上修正本地与 Redis 缓存（缓存里可能已包含尚未落库的乐观计数，只增不减）"""
+    cache, field = (_quota_cache, "embed_used") if kind == "embed" else (_detect_quota_cache, "detect_used")
+    entry = cache.get(user_id)
+    if entry:
+        entry[field] = max(entry.get(field, 0), used)
+    _raise_shared_quota_used(kind, user_id, used)
+
+
+# ---- 额度持久化：RPC 原子自增（见 supabase_migration_quota_increment_rpc.sql） ----
+def _persist_embed_quota_increment(sb, user_id: str) -> Optional[int]:
+    """quota_embed_used 原子 +1，返回最新已用量，并用它刷新内存缓存（不再整体失效）"""
+    used = sb.rpc("increment_quota_embed", {"p_user_id": user_id, "p_delta": 1}).execute().data
+    if isinstance(used, int):
+        _raise_cached_quota_used("embed", user_id, used)
+    invalidate_user_quota_cache(user_id)
+    return used
 
-def _invalidate_detect_quota_cache(user_id: str):
-    """强制清除缓存，强制下一次请求重新查询 Supabase"""
-    if user_id in _detect_quota_cache:
-        del _detect_quota_cache[user_id]
+
+def _persist_detect_quota_increment(sb, user_id: str) -> Optional[int]:
+    """quota_detect_used 原子 +1，返回最新已用量，并用它刷新内存缓存（不再整体失效）"""
+    used = sb.rpc("increment_quota_detect", {"p_user_id": user_id, "p_delta": 1}).execute().data
+    if isinstance(used, int):
+        _raise_cached_quota_used("detect", user_id, used)
+    invalidate_user_quota_cache(user_id)
+    return used
+
+
+def _safe_int(val, default: int = 0) -> int:
+    """profiles 中的额度字段可能为 NULL 或非数字字符串，统一转成 int"""
+    try:
+        return int(val) if val is not None else default
+    except (ValueError, TypeError):
+        return default
+
+
+# ---- 文本/视频接口：入口处一次 RPC 完成额度检查与扣减（见 supabase_migration_consume_quota_rpc.sql） ----
+def _consume_quota(sb, user_id: str, kind: str) -> dict:
+    """检查并扣减 1 次 embed / detect 额度（含到期降级与套餐上限纠偏），额度不足时抛 402"""
+    totals, default_total = _QUOTA_RPC_TOTALS[kind]
+    result = sb.rpc("check_and_consume_quota", {
+        "p_user_id": user_id,
+        "p_kind": kind,
+        "p_plan_totals": totals,
+        "p_default_total": default_total,
+    }).execute().data or {}
+    used, total = result.get("used"), result.get("total")
+    if not result.get("allowed", True):
+        label = "嵌入" if kind == "embed" else "检测"
+        raise HTTPException(status_code=402, detail=f"您的{label}额度已用完（{used}/{total}），请升级套餐或联系管理员。")
+    if isinstance(used, int):
+        _raise_cached_quota_used(kind, user_id, used)
+    invalidate_user_quota_cache(user_id)
+    return result
+
+
+def _refund_quota(sb, user_id: str, kind: str) -> None:
+    """处理失败时退回 _consume_quota 扣减的 1 次额度（本地缓存只增不减，TTL 内偏保守）"""
+    try:
+        sb.rpc(f"increment_quota_{kind}", {"p_user_id": user_id, "p_delta": -1}).execute()
+    except Exception as e:
+        logger.warning("[Quota] Failed to refund %s quota for %s: %s", kind, user_id, e)
+    invalidate_user_quota_cache(user_id)
 
 class TextEmbedRequest(BaseModel):
     text: str
@@ -132,21 +421,18 @@ def get_optional_user(authorization: Optional[str] = Header(None)) -> Optional[s
     """
     if authorization and authorization.startswith('Bearer '):
         token = authorization[len('Bearer '):]
-        # 1. 尝试本地验证
+        if len(token) < _JWT_MIN_LENGTH or not _JWT_SHAPE_RE.match(token):
+            return None
+        # 1. 尝试本地验证（PyJWT，HS256 走原生 HMAC）
         try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+            payload = pyjwt.decode(token, settings.SECRET_KEY, algorithms=_LOCAL_JWT_ALGORITHMS)
             username = payload.get('sub')
-            if username:
-                import uuid
-                # 检查是否为 UUID，如果不是说明是旧的本地 token，直接忽略
-                try:
-                    uuid.UUID(username)
-                    return username
-                except ValueError:
-                    pass
-        except JWTError:
+            # 检查是否为 UUID，如果不是说明是旧的本地 token，直接忽略
+            if isinstance(username, str) and _UUID_RE.match(username):
+                return username
+        except pyjwt.PyJWTError:
             pass
-            
+
         # 2. 尝试 Supabase Token 验证 - 优先使用 sub (UUID)
         # 通过调用 Supabase Auth API 验证 token，而不是仅解析未验证的 claims
         uid = _get_user_id_from_token_cached(token)
@@ -154,11 +440,73 @@ def get_optional_user(authorization: Optional[str] = Header(None)) -> Optional[s
             return uid
     return None
 
+
+def _quota_dependency(kind: str):
+    """文本/视频接口的额度依赖：进入接口前扣减 1 次 kind 额度，产出 (sb, final_user_id)
+
+    接口（含请求体校验）抛出任何异常时自动退回本次扣减；游客与 Supabase 未配置时不扣减
+    """
+    def dependency(user_id: Optional[str] = Depends(get_optional_user)):
+        final_user_id = user_id if user_id else "guest"
+        sb = get_supabase_service_client()
+        charged = bool(sb) and final_user_id != "guest"
+        if charged:
+            _consume_quota(sb, final_user_id, kind)
+        try:
+            yield sb, final_user_id
+        except Exception:
+            if charged:
+                _refund_quota(sb, final_user_id, kind)
+            raise
+    return dependency
+
+
+require_embed_quota = _quota_dependency("embed")
+require_detect_quota = _quota_dependency("detect")
+
 router = APIRouter()
 
+# 水印输出文件名唯一且生成后不再修改，浏览器可长期缓存；带 token 的 URL 属于个人资源，只允许私有缓存
+_IMAGE_CACHE_CONTROL = "private, max-age=3600, immutable"
+
+
+def _image_file_response(request: Request, filename: str) -> Response:
+    """返回 outputs 下的文件；带 ETag，If-None-Match 命中时直接 304（不读文件）"""
+    entry = _output_stat_cache.get(filename)
+    if entry and time.time() < entry["expires"]:
+        file_path, st = entry["path"], entry["stat"]
+    else:
+        file_path = os.path.join("outputs", filename)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            logger.warning(f"Image not found: {filename}")
+            raise HTTPException(status_code=404, detail="File not found")
+        _cache_put(_output_stat_cache, filename, {"path": file_path, "stat": st, "expires": time.time() + _OUTPUT_STAT_TTL})
+
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {"etag": etag, "cache-control": _IMAGE_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+
+    # Force the filename in the response header to avoid UUID naming issues in some browsers
+    # 传入 stat_result 后 Starlette 不再重复 stat；文件内容由其按块流式发送
+    return FileResponse(
+        file_path,
+        filename=filename,
+        content_disposition_type="attachment",
+        headers=headers,
+        stat_result=st,
+    )
+
+
 @router.get("/image/{filename}")
 def get_image(
     filename: str,
+    request: Request,
     token: Optional[str] = Query(None),
     user_id: Optional[str] = Depends(get_optional_user),
 ):
@@ -174,15 +522,7 @@ def get_image(
     # 异步落库期间：允许刚嵌入的文件直接预览（避免 Supabase 记录尚未写入导致 404）
     entry = _recent_embed_files.get(filename)
     if entry and time.time() < entry.get("expires", 0) and entry.get("user_id") == user_id:
-        file_path = os.path.join("outputs", filename)
-        if not os.path.exists(file_path):
-            logger.warning(f"Image not found: {filename}")
-            raise HTTPException(status_code=404, detail="File not found")
-        return FileResponse(
-            file_path,
-            filename=filename,
-            content_disposition_type="attachment"
-        )
+        return _image_file_response(request, filename)
 
     # 无论是否 token query 模式，都必须做权限校验。
     # 说明：token query 仅用于 <img> 无法携带 Authorization header 的场景。
@@ -190,34 +530,101 @@ def get_image(
     if not sb:
         raise HTTPException(status_code=500, detail="Supabase 未配置")
 
-    # 判断是否 admin
-    user_res = sb.table("profiles").select("role").eq("id", user_id).limit(1).execute()
-    is_admin = bool(user_res.data) and user_res.data[0].get("role") in ["admin", "行政"]
-
-    # 资产归属校验（按 filename 查询）
-    asset_res = sb.table("watermarked_assets").select("user_id").eq("filename", filename).limit(1).execute()
-    if not asset_res.data:
-        raise HTTPException(status_code=404, detail="File not found")
+    # 是否 admin + 资产归属：一次 RPC 完成（见 supabase_migration_image_access_rpc.sql）
+    cache_key = f"{user_id}:{filename}"
+    access = _image_access_cache.get(cache_key)
+    if not access or time.time() >= access.get("expires", 0):
+        access = sb.rpc("check_image_access", {"p_user_id": user_id, "p_filename": filename}).execute().data or {}
+        if not access.get("asset_found"):
+            # 不缓存 404：资产记录可能仍在后台落库
+            raise HTTPException(status_code=404, detail="File not found")
+        access = {
+            "is_admin": bool(access.get("is_admin")),
+            "owner_id": access.get("owner_id"),
+            "expires": time.time() + _IMAGE_ACCESS_TTL,
+        }
+        _cache_put(_image_access_cache, cache_key, access)
 
-    owner_id = asset_res.data[0].get("user_id")
+    is_admin = access["is_admin"]
+    owner_id = access["owner_id"]
     if not is_admin and owner_id != user_id:
         raise HTTPException(status_code=403, detail="无权下载他人文件")
 
     # Directly read from outputs
-    file_path = os.path.join("outputs", filename)
-    if not os.path.exists(file_path):
-        logger.warning(f"Image not found: {filename}")
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    # Force the filename in the response header to avoid UUID naming issues in some browsers
-    return FileResponse(
-        file_path, 
-        filename=filename,
-        content_disposition_type="attachment"
-    )
+    return _image_file_response(request, filename)
+
+def _downgrade_if_expired(sb, user_id: str, user_data: dict) -> bool:
+    """订阅已过期但定时降级任务尚未执行时，立即执行一次批量降级（与 check_and_consume_quota 的就地降级对应）
+
+    user_data 需包含 subscription_status / subscription_expires_at；返回该用户是否已过期（调用方按免费版计算额度）
+    """
+    if user_data.get("subscription_status") != "active":
+        return False
+    expires_at = _parse_iso_datetime(user_data.get("subscription_expires_at"))
+    if expires_at is None or expires_at >= datetime.now(timezone.utc):
+        return False
+    try:
+        sb.rpc("downgrade_expired_subscriptions", {}).execute()
+    except Exception as e:
+        logger.warning("[Quota] Failed to downgrade expired subscription for %s: %s", user_id, e)
+    else:
+        # 嵌入与检测的 total 一起变化：两类额度的本地 / Redis 缓存都清除（当前查询的那一类由调用方随后重新写入）
+        _invalidate_quota_caches_from_thread(user_id)
+    invalidate_user_cache(user_id)
+    return True
+
+
+def _check_embed_quota(final_user_id: str):
+    """检查嵌入额度，返回 (embed_used, embed_total)；额度用完时抛 402（查库时顺带降级已过期的订阅）
+
+    优先使用内存缓存（批量嵌入时避免每张图都访问新加坡节点）；未命中时含同步 Supabase 调用，由调用方放到线程池执行
+    """
+    _cached_embed_used = 0
+    _cached_embed_total = 50
+    cached_q = _get_quota_from_cache(final_user_id)
+    if cached_q:
+        # 命中缓存，直接使用，跳过 Supabase 网络往返
+        embed_used = cached_q["embed_used"]
+        embed_total = cached_q["embed_total"]
+        _cached_embed_used = embed_used
+        _cached_embed_total = embed_total
+        if embed_used >= embed_total:
+            raise HTTPException(status_code=402, detail=f"您的嵌入额度已用完（{embed_used}/{embed_total}），请升级套餐或联系管理员。")
+    else:
+        # 缓存未命中，查询 Supabase
+        sb = get_supabase_service_client()
+        if sb:
+            user_res = sb.table("profiles").select("plan, quota_embed_used, quota_embed_total, subscription_status, subscription_expires_at").eq("id", final_user_id).execute()
+            if user_res.data:
+                user_data = user_res.data[0]
+                plan = user_data.get("plan", "free")
+                embed_total = _safe_int(user_data.get("quota_embed_total"), 50)
+                embed_used = _safe_int(user_data.get("quota_embed_used"), 0)
+
+                # 过期订阅已由 RPC 把 total 恢复为免费版，无需再纠偏
+                downgraded = _downgrade_if_expired(sb, final_user_id, user_data)
+                if downgraded:
+                    plan = "free"
+                
+                expected_total = _EMBED_TOTALS.get(plan, _EMBED_TOTALS["free"])
+                if embed_total != expected_total:
+                    if not downgraded:
+                        _fix_quota_total_async(sb, final_user_id, "quota_embed_total", expected_total)
+                    embed_total = expected_total
+                
+                # 写入缓存，后续批量请求直接命中
+                _set_quota_cache(final_user_id, embed_used, embed_total, plan)
+                
+                _cached_embed_used = embed_used
+                _cached_embed_total = embed_total
+                
+                if embed_used >= embed_total:
+                    raise HTTPException(status_code=402, detail=f"您的嵌入额度已用完（{embed_used}/{embed_total}），请升级套餐或联系管理员。")
+    return _cached_embed_used, _cached_embed_total
+
 
 @router.post("/embed", response_model=WatermarkResult)
-def embed_watermark(
+async def embed_watermark(
     image: UploadFile = File(...),
     strength: float = Form(0.1),
     author_name: str = Form(""),
@@ -228,83 +635,21 @@ def embed_watermark(
          raise HTTPException(status_code=400, detail="No file selected")
     
     final_user_id = user_id if user_id else "guest"
-    _cached_embed_used = 0
-    _cached_embed_total = 50
     t_start = time.perf_counter()
-    
-    # Check Embed Quota - 优先使用内存缓存（批量嵌入时避免每张图都访问新加坡节点）
+
+    # Check Embed Quota（本地缓存 → Redis 共享缓存 → Supabase；Supabase 查询放到线程池，并发同用户请求合并为一次）
+    _cached_embed_used, _cached_embed_total = 0, 50
     if final_user_id != "guest":
-        cached_q = _get_quota_from_cache(final_user_id)
-        if cached_q:
-            # 命中缓存，直接使用，跳过 Supabase 网络往返
-            embed_used = cached_q["embed_used"]
-            embed_total = cached_q["embed_total"]
-            _cached_embed_used = embed_used
-            _cached_embed_total = embed_total
-            if embed_used >= embed_total:
-                raise HTTPException(status_code=402, detail=f"您的嵌入额度已用完（{embed_used}/{embed_total}），请升级套餐或联系管理员。")
-        else:
-            # 缓存未命中，查询 Supabase
-            sb = get_supabase_service_client()
-            if sb:
-                user_res = sb.table("profiles").select("plan, quota_embed_used, quota_embed_total, subscription_expires_at, subscription_status").eq("id", final_user_id).execute()
-                if user_res.data:
-                    def safe_int(val, default=0):
-                        try:
-                            return int(val) if val is not None else default
-                        except (ValueError, TypeError):
-                            return default
-                    
-                    user_data = user_res.data[0]
-                    plan = user_data.get("plan", "free")
-                    embed_total = safe_int(user_data.get("quota_embed_total"), 50)
-                    embed_used = safe_int(user_data.get("quota_embed_used"), 0)
-                    
-                    # 检查订阅是否过期
-                    from datetime import datetime
-                    expires_at = user_data.get("subscription_expires_at")
-                    sub_status = user_data.get("subscription_status")
-                    
-                    if expires_at and sub_status == 'active':
-                        try:
-                            expire_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                            if datetime.now(expire_time.tzinfo) > expire_time:
-                                sb.table("profiles").update({
-                                    "plan": "free",
-                                    "quota_total": 10,
-                                    "quota_embed_total": 50,
-                                    "quota_detect_total": 20,
-                                    "subscription_status": "expired",
-                                    "subscription_period": None,
-                                    "subscription_expires_at": None
-                                }).eq("id", final_user_id).execute()
-                                plan = "free"
-                                embed_total = 50
-                                raise HTTPException(status_code=402, detail="您的订阅已过期，已自动降级到免费版。如需继续使用付费功能，请重新订阅。")
-                        except ValueError:
-                            pass
-                    
-                    expected_total = {"free": 50, "personal": 500, "pro": 2000, "enterprise": 9999999}.get(plan, 50)
-                    if embed_total != expected_total:
-                        sb.table("profiles").update({"quota_embed_total": expected_total}).eq("id", final_user_id).execute()
-                        embed_total = expected_total
-                    
-                    # 写入缓存，后续批量请求直接命中
-                    _set_quota_cache(final_user_id, embed_used, embed_total, plan)
-                    
-                    _cached_embed_used = embed_used
-                    _cached_embed_total = embed_total
-                    
-                    if embed_used >= embed_total:
-                        raise HTTPException(status_code=402, detail=f"您的嵌入额度已用完（{embed_used}/{embed_total}），请升级套餐或联系管理员。")
-            
+        _cached_embed_used, _cached_embed_total = await _load_embed_quota(final_user_id)
+
     t_quota = time.perf_counter()
     try:
         t0 = time.perf_counter()
-        content = image.file.read()
+        content = await image.read()
         t_read = time.perf_counter()
 
-        res = WatermarkService.embed_watermark(
+        res = await run_in_threadpool(
+            WatermarkService.embed_watermark,
             file_bytes=content,
             filename=image.filename,
             user_id=final_user_id,
@@ -320,25 +665,27 @@ def embed_watermark(
 
             # ★ 立即注入检测缓存，确保"刚嵌入立即检测"能命中
             try:
-                from app.service.enhanced_watermark import inject_asset_to_cache, invalidate_assets_cache
                 inject_asset_to_cache(
                     fingerprint=str(res.get("fingerprint", "")),
                     user_id=final_user_id,
                     filename=str(res.get("filename", "")),
                 )
             except Exception as e:
-                print(f"[CacheInject] 注入检测缓存失败(non-fatal): {e}")
+                logger.warning("[CacheInject] 注入检测缓存失败(non-fatal): %s", e)
 
             # 异步落库期间：记录文件归属，允许立即预览
             if res.get("filename"):
-                _recent_embed_files[str(res.get("filename"))] = {
+                _cache_put(_recent_embed_files, str(res.get("filename")), {
                     "user_id": final_user_id,
                     "expires": time.time() + _RECENT_EMBED_TTL,
-                }
+                })
 
             # 先用内存缓存做“乐观更新”（体感更快）；真正持久化在后台完成
             optimistic_used = _cached_embed_used + 1
             _increment_quota_cache(final_user_id)
+            shared_used = await _incr_shared_quota("embed", final_user_id, _quota_cache, "embed_used")
+            if shared_used is not None:
+                optimistic_used = max(optimistic_used, shared_used)
             res["quota_embed_used"] = optimistic_used
             res["quota_embed_total"] = _cached_embed_total
             res["quota_used"] = optimistic_used
@@ -353,7 +700,6 @@ def embed_watermark(
 
                     # 失效资产缓存，下次检测时会重新加载含新资产的列表
                     try:
-                        from app.service.enhanced_watermark import invalidate_assets_cache
                         invalidate_assets_cache()
                     except Exception:
                         pass
@@ -376,16 +722,11 @@ def embed_watermark(
                     except Exception:
                         inserted_id = None
 
-                    # 2) 扣减额度（异步）
+                    # 2) 扣减额度（异步，数据库内原子自增，并发批量嵌入不会丢计数）
                     try:
-                        sb2.table("profiles").update({
-                            "quota_embed_used": optimistic_used,
-                            "quota_used": optimistic_used,
-                        }).eq("id", final_user_id).execute()
-                        # 持久化成功后，清除缓存，强制下一次重新查询（为了批量嵌入此时获取最新的额度）
-                        _invalidate_quota_cache(final_user_id)
+                        _persist_embed_quota_increment(sb2, final_user_id)
                     except Exception as e:
-                        print(f"[Quota] Failed to update embed quota(async): {e}")
+                        logger.warning("[Quota] Failed to update embed quota(async): %s", e)
 
                     # 3) 上传到 Supabase Storage，并更新 output_path
                     try:
@@ -394,9 +735,9 @@ def embed_watermark(
                         if cloud_url and inserted_id is not None:
                             sb2.table("watermarked_assets").update({"output_path": cloud_url}).eq("id", inserted_id).execute()
                     except Exception as e:
-                        print(f"Background sync failed: {e}")
+                        logger.warning("Background sync failed: %s", e)
                 except Exception as e:
-                    print(f"Background persist failed: {e}")
+                    logger.exception("Background persist failed: %s", e)
 
             if background_tasks is not None and res.get("filename") and res.get("fingerprint"):
                 background_tasks.add_task(
@@ -408,14 +749,12 @@ def embed_watermark(
 
             t_done = time.perf_counter()
             res["processing_time_sec"] = round(t_done - t_start, 3)
-            print(
-                "DEBUG: embed timings(ms) quota=%.1f read=%.1f embed=%.1f total=%.1f (persist async)"
-                % (
-                    (t_quota - t_start) * 1000,
-                    (t_read - t0) * 1000,
-                    (t_embed - t_read) * 1000,
-                    (t_done - t_start) * 1000,
-                )
+            logger.debug(
+                "embed timings(ms) quota=%.1f read=%.1f embed=%.1f total=%.1f (persist async)",
+                (t_quota - t_start) * 1000,
+                (t_read - t0) * 1000,
+                (t_embed - t_read) * 1000,
+                (t_done - t_start) * 1000,
             )
 
         else:
@@ -426,14 +765,12 @@ def embed_watermark(
             if final_user_id != "guest":
                 res["quota_embed_used"] = _cached_embed_used
                 res["quota_embed_total"] = _cached_embed_total
-            print(
-                "DEBUG: embed timings(ms) quota=%.1f read=%.1f embed=%.1f total=%.1f"
-                % (
-                    (t_quota - t_start) * 1000,
-                    (t_read - t0) * 1000,
-                    (t_embed - t_read) * 1000,
-                    (t_done - t_start) * 1000,
-                )
+            logger.debug(
+                "embed timings(ms) quota=%.1f read=%.1f embed=%.1f total=%.1f",
+                (t_quota - t_start) * 1000,
+                (t_read - t0) * 1000,
+                (t_embed - t_read) * 1000,
+                (t_done - t_start) * 1000,
             )
             
         return res
@@ -447,7 +784,7 @@ def embed_watermark(
              "quota_embed_total": _cached_embed_total if final_user_id != "guest" else 50,
          }
     except Exception as e:
-         print(f"Embed Error: {e}")
+         logger.exception("Embed Error: %s", e)
          return {
              "success": False,
              "error": "EMBED_FAILED",
@@ -457,129 +794,136 @@ def embed_watermark(
              "quota_embed_total": _cached_embed_total if final_user_id != "guest" else 50,
          }
 
-from app.workers.tasks import process_watermark_batch, run_infringement_crawler
-import base64
+from app.workers.tasks import BATCH_INCOMING_DIR, process_watermark_batch, run_infringement_crawler
+
+def _compute_detect_report(report_id: str, user_id: str, res: dict, image_filename: str, user_plan: str):
+    """后台生成五维评分 / 可视化 / 法律评估（区块链数据不在此获取），写入 _detect_reports"""
+    report = {}
+    try:
+        enhanced_report = ReportService.generate_enhanced_report(
+            detection_result=res,
+            image_filename=image_filename,
+            user_plan=user_plan,
+            blockchain_data=None
+        )
+        if enhanced_report and enhanced_report.get("detection_summary", {}).get("five_dim_score"):
+            report["five_dim_score"] = enhanced_report["detection_summary"]["five_dim_score"]
+            report["confidence_level"] = enhanced_report["detection_summary"].get("confidence_level", "未评级")
+            report["legal_description"] = enhanced_report["detection_summary"].get("legal_description", "")
+            if enhanced_report.get("visualizations"):
+                report["visualizations"] = enhanced_report["visualizations"]
+            if enhanced_report.get("legal_assessment"):
+                report["legal_assessment"] = enhanced_report["legal_assessment"]
+    except Exception as e:
+        logger.warning("[FiveDimScore] Failed to calculate: %s", e)
+
+    _cache_put(_detect_reports, report_id, {
+        "user_id": user_id,
+        "ready": True,
+        "report": report,
+        "expires": time.time() + _DETECT_REPORT_TTL,
+    })
+
+
+def _check_detect_quota(final_user_id: str):
+    """检查检测额度，返回 (detect_used, detect_total, plan)；额度用完时抛 402（查库时顺带降级已过期的订阅）
+
+    优先使用内存缓存（批量检测时避免每张图都访问新加坡节点）；未命中时含同步 Supabase 调用，由调用方放到线程池执行
+    """
+    _cached_detect_used = 0
+    _cached_detect_total = 20
+    _cached_plan = "free"
+    cached_dq = _get_detect_quota_from_cache(final_user_id)
+    if cached_dq:
+        # 命中缓存，直接使用，跳过 Supabase 网络往返
+        detect_used = cached_dq["detect_used"]
+        detect_total = cached_dq["detect_total"]
+        _cached_detect_used = detect_used
+        _cached_detect_total = detect_total
+        _cached_plan = cached_dq.get("plan", "free")
+        if detect_used >= detect_total:
+            raise HTTPException(status_code=402, detail=f"您的检测额度已用完（{detect_used}/{detect_total}），请升级套餐或联系管理员。")
+    else:
+        # 缓存未命中，查询 Supabase
+        sb = get_supabase_service_client()
+        if sb:
+            user_res = sb.table("profiles").select("plan, quota_detect_used, quota_detect_total, subscription_status, subscription_expires_at").eq("id", final_user_id).execute()
+            if user_res.data:
+                user_data = user_res.data[0]
+                plan = user_data.get("plan", "free")
+                detect_total = _safe_int(user_data.get("quota_detect_total"), 20)
+                detect_used = _safe_int(user_data.get("quota_detect_used"), 0)
+
+                # 过期订阅已由 RPC 把 total 恢复为免费版，无需再纠偏
+                downgraded = _downgrade_if_expired(sb, final_user_id, user_data)
+                if downgraded:
+                    plan = "free"
+                
+                expected_total = _DETECT_TOTALS.get(plan, _DETECT_TOTALS["free"])
+                if detect_total != expected_total:
+                    if not downgraded:
+                        _fix_quota_total_async(sb, final_user_id, "quota_detect_total", expected_total)
+                    detect_total = expected_total
+                
+                # 写入缓存，后续批量请求直接命中
+                _set_detect_quota_cache(final_user_id, detect_used, detect_total, plan)
+                _cached_detect_used = detect_used
+                _cached_detect_total = detect_total
+                _cached_plan = plan
+                
+                if detect_used >= detect_total:
+                    raise HTTPException(status_code=402, detail=f"您的检测额度已用完（{detect_used}/{detect_total}），请升级套餐或联系管理员。")
+    return _cached_detect_used, _cached_detect_total, _cached_plan
+
 
 @router.post("/detect", response_model=DetectionResult)
-def detect_watermark(
+async def detect_watermark(
     image: UploadFile = File(...),
     user_id: Optional[str] = Depends(get_optional_user),
     background_tasks: BackgroundTasks = None
 ) -> Any:
     final_user_id = user_id if user_id else "guest"
     t_start = time.perf_counter()
-    _cached_detect_used = 0
-    _cached_detect_total = 20
-    _cached_plan = "free"
-    
-    # Check Detect Quota - 优先使用内存缓存（批量检测时避免每张图都访问新加坡节点）
+
+    # Check Detect Quota（本地缓存 → Redis 共享缓存 → Supabase；Supabase 查询放到线程池，并发同用户请求合并为一次）
+    _cached_detect_used, _cached_detect_total, _cached_plan = 0, 20, "free"
     if final_user_id != "guest":
-        cached_dq = _get_detect_quota_from_cache(final_user_id)
-        if cached_dq:
-            # 命中缓存，直接使用，跳过 Supabase 网络往返
-            detect_used = cached_dq["detect_used"]
-            detect_total = cached_dq["detect_total"]
-            _cached_detect_used = detect_used
-            _cached_detect_total = detect_total
-            _cached_plan = cached_dq.get("plan", "free")
-            if detect_used >= detect_total:
-                raise HTTPException(status_code=402, detail=f"您的检测额度已用完（{detect_used}/{detect_total}），请升级套餐或联系管理员。")
-        else:
-            # 缓存未命中，查询 Supabase
-            sb = get_supabase_service_client()
-            if sb:
-                user_res = sb.table("profiles").select("plan, quota_detect_used, quota_detect_total, subscription_expires_at, subscription_status").eq("id", final_user_id).execute()
-                if user_res.data:
-                    user_data = user_res.data[0]
-                    def safe_int(val, default=0):
-                        try:
-                            return int(val) if val is not None else default
-                        except (ValueError, TypeError):
-                            return default
-                    
-                    plan = user_data.get("plan", "free")
-                    detect_total = safe_int(user_data.get("quota_detect_total"), 20)
-                    detect_used = safe_int(user_data.get("quota_detect_used"), 0)
-                    
-                    # 检查订阅是否过期
-                    from datetime import datetime
-                    expires_at = user_data.get("subscription_expires_at")
-                    sub_status = user_data.get("subscription_status")
-                    
-                    if expires_at and sub_status == 'active':
-                        try:
-                            expire_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                            if datetime.now(expire_time.tzinfo) > expire_time:
-                                sb.table("profiles").update({
-                                    "plan": "free",
-                                    "quota_total": 10,
-                                    "quota_embed_total": 50,
-                                    "quota_detect_total": 20,
-                                    "subscription_status": "expired",
-                                    "subscription_period": None,
-                                    "subscription_expires_at": None
-                                }).eq("id", final_user_id).execute()
-                                plan = "free"
-                                detect_total = 20
-                                raise HTTPException(status_code=402, detail="您的订阅已过期，已自动降级到免费版。如需继续使用付费功能，请重新订阅。")
-                        except ValueError:
-                            pass
-                    
-                    expected_total = {"free": 20, "personal": 200, "pro": 1000, "enterprise": 9999999}.get(plan, 20)
-                    if detect_total != expected_total:
-                        sb.table("profiles").update({"quota_detect_total": expected_total}).eq("id", final_user_id).execute()
-                        detect_total = expected_total
-                    
-                    # 写入缓存，后续批量请求直接命中
-                    _set_detect_quota_cache(final_user_id, detect_used, detect_total, plan)
-                    _cached_detect_used = detect_used
-                    _cached_detect_total = detect_total
-                    _cached_plan = plan
-                    
-                    if detect_used >= detect_total:
-                        raise HTTPException(status_code=402, detail=f"您的检测额度已用完（{detect_used}/{detect_total}），请升级套餐或联系管理员。")
-    
+        _cached_detect_used, _cached_detect_total, _cached_plan = await _load_detect_quota(final_user_id)
+
     t_quota = time.perf_counter()
     try:
         t0 = time.perf_counter()
-        content = image.file.read()
+        content = await image.read()
         t_read = time.perf_counter()
-        res = WatermarkService.detect_watermark(content, image.filename or "unknown")
+        res = await run_in_threadpool(WatermarkService.detect_watermark, content, image.filename or "unknown")
         t_detect = time.perf_counter()
         
         # 乐观更新额度缓存（体感更快），真正持久化在后台完成
         optimistic_detect_used = _cached_detect_used + 1
-        _increment_detect_quota_cache(final_user_id)
+        if final_user_id != "guest":
+            _increment_detect_quota_cache(final_user_id)
+            shared_used = await _incr_shared_quota("detect", final_user_id, _detect_quota_cache, "detect_used")
+            if shared_used is not None:
+                optimistic_detect_used = max(optimistic_detect_used, shared_used)
         res["quota_detect_used"] = optimistic_detect_used
         res["quota_detect_total"] = _cached_detect_total
         
-        # --- [五维评分计算 - 同步计算，但区块链数据删归后台] ---
-        if final_user_id != "guest":
-            try:
-                from app.service.report_service import ReportService
-                user_plan = _cached_plan
-                
-                enhanced_report = ReportService.generate_enhanced_report(
-                    detection_result=res,
-                    image_filename=image.filename or "unknown",
-                    user_plan=user_plan,
-                    blockchain_data=None  # 区块链数据移到后台获取
-                )
-                
-                if enhanced_report and enhanced_report.get("detection_summary", {}).get("five_dim_score"):
-                    five_dim_score = enhanced_report["detection_summary"]["five_dim_score"]
-                    res["five_dim_score"] = five_dim_score
-                    res["confidence_level"] = enhanced_report["detection_summary"].get("confidence_level", "未评级")
-                    res["legal_description"] = enhanced_report["detection_summary"].get("legal_description", "")
-                    
-                    if enhanced_report.get("visualizations"):
-                        res["visualizations"] = enhanced_report["visualizations"]
-                    if enhanced_report.get("legal_assessment"):
-                        res["legal_assessment"] = enhanced_report["legal_assessment"]
-                        
-            except Exception as e:
-                print(f"[FiveDimScore] Failed to calculate: {e}")
-        
+        # --- [五维评分报告 → 后台任务，前端凭 report_id 轮询 GET /detect/report/{report_id}] ---
+        if final_user_id != "guest" and background_tasks is not None:
+            report_id = uuid.uuid4().hex
+            _cache_put(_detect_reports, report_id, {
+                "user_id": final_user_id,
+                "ready": False,
+                "report": {},
+                "expires": time.time() + _DETECT_REPORT_TTL,
+            })
+            # 先于落库任务加入（后台任务按顺序执行），报告尽快就绪
+            background_tasks.add_task(
+                _compute_detect_report, report_id, final_user_id, res, image.filename or "unknown", _cached_plan
+            )
+            res["report_id"] = report_id
+            res["report_ready"] = False
+
         # --- [额度持久化 + 检测记录辐库 → 后台任务] ---
         if final_user_id != "guest" and background_tasks is not None:
             def _background_detect_persist():
@@ -588,15 +932,11 @@ def detect_watermark(
                     if not sb2:
                         return
                     
-                    # 1) 额度持久化
+                    # 1) 额度持久化（数据库内原子自增，并发批量检测不会丢计数）
                     try:
-                        sb2.table("profiles").update({
-                            "quota_detect_used": optimistic_detect_used
-                        }).eq("id", final_user_id).execute()
-                        # 持久化成功后，清除缓存，强制下一次重新查询（为了批量检测此时获取最新的额度）
-                        _invalidate_detect_quota_cache(final_user_id)
+                        _persist_detect_quota_increment(sb2, final_user_id)
                     except Exception as e:
-                        print(f"[Quota] Failed to update detect quota(async): {e}")
+                        logger.warning("[Quota] Failed to update detect quota(async): %s", e)
                     
                     # 2) 检测记录落库
                     try:
@@ -639,137 +979,176 @@ def detect_watermark(
                             }
                         }).execute()
                     except Exception as e:
-                        print(f"[DetectionRecord] Failed to save detection record(async): {e}")
+                        logger.warning("[DetectionRecord] Failed to save detection record(async): %s", e)
                 except Exception as e:
-                    print(f"Background detect persist failed: {e}")
+                    logger.exception("Background detect persist failed: %s", e)
             
             background_tasks.add_task(_background_detect_persist)
         
         t_done = time.perf_counter()
         res["processing_time_sec"] = round(t_done - t_start, 3)
-        print(
-            "DEBUG: detect timings(ms) quota=%.1f read=%.1f detect=%.1f total=%.1f (persist async)"
-            % (
-                (t_quota - t_start) * 1000,
-                (t_read - t0) * 1000,
-                (t_detect - t_read) * 1000,
-                (t_done - t_start) * 1000,
-            )
+        logger.debug(
+            "detect timings(ms) quota=%.1f read=%.1f detect=%.1f total=%.1f (persist async)",
+            (t_quota - t_start) * 1000,
+            (t_read - t0) * 1000,
+            (t_detect - t_read) * 1000,
+            (t_done - t_start) * 1000,
         )
         return res
     except ValueError as e:
          raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-         print(f"Detect Error: {e}")
+         logger.exception("Detect Error: %s", e)
          raise HTTPException(status_code=500, detail="Internal Server Error")
 
+@router.get("/detect/report/{report_id}")
+def get_detect_report(report_id: str, user_id: Optional[str] = Depends(get_optional_user)) -> Any:
+    """轮询 /detect 的五维评分报告：ready 为 false 时稍后重试；只有检测发起人可以读取"""
+    entry = _detect_reports.get(report_id)
+    if not entry or time.time() >= entry["expires"] or entry["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="报告不存在或已过期")
+    return {"report_id": report_id, "ready": entry["ready"], **entry["report"]}
+
+
+def _spool_batch_uploads(images: List[UploadFile]):
+    """把上传文件按块复制到 BATCH_INCOMING_DIR，返回 (暂存路径列表, 原文件名列表)；失败时删除已写入的文件"""
+    os.makedirs(BATCH_INCOMING_DIR, exist_ok=True)
+    paths, filenames = [], []
+    try:
+        for img in images:
+            path = os.path.join(BATCH_INCOMING_DIR, f"{uuid.uuid4().hex}.bin")
+            paths.append(path)
+            with open(path, "wb") as f:
+                shutil.copyfileobj(img.file, f, 1 << 20)
+            filenames.append(img.filename)
+    except Exception:
+        _discard_spooled(paths)
+        raise
+    return paths, filenames
+
+
+def _discard_spooled(paths: List[str]):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
 @router.post("/embed/batch")
-def embed_watermark_batch(
+async def embed_watermark_batch(
     images: List[UploadFile] = File(...),
     strength: float = Form(0.1),
     author_name: str = Form(""),
     user_id: Optional[str] = Depends(get_optional_user)
 ) -> Any:
-    """提交大批量水印任务进 Celery 队列"""
+    """提交大批量水印任务进 Celery 队列（消息只携带暂存文件路径，图片内容不经过 broker）"""
     final_user_id = user_id if user_id else "guest"
-    
-    b64_files = []
-    filenames = []
-    for img in images:
-        content = img.file.read()
-        b64_files.append(base64.b64encode(content).decode('utf-8'))
-        filenames.append(img.filename)
-        
-    task = process_watermark_batch.delay(b64_files, filenames, final_user_id, author_name or final_user_id, strength)
+
+    paths, filenames = await run_in_threadpool(_spool_batch_uploads, images)
+    try:
+        task = process_watermark_batch.delay(paths, filenames, final_user_id, author_name or final_user_id, strength)
+    except Exception:
+        _discard_spooled(paths)
+        raise
     return {"message": "Batch task submitted successfully", "task_id": task.id}
 
+# 文本检测证据库匹配：作者名随资产一起嵌入返回
+_TEXT_MATCH_COLUMNS = 'id, user_id, filename, fingerprint, timestamp, asset_type, uploader:profiles(display_name)'
+
+
+def _write_text_output(output_path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _save_upload_to_temp(upload: UploadFile, suffix: str) -> str:
+    """把上传文件按块复制到临时文件（不整体读入内存），返回临时文件路径"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        shutil.copyfileobj(upload.file, tmp, 1 << 20)
+        return tmp.name
+
+
+def _discard_temp(*paths: str) -> None:
+    """删除临时文件（不存在或删除失败时忽略）；异步接口中经 run_in_threadpool 调用"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+async def _persist_embedded_asset(sb, user_id: str, row: dict, local_path: Optional[str] = None):
+    """后台写入 watermarked_assets（响应已返回）；传入 local_path 时同时上传对象存储
+
+    插入与上传并发执行（耗时取两者最大值），记录先以本地地址落库、立即可被检测匹配；
+    上传成功后再把 output_path 更新为云端地址。写入失败时退回入口处扣减的嵌入额度
+    """
+    insert = run_in_threadpool(sb.table("watermarked_assets").insert({"user_id": user_id, **row}).execute)
+    cloud_url = None
+    if local_path:
+        # upload_file 内部捕获异常，失败返回 None
+        inserted, cloud_url = await asyncio.gather(
+            insert, run_in_threadpool(StorageService.upload_file, local_path), return_exceptions=True
+        )
+    else:
+        try:
+            inserted = await insert
+        except Exception as e:
+            inserted = e
+
+    if isinstance(inserted, Exception):
+        logger.error("Background asset persist failed: %s", inserted)
+        await run_in_threadpool(_refund_quota, sb, user_id, "embed")
+        return
+
+    asset_id = (inserted.data or [{}])[0].get("id")
+    if isinstance(cloud_url, str) and cloud_url and asset_id is not None:
+        try:
+            await run_in_threadpool(
+                sb.table("watermarked_assets").update({"output_path": cloud_url}).eq("id", asset_id).execute
+            )
+        except Exception as e:
+            logger.warning("Cloud URL update failed for asset %s: %s", asset_id, e)
+
+
 @router.post("/embed/text")
-def embed_text_watermark(req: TextEmbedRequest, user_id: Optional[str] = Depends(get_optional_user)):
-    """AIGC 爆款文案/小说 - 零宽字符水印隐写"""
-    final_user_id = user_id if user_id else "guest"
-    
-    # 检查订阅和额度（同图片嵌入逻辑）
-    if final_user_id != "guest":
-        sb = get_supabase_service_client()
-        if sb:
-            user_res = sb.table("profiles").select("plan, quota_embed_used, quota_embed_total, subscription_expires_at, subscription_status").eq("id", final_user_id).execute()
-            if user_res.data:
-                user_data = user_res.data[0]
-                def safe_int(val, default=0):
-                    try:
-                        return int(val) if val is not None else default
-                    except (ValueError, TypeError):
-                        return default
-                
-                plan = user_data.get("plan", "free")
-                embed_total = safe_int(user_data.get("quota_embed_total"), 50)
-                embed_used = safe_int(user_data.get("quota_embed_used"), 0)
-                
-                # 检查订阅过期
-                from datetime import datetime
-                expires_at = user_data.get("subscription_expires_at")
-                sub_status = user_data.get("subscription_status")
-                
-                if expires_at and sub_status == 'active':
-                    try:
-                        expire_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                        if datetime.now(expire_time.tzinfo) > expire_time:
-                            sb.table("profiles").update({
-                                "plan": "free",
-                                "quota_total": 10,
-                                "quota_embed_total": 50,
-                                "quota_detect_total": 20,
-                                "subscription_status": "expired",
-                                "subscription_period": None,
-                                "subscription_expires_at": None
-                            }).eq("id", final_user_id).execute()
-                            raise HTTPException(status_code=402, detail="您的订阅已过期，已自动降级到免费版。如需继续使用付费功能，请重新订阅。")
-                    except ValueError:
-                        pass
-                
-                # 检查额度
-                expected_total = {"free": 50, "personal": 500, "pro": 2000, "enterprise": 9999999}.get(plan, 50)
-                if embed_total != expected_total:
-                    sb.table("profiles").update({"quota_embed_total": expected_total}).eq("id", final_user_id).execute()
-                    embed_total = expected_total
-                
-                if embed_used >= embed_total:
-                    raise HTTPException(status_code=402, detail=f"您的嵌入额度已用完（{embed_used}/{embed_total}），请升级套餐或联系管理员。")
-    
-    timestamp = datetime.now().strftime('%Y%m%d%H%M')
-    fingerprint = str(abs(hash(f"{final_user_id}_{timestamp}_{req.author_name}")) % (10**8))
-    
+async def embed_text_watermark(
+    req: TextEmbedRequest,
+    quota: tuple = Depends(require_embed_quota),
+    background_tasks: BackgroundTasks = None
+):
+    """AIGC 爆款文案/小说 - 零宽字符水印隐写（水印与文件写入完成即返回，存证记录在后台写入）"""
+    # 嵌入额度已由依赖扣减（处理失败时自动退回）
+    sb, final_user_id = quota
+
+    now = datetime.now()  # 每个请求只取一次时间，指纹、文件名与存证时间一致
+    timestamp = now.strftime('%Y%m%d%H%M')
+    # 内置 hash() 按进程随机化，重启或多 worker 下同一输入得到不同指纹；BLAKE2s 结果稳定（8 位十六进制）
+    fingerprint = hashlib.blake2s(f"{final_user_id}:{timestamp}:{req.author_name}".encode(), digest_size=4).hexdigest()
+
     watermarked = TextWatermarkService.embed(req.text, fingerprint)
-    
+
     filename = f"text_{timestamp}_{fingerprint[:8]}.txt"
     output_path = os.path.join("outputs", filename)
-    os.makedirs("outputs", exist_ok=True)
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(watermarked)
-        
-    # Save to Supabase
-    if final_user_id != "guest":
-        sb = get_supabase_service_client()
-        if sb:
-            sb.table("watermarked_assets").insert({
-                "user_id": final_user_id,
-                "filename": filename,
-                "fingerprint": fingerprint,
-                "timestamp": datetime.now().isoformat(),
-                "psnr": 0,
-                "asset_type": "text",
-                "output_path": f"/api/image/{filename}"
-            }).execute()
-            
-            # 更新额度
-            user_res = sb.table("profiles").select("quota_embed_used, quota_embed_total").eq("id", final_user_id).execute()
-            if user_res.data:
-                current_used = user_res.data[0].get("quota_embed_used", 0)
-                current_total = user_res.data[0].get("quota_embed_total", 50)
-                sb.table("profiles").update({
-                    "quota_embed_used": current_used + 1
-                }).eq("id", final_user_id).execute()
-        
+    await run_in_threadpool(_write_text_output, output_path, watermarked)
+
+    # Save to Supabase（后台任务，不阻塞响应）
+    if sb and final_user_id != "guest":
+        row = {
+            "filename": filename,
+            "fingerprint": fingerprint,
+            "timestamp": now.isoformat(),
+            "psnr": 0,
+            "asset_type": "text",
+            "output_path": f"/api/image/{filename}"
+        }
+        if background_tasks is not None:
+            background_tasks.add_task(_persist_embedded_asset, sb, final_user_id, row)
+        else:
+            await _persist_embedded_asset(sb, final_user_id, row)
+
     return {
         "success": True,
         "fingerprint": fingerprint,
@@ -780,86 +1159,32 @@ def embed_text_watermark(req: TextEmbedRequest, user_id: Optional[str] = Depends
 @router.post("/detect/text")
 def detect_text_watermark(
     req: TextDetectRequest,
-    user_id: Optional[str] = Depends(get_optional_user)
+    quota: tuple = Depends(require_detect_quota)
 ):
     """检测被恶意复制的爆款文案的源头指纹"""
-    final_user_id = user_id if user_id else "guest"
-    
-    # 检查检测额度
-    if final_user_id != "guest":
-        sb = get_supabase_service_client()
-        if sb:
-            user_res = sb.table("profiles").select("plan, quota_detect_used, quota_detect_total, subscription_expires_at, subscription_status").eq("id", final_user_id).execute()
-            if user_res.data:
-                user_data = user_res.data[0]
-                def safe_int(val, default=0):
-                    try:
-                        return int(val) if val is not None else default
-                    except (ValueError, TypeError):
-                        return default
-                
-                plan = user_data.get("plan", "free")
-                detect_total = safe_int(user_data.get("quota_detect_total"), 20)
-                detect_used = safe_int(user_data.get("quota_detect_used"), 0)
-                
-                # 检查订阅过期
-                from datetime import datetime
-                expires_at = user_data.get("subscription_expires_at")
-                sub_status = user_data.get("subscription_status")
-                
-                if expires_at and sub_status == 'active':
-                    try:
-                        expire_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                        if datetime.now(expire_time.tzinfo) > expire_time:
-                            sb.table("profiles").update({
-                                "plan": "free",
-                                "quota_total": 10,
-                                "quota_embed_total": 50,
-                                "quota_detect_total": 20,
-                                "subscription_status": "expired",
-                                "subscription_period": None,
-                                "subscription_expires_at": None
-                            }).eq("id", final_user_id).execute()
-                            raise HTTPException(status_code=402, detail="您的订阅已过期，已自动降级到免费版。如需继续使用付费功能，请重新订阅。")
-                    except ValueError:
-                        pass
-                
-                # 根据套餐设置正确的检测额度上限
-                expected_total = {"free": 20, "personal": 200, "pro": 1000, "enterprise": 9999999}.get(plan, 20)
-                if detect_total != expected_total:
-                    sb.table("profiles").update({"quota_detect_total": expected_total}).eq("id", final_user_id).execute()
-                    detect_total = expected_total
-                
-                if detect_used >= detect_total:
-                    raise HTTPException(status_code=402, detail=f"您的检测额度已用完（{detect_used}/{detect_total}），请升级套餐或联系管理员。")
-    
+    # 检测额度已由依赖扣减（每次检测都扣减）
+    sb, final_user_id = quota
+
     fingerprint = TextWatermarkService.extract(req.text)
 
     has_watermark = (fingerprint != "" and fingerprint != "No watermark found" and fingerprint != "Corrupted watermark")
     matched_asset = None
     
     if has_watermark:
-        # Search Cloud Only - 使用独立查询避免 FK join 失败
+        # Search Cloud Only - 作者名通过 profiles 外键嵌入（见 supabase_migration_assets_profiles_fk.sql），一次查询取回
         try:
-            sb = get_supabase_service_client()
             if sb:
-                # 第一步：按指纹精确匹配（不使用 join，避免 FK 缺失导致查询失败）
-                res = sb.table('watermarked_assets').select('id, user_id, filename, fingerprint, timestamp, asset_type').eq('fingerprint', fingerprint).execute()
+                # 第一步：按指纹精确匹配
+                res = sb.table('watermarked_assets').select(_TEXT_MATCH_COLUMNS).eq('fingerprint', fingerprint).limit(1).execute()
                 
                 # 第二步：如果精确匹配无结果，尝试 LIKE 模糊匹配（处理可能的前导零/格式差异）
                 if not res.data:
-                    res = sb.table('watermarked_assets').select('id, user_id, filename, fingerprint, timestamp, asset_type').like('fingerprint', f'%{fingerprint}%').execute()
+                    res = sb.table('watermarked_assets').select(_TEXT_MATCH_COLUMNS).like('fingerprint', f'%{fingerprint}%').limit(1).execute()
                 
                 if res.data:
                     row = res.data[0]
-                    # 第三步：单独查询作者名（避免 join 依赖 FK）
-                    author_name = row.get('user_id', '未知')
-                    try:
-                        prof_res = sb.table('profiles').select('display_name').eq('id', row['user_id']).limit(1).execute()
-                        if prof_res.data and prof_res.data[0].get('display_name'):
-                            author_name = prof_res.data[0]['display_name']
-                    except Exception:
-                        pass
+                    uploader = row.get('uploader') or {}
+                    author_name = uploader.get('display_name') or row.get('user_id', '未知')
                     
                     matched_asset = {
                         'id': row['id'],
@@ -871,26 +1196,9 @@ def detect_text_watermark(
                         'is_cloud_record': True
                     }
                 else:
-                    print(f"[TextDetect] 指纹 {fingerprint} 在证据库中未找到匹配记录")
+                    logger.info("[TextDetect] 指纹 %s 在证据库中未找到匹配记录", fingerprint)
         except Exception as e:
-            print(f"Text Supabase search error: {e}")
-            import traceback
-            traceback.print_exc()
-    
-    # 更新检测额度（每次检测都扣减，与图片/视频检测保持一致）
-    if final_user_id != "guest":
-        sb = get_supabase_service_client()
-        if sb:
-            try:
-                user_res = sb.table("profiles").select("quota_detect_used, quota_detect_total").eq("id", final_user_id).execute()
-                if user_res.data:
-                    current_used = user_res.data[0].get("quota_detect_used", 0)
-                    current_total = user_res.data[0].get("quota_detect_total", 20)
-                    sb.table("profiles").update({
-                        "quota_detect_used": current_used + 1
-                    }).eq("id", final_user_id).execute()
-            except Exception as e:
-                print(f"Update text detect quota failed: {e}")
+            logger.exception("Text Supabase search error: %s", e)
     
     # --- 构建解释性结论（用于前端报告展示）---
     if fingerprint == "No watermark found":
@@ -952,200 +1260,83 @@ def detect_text_watermark(
     }
 
 @router.post("/embed/video")
-def embed_video_watermark(
+async def embed_video_watermark(
     video: UploadFile = File(...),
     author_name: str = Form(""),
-    user_id: Optional[str] = Depends(get_optional_user)
+    quota: tuple = Depends(require_embed_quota),
+    background_tasks: BackgroundTasks = None
 ):
-    """Sora/Runway AIGC 视频级盲水印嵌入"""
-    final_user_id = user_id if user_id else "guest"
-    
-    # 检查订阅和额度
-    if final_user_id != "guest":
-        sb = get_supabase_service_client()
-        if sb:
-            user_res = sb.table("profiles").select("plan, quota_embed_used, quota_embed_total, subscription_expires_at, subscription_status").eq("id", final_user_id).execute()
-            if user_res.data:
-                user_data = user_res.data[0]
-                def safe_int(val, default=0):
-                    try:
-                        return int(val) if val is not None else default
-                    except (ValueError, TypeError):
-                        return default
-                
-                plan = user_data.get("plan", "free")
-                embed_total = safe_int(user_data.get("quota_embed_total"), 50)
-                embed_used = safe_int(user_data.get("quota_embed_used"), 0)
-                
-                # 检查订阅过期
-                from datetime import datetime
-                expires_at = user_data.get("subscription_expires_at")
-                sub_status = user_data.get("subscription_status")
-                
-                if expires_at and sub_status == 'active':
-                    try:
-                        expire_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                        if datetime.now(expire_time.tzinfo) > expire_time:
-                            sb.table("profiles").update({
-                                "plan": "free",
-                                "quota_total": 10,
-                                "quota_embed_total": 50,
-                                "quota_detect_total": 20,
-                                "subscription_status": "expired",
-                                "subscription_period": None,
-                                "subscription_expires_at": None
-                            }).eq("id", final_user_id).execute()
-                            raise HTTPException(status_code=402, detail="您的订阅已过期，已自动降级到免费版。如需继续使用付费功能，请重新订阅。")
-                    except ValueError:
-                        pass
-                
-                # 检查额度
-                expected_total = {"free": 50, "personal": 500, "pro": 2000, "enterprise": 9999999}.get(plan, 50)
-                if embed_total != expected_total:
-                    sb.table("profiles").update({"quota_embed_total": expected_total}).eq("id", final_user_id).execute()
-                    embed_total = expected_total
-                
-                if embed_used >= embed_total:
-                    raise HTTPException(status_code=402, detail=f"您的嵌入额度已用完（{embed_used}/{embed_total}），请升级套餐或联系管理员。")
-    
-    import tempfile
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as in_tmp:
-        in_tmp.write(video.file.read())
-        in_path = in_tmp.name
+    """Sora/Runway AIGC 视频级盲水印嵌入（转码与文件移动放到线程池；对象存储上传与存证记录在后台完成）"""
+    # 嵌入额度已由依赖扣减（处理失败时自动退回）
+    sb, final_user_id = quota
+
+    in_path = await run_in_threadpool(_save_upload_to_temp, video, ".mp4")
         
     out_path = in_path.replace(".mp4", "_watermarked.mp4")
     
-    import hashlib
-    timestamp = datetime.now().strftime('%Y%m%d%H%M')
+    now = datetime.now()
+    timestamp = now.strftime('%Y%m%d%H%M')
     # 使用 SHA256 生成合法的 64 字符十六进制指纹，确保 embed_dct 能正确嵌入 256 位
     fingerprint = hashlib.sha256(f"{final_user_id}:{timestamp}:{author_name}".encode()).hexdigest()
     
     try:
-        res = VideoWatermarkService.embed_video(in_path, out_path, fingerprint, author_name)
+        res = await run_in_threadpool(VideoWatermarkService.embed_video, in_path, out_path, fingerprint, author_name)
         
-        timestamp_full = datetime.now().strftime('%Y%m%d_%H%M%S')
+        timestamp_full = now.strftime('%Y%m%d_%H%M%S')
         final_filename = f"video_{timestamp_full}_{fingerprint[:16]}.mp4"
         final_path = os.path.join("outputs", final_filename)
         os.makedirs("outputs", exist_ok=True)
-        import shutil
-        shutil.move(out_path, final_path)
-        if os.path.exists(in_path): os.remove(in_path)
+        await run_in_threadpool(shutil.move, out_path, final_path)
+        await run_in_threadpool(_discard_temp, in_path)
         
-        # Save to Supabase
-        if final_user_id != "guest":
-            sb = get_supabase_service_client()
-            if sb:
-                # --- [云端同步逻辑] ---
-                cloud_url = StorageService.upload_file(final_path)
-                
-                sb.table("watermarked_assets").insert({
-                    "user_id": final_user_id,
-                    "filename": final_filename,
-                    "fingerprint": fingerprint,
-                    "timestamp": datetime.now().isoformat(),
-                    "psnr": res.get("psnr", 0),
-                    "asset_type": "video",
-                    "output_path": cloud_url or f"/api/image/{final_filename}"
-                }).execute()
-                
-                # 更新额度
-                user_res = sb.table("profiles").select("quota_embed_used, quota_embed_total").eq("id", final_user_id).execute()
-                if user_res.data:
-                    current_used = user_res.data[0].get("quota_embed_used", 0)
-                    current_total = user_res.data[0].get("quota_embed_total", 50)
-                    sb.table("profiles").update({
-                        "quota_embed_used": current_used + 1
-                    }).eq("id", final_user_id).execute()
-                
-                # 如果同步成功，更新下载链接
-                if cloud_url:
-                    res_url = cloud_url
-                else:
-                    res_url = f"/api/image/{final_filename}"
-            
+        # Save to Supabase（云端同步 + 存证记录放到后台任务；下载链接先用本地地址，文件已在 outputs 中）
+        if sb and final_user_id != "guest":
+            row = {
+                "filename": final_filename,
+                "fingerprint": fingerprint,
+                "timestamp": now.isoformat(),
+                "psnr": res.get("psnr", 0),
+                "asset_type": "video",
+                "output_path": f"/api/image/{final_filename}"
+            }
+            if background_tasks is not None:
+                background_tasks.add_task(_persist_embedded_asset, sb, final_user_id, row, final_path)
+            else:
+                await _persist_embedded_asset(sb, final_user_id, row, final_path)
+            # 异步落库期间：记录文件归属，允许立即下载
+            _cache_put(_recent_embed_files, final_filename, {
+                "user_id": final_user_id,
+                "expires": time.time() + _RECENT_EMBED_TTL,
+            })
+
         return {
             "success": True,
             "message": "视频盲水印注入完成",
             "fingerprint_embedded": fingerprint,
             "video_stats": res,
-            "download_url": res_url if 'res_url' in locals() else f"/api/image/{final_filename}"
+            "download_url": f"/api/image/{final_filename}"
         }
     except Exception as e:
-        if os.path.exists(in_path): os.remove(in_path)
+        # 失败时连同未移动的水印输出一起清理
+        await run_in_threadpool(_discard_temp, in_path, out_path)
         raise HTTPException(status_code=500, detail=str(e))
         
 @router.post("/detect/video")
 def detect_video_watermark(
     video: UploadFile = File(...),
-    user_id: Optional[str] = Depends(get_optional_user)
+    quota: tuple = Depends(require_detect_quota)
 ):
     """提取恶意搬运的短视频内的盲水印"""
-    final_user_id = user_id if user_id else "guest"
-    
-    # 检查订阅和额度
-    if final_user_id != "guest":
-        sb = get_supabase_service_client()
-        if sb:
-            user_res = sb.table("profiles").select("plan, quota_detect_used, quota_detect_total, subscription_expires_at, subscription_status").eq("id", final_user_id).execute()
-            if user_res.data:
-                user_data = user_res.data[0]
-                def safe_int(val, default=0):
-                    try:
-                        return int(val) if val is not None else default
-                    except (ValueError, TypeError):
-                        return default
-                
-                plan = user_data.get("plan", "free")
-                detect_total = safe_int(user_data.get("quota_detect_total"), 20)
-                detect_used = safe_int(user_data.get("quota_detect_used"), 0)
-                
-                # 检查订阅过期
-                from datetime import datetime
-                expires_at = user_data.get("subscription_expires_at")
-                sub_status = user_data.get("subscription_status")
-                
-                if expires_at and sub_status == 'active':
-                    try:
-                        expire_time = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                        if datetime.now(expire_time.tzinfo) > expire_time:
-                            sb.table("profiles").update({
-                                "plan": "free",
-                                "quota_total": 10,
-                                "quota_embed_total": 50,
-                                "quota_detect_total": 20,
-                                "subscription_status": "expired",
-                                "subscription_period": None,
-                                "subscription_expires_at": None
-                            }).eq("id", final_user_id).execute()
-                            raise HTTPException(status_code=402, detail="您的订阅已过期，已自动降级到免费版。如需继续使用付费功能，请重新订阅。")
-                    except ValueError:
-                        pass
-                
-                # 检查额度
-                expected_total = {"free": 20, "personal": 200, "pro": 1000, "enterprise": 9999999}.get(plan, 20)
-                if detect_total != expected_total:
-                    sb.table("profiles").update({"quota_detect_total": expected_total}).eq("id", final_user_id).execute()
-                    detect_total = expected_total
-                
-                if detect_used >= detect_total:
-                    raise HTTPException(status_code=402, detail=f"您的检测额度已用完（{detect_used}/{detect_total}），请升级套餐或联系管理员。")
-    
-    import tempfile
-    from algorithms.fingerprint_engine import FingerprintEngine
+    # 检测额度已由依赖扣减（处理失败时自动退回）
+    sb, final_user_id = quota
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as in_tmp:
-        in_tmp.write(video.file.read())
-        in_path = in_tmp.name
-        
-    raw_res = VideoWatermarkService.detect_video(in_path)
+    in_path = _save_upload_to_temp(video, ".mp4")
 
-    # 清理临时文件
-    if os.path.exists(in_path):
-        try:
-            os.remove(in_path)
-        except Exception:
-            pass
+    try:
+        raw_res = VideoWatermarkService.detect_video(in_path)
+    finally:
+        # 清理临时文件
+        _discard_temp(in_path)
 
     extracted_fp = raw_res.get("extracted_fingerprint", "")
     has_watermark = raw_res.get("has_watermark", False)
@@ -1157,35 +1348,17 @@ def detect_video_watermark(
     method_note = ""
 
     # --- 数据库指纹比对（与文本检测对齐） ---
-    if has_watermark and extracted_fp:
+    if has_watermark and extracted_fp and _FINGERPRINT_HEX_RE.match(extracted_fp):
         try:
-            sb = get_supabase_service_client()
             if sb:
-                engine = FingerprintEngine()
-                # 查询所有视频资产（也包含图片，因为用的是同一套 DCT 指纹）
-                assets_res = sb.table("watermarked_assets").select(
-                    "id, fingerprint, user_id, filename, timestamp, asset_type"
-                ).execute()
-                best_sim = 0.0
-                best_row = None
-                for row in (assets_res.data or []):
-                    db_fp = row.get("fingerprint", "")
-                    if not db_fp:
-                        continue
-                    sim = engine.fingerprint_similarity(extracted_fp, db_fp)
-                    if sim > best_sim:
-                        best_sim = sim
-                        best_row = row
+                # 在数据库内比对所有 256 位指纹（视频与图片用的是同一套 DCT 指纹），只取回最相近的一条
+                match_res = sb.rpc("match_fingerprint", {"p_fingerprint": extracted_fp, "p_threshold": 0.60}).execute()
+                best_row = match_res.data[0] if match_res.data else None
+                best_sim = float(best_row.get("similarity") or 0.0) if best_row else 0.0
 
                 if best_row and best_sim >= 0.60:
-                    # 查询作者名
-                    author_name = best_row.get("user_id", "未知")
-                    try:
-                        prof_res = sb.table("profiles").select("display_name").eq("id", best_row["user_id"]).limit(1).execute()
-                        if prof_res.data and prof_res.data[0].get("display_name"):
-                            author_name = prof_res.data[0]["display_name"]
-                    except Exception:
-                        pass
+                    # 作者名由 RPC 一并返回（LEFT JOIN profiles）
+                    author_name = best_row.get("author_name") or best_row.get("user_id", "未知")
 
                     matched_asset = {
                         "id": best_row["id"],
@@ -1197,7 +1370,7 @@ def detect_video_watermark(
                         "is_cloud_record": True,
                     }
         except Exception as e:
-            print(f"Video Supabase search error: {e}")
+            logger.warning("Video Supabase search error: %s", e)
 
     # --- 构建解释性检测结果 ---
     if has_watermark:
@@ -1234,21 +1407,6 @@ def detect_video_watermark(
         legal_description = "未发现可复现的频域盲水印证据。"
         method_note = "已对视频关键帧进行 DCT 频域扫描，未发现有效的数字指纹特征。"
 
-    # 更新检测额度
-    if final_user_id != "guest":
-        sb = get_supabase_service_client()
-        if sb:
-            try:
-                user_res = sb.table("profiles").select("quota_detect_used, quota_detect_total").eq("id", final_user_id).execute()
-                if user_res.data:
-                    current_used = user_res.data[0].get("quota_detect_used", 0)
-                    current_total = user_res.data[0].get("quota_detect_total", 20)
-                    sb.table("profiles").update({
-                        "quota_detect_used": current_used + 1
-                    }).eq("id", final_user_id).execute()
-            except Exception as e:
-                print(f"Update video detect quota failed: {e}")
-    
     return {
         "success": True,
         "has_watermark": has_watermark,
@@ -1290,11 +1448,11 @@ def list_my_assets(
         raise HTTPException(status_code=500, detail="Supabase 未配置：请检查 SUPABASE_URL / SUPABASE_KEY / SUPABASE_SERVICE_ROLE_KEY")
     
     # Check if admin（user_id 应为 UUID，对应 profiles.id）
-    user_res = sb.table("profiles").select("role").eq("id", user_id).execute()
-    is_admin = user_res.data and user_res.data[0].get("role") in ["admin", "行政"]
+    profile = get_cached_profile(sb, user_id)
+    is_admin = bool(profile) and profile.get("role") in _ADMIN_ROLES
     
     # Query assets - 回归私有库模式：用户仅能查看自己的存证记录
-    print(f"DEBUG: Listing assets for user_id={user_id}, is_admin={is_admin}")
+    logger.debug("Listing assets for user_id=%s, is_admin=%s", user_id, is_admin)
     
     if is_admin:
         assets_res = sb.table("watermarked_assets").select("*").order("created_at", desc=True).limit(limit).execute()
@@ -1302,7 +1460,7 @@ def list_my_assets(
         assets_res = sb.table("watermarked_assets").select("*").eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
     
     assets = assets_res.data or []
-    print(f"DEBUG: Found {len(assets)} assets in DB")
+    logger.debug("Found %d assets in DB", len(assets))
     
     # Rename fields for frontend consistency if needed, but mainly ensure URL logic
     for a in assets:
@@ -1336,8 +1494,8 @@ def get_dashboard_stats(username: Optional[str] = Depends(get_optional_user)) ->
         return {"total_assets": 0, "active_monitors": 0, "total_infringements": 0, "total_authors": 1}
     
     # Check if admin - 使用 id (UUID) 查询
-    user_res = sb.table("profiles").select("role").eq("id", username).execute()
-    is_admin = user_res.data and user_res.data[0].get("role") in ["admin", "行政"]
+    profile = get_cached_profile(sb, username)
+    is_admin = bool(profile) and profile.get("role") in _ADMIN_ROLES
     
     if is_admin:
         # Get real stats from Supabase
@@ -1368,8 +1526,8 @@ def get_recent_activity(username: Optional[str] = Depends(get_optional_user)):
     is_admin = False
     if username:
         # 使用 id (UUID) 查询 profiles 表
-        user_res = sb.table("profiles").select("role").eq("id", username).execute()
-        is_admin = user_res.data and user_res.data[0].get("role") in ["admin", "行政"]
+        profile = get_cached_profile(sb, username)
+        is_admin = bool(profile) and profile.get("role") in _ADMIN_ROLES
     
     assets_res = (
         sb.table("watermarked_assets")
@@ -1402,7 +1560,6 @@ def get_recent_activity(username: Optional[str] = Depends(get_optional_user)):
     # 始终添加模拟数据以增强“全网监测”氛围
     if len(assets) < 15:
         import random
-        from datetime import datetime, timedelta
         fake_assets = []
         current_time = datetime.now()
         user_pool = ["u8821***", "art_flow***", "pixel_ma***"]
@@ -1410,7 +1567,7 @@ def get_recent_activity(username: Optional[str] = Depends(get_optional_user)):
         for i in range(10 - len(assets)):
             fake_assets.append({
                 "id": f"fake_{i}",
-                "filename": "私密资产_" + datetime.now().strftime('%H%M%S'),
+                "filename": "私密资产_" + current_time.strftime('%H%M%S'),
                 "user_id": random.choice(user_pool),
                 "timestamp": (current_time - timedelta(minutes=random.randint(2, 300))).strftime("%Y-%m-%d %H:%M:%S"),
                 "fingerprint": "hash_" + os.urandom(8).hex()[:12] + "...",
@@ -1513,8 +1670,8 @@ async def generate_dmca_notice(req: DMCARequest, user_id: Optional[str] = Depend
     
     # 管理员检查
     try:
-        user_res = sb.table("profiles").select("role").eq("id", user_id).execute()
-        is_admin = user_res.data and user_res.data[0].get("role") in ["admin", "行政"]
+        profile = get_cached_profile(sb, user_id)
+        is_admin = bool(profile) and profile.get("role") in _ADMIN_ROLES
     except Exception as e:
         logger.error(f"[DMCA] 检查管理员管失败: {e}")
         is_admin = False
@@ -1600,8 +1757,8 @@ def anchor_asset(asset_id: str, user_id: Optional[str] = Depends(get_optional_us
     asset = asset_res.data[0]
     
     # Check if admin - 使用 id (UUID) 查询
-    user_res = sb.table("profiles").select("role").eq("id", user_id).execute()
-    is_admin = user_res.data and user_res.data[0].get("role") in ["admin", "行政"]
+    profile = get_cached_profile(sb, user_id)
+    is_admin = bool(profile) and profile.get("role") in _ADMIN_ROLES
     
     if asset['user_id'] != user_id and not is_admin:
         raise HTTPException(status_code=403, detail="Forbidden")
@@ -1668,18 +1825,16 @@ async def generate_detection_report(
         raise HTTPException(status_code=401, detail="请登录后使用报告生成功能")
     
     try:
-        from app.service.report_service import ReportService
-
         # 获取用户信息以检查套餐等级（AI 报告：个人版及以上）
         sb = get_supabase_service_client()
         user_plan = "free"
         user_role = "user"
         if sb:
             try:
-                user_res = sb.table("profiles").select("plan, role").eq("id", user_id).execute()
-                if user_res.data:
-                    user_plan = user_res.data[0].get("plan", "free")
-                    user_role = user_res.data[0].get("role", "user")
+                profile = get_cached_profile(sb, user_id)
+                if profile:
+                    user_plan = profile.get("plan", "free")
+                    user_role = profile.get("role", "user")
             except Exception:
                 pass
         
@@ -1759,8 +1914,6 @@ async def detect_watermark_with_report(
         # 2. 如果请求生成报告
         if generate_report and detection_result.get("success"):
             try:
-                from app.service.report_service import ReportService
-                
                 if report_format == "ai":
                     # AI分析报告
                     ai_report = await ReportService.generate_ai_analysis_report(
@@ -1820,10 +1973,10 @@ async def export_report(
     user_role = "user"
     if sb:
         try:
-            user_res = sb.table("profiles").select("plan, role").eq("id", user_id).execute()
-            if user_res.data:
-                user_plan = user_res.data[0].get("plan", "free")
-                user_role = user_res.data[0].get("role", "user")
+            profile = get_cached_profile(sb, user_id)
+            if profile:
+                user_plan = profile.get("plan", "free")
+                user_role = profile.get("role", "user")
         except:
             pass
 
@@ -2325,7 +2478,6 @@ async def quick_analysis(
         ai_report = None
         if detection_result.get("has_watermark"):
             try:
-                from app.service.report_service import ReportService
                 ai_report = await ReportService.generate_ai_analysis_report(
                     detection_result=detection_result,
                     image_filename=image.filename
@@ -2587,13 +2739,9 @@ async def submit_async_detection(
         raise HTTPException(status_code=401, detail="请登录后使用")
     
     try:
-        import tempfile
-        import os
-
+        # 大文件按块落盘（线程池中执行），不整体读入内存也不阻塞事件循环
         suffix = os.path.splitext(file.filename or "")[1] or ".bin"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
+        tmp_path = await run_in_threadpool(_save_upload_to_temp, file, suffix)
 
         task_id = task_queue.submit_task(
             user_id=user_id,
@@ -2634,8 +2782,8 @@ async def get_task_status(
     if task.user_id != user_id:
         sb = get_supabase_service_client()
         if sb:
-            user_res = sb.table("profiles").select("role").eq("id", user_id).execute()
-            is_admin = user_res.data and user_res.data[0].get("role") in ["admin", "行政"]
+            profile = get_cached_profile(sb, user_id)
+            is_admin = bool(profile) and profile.get("role") in _ADMIN_ROLES
             if not is_admin:
                 raise HTTPException(status_code=403, detail="无权查看他人任务")
     
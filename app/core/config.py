@@ -27,6 +27,12 @@ class Settings(BaseSettings):
     SUPABASE_URL: str = os.environ.get("SUPABASE_URL", "")
     SUPABASE_KEY: str = os.environ.get("SUPABASE_KEY", "")
     SUPABASE_SERVICE_ROLE_KEY: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+
+    # Admin API：设置后管理接口需额外携带 X-Admin-Secret 请求头
+    ADMIN_API_SECRET: str = os.environ.get("ADMIN_API_SECRET", "")
+
+    # Redis：设置后管理后台统计缓存在多个 worker 间共享（未设置则仅用进程内缓存）
+    REDIS_URL: str = os.environ.get("REDIS_URL", "")
     
     # CORS - 从环境变量读取，逗号分隔多个域名（在 app/main.py 中 split 解析，避免 pydantic 解析 List 时在某些平台报错）
     BACKEND_CORS_ORIGINS: str = os.environ.get(
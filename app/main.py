@@ -7,6 +7,9 @@ from datetime import datetime
 from app.core.config import settings
 from app.api.endpoints import auth, users, watermark, pay, admin
 from app.service.task_queue import start_task_queue, stop_task_queue
+from app.utils.supabase import get_supabase_http_client, close_supabase_http_client
+from app.utils.stats_cache import close_stats_cache
+from app.utils.responses import DEFAULT_RESPONSE_CLASS
 
 # Ensure directories exist
 os.makedirs("outputs", exist_ok=True)
@@ -17,6 +20,8 @@ app = FastAPI(
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     description="AIGC Content Protection Platform (Supabase Cloud Version)",
     version="1.0.0",
+    # 所有路由的默认 JSON 响应类：旧版 FastAPI 用 orjson，新版保持 pydantic-core 直出（见 app/utils/responses.py）
+    default_response_class=DEFAULT_RESPONSE_CLASS,
 )
 
 # CORS
@@ -68,11 +73,15 @@ app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 @app.on_event("startup")
 async def startup_event():
     await start_task_queue()
+    # 共享的 Supabase HTTP 连接池（Auth 校验等），整个进程生命周期复用
+    app.state.supabase_http = get_supabase_http_client()
     
 # 关闭事件：停止任务队列
 @app.on_event("shutdown")
 async def shutdown_event():
     await stop_task_queue()
+    await close_supabase_http_client()
+    await close_stats_cache()
 
 # Frontend
 if os.path.exists("web_app/dist"):
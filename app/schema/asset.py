@@ -48,6 +48,10 @@ class DetectionResult(BaseModel):
     is_historical: Optional[bool] = None
     suggested_action: Optional[str] = None
 
+    # 五维评分报告在后台生成：凭 report_id 轮询 GET /detect/report/{report_id}
+    report_id: Optional[str] = None
+    report_ready: Optional[bool] = None
+
 class Asset(BaseModel):
     id: int | str
     user_id: str
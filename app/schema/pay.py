@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+from typing import Literal
+
+PlanName = Literal["free", "personal", "pro", "enterprise"]
+PaidPlanName = Literal["personal", "pro", "enterprise"]
+Period = Literal["month", "year"]  # 'month' 月付 / 'year' 年付
+
+class UpgradeForm(BaseModel):
+    """支付宝下单表单（免费版无需下单，不在可选套餐内）"""
+    plan: PaidPlanName
+    period: Period
+    username: str
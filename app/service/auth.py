@@ -50,14 +50,9 @@ class AuthService:
             return None
         
         try:
-            # Check if user exists
-            existing = sb.table("profiles").select("id").eq("username", user_in.username).execute()
-            if existing.data:
-                return None
-            
-            # Create user in Supabase
+            # Create user in Supabase（用户名已存在时 ON CONFLICT DO NOTHING 不返回任何行）
             from datetime import datetime, timezone
-            result = sb.table("profiles").insert({
+            result = sb.table("profiles").upsert({
                 "username": user_in.username,
                 "display_name": user_in.display_name or user_in.username.split('@')[0],
                 "role": "user",
@@ -65,7 +60,7 @@ class AuthService:
                 "quota_total": 10,
                 "quota_used": 0,
                 "created_at": datetime.now(timezone.utc).isoformat(),
-            }).execute()
+            }, on_conflict="username", ignore_duplicates=True).execute()
             
             if result.data:
                 return User(**result.data[0])
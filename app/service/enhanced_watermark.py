@@ -406,16 +406,10 @@ class EnhancedWatermarkService:
         # watermark_info 将从数据库匹配结果中获取，而不是从图片中解码
         watermark_info = None
         
-        # 3. 计算pHash
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        temp_path = os.path.join("uploads", f"temp_detect_{timestamp}.jpg")
-        os.makedirs("uploads", exist_ok=True)
-        with open(temp_path, "wb") as f:
-            f.write(file_bytes)
-        
+        # 3. 计算pHash（直接使用已解码的图像，无需落盘再读）
         phash = None
         try:
-            phash = self.matcher.calculate_phash(temp_path)
+            phash = self.matcher.calculate_phash_array(img_cv2)
         except:
             pass
         
@@ -424,10 +418,6 @@ class EnhancedWatermarkService:
         if fingerprint_strength < QUICK_CHECK_THRESHOLD and not watermark_info:
             detection_time = round(time.time() - start_time, 3)
             
-            # 清理临时文件
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
             return {
                 "success": True,
                 "detection_id": f"det_{int(time.time())}_{filename[:20]}",
@@ -602,10 +592,6 @@ class EnhancedWatermarkService:
             "detection_source": detection_source,  # "db_match" | "fingerprint_signal" | "none"
         }
         
-        # 清理临时文件
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        
         return result
     
     def _find_best_match_enhanced(
@@ -0,0 +1,130 @@
+"""
+嵌入 / 检测额度的跨 worker 共享缓存（可选 Redis）
+
+watermark.py 中的额度缓存是进程内 dict，多 worker 部署时每个 worker 的首次请求都要查一次 Supabase。
+这里在进程内缓存之后加一层 Redis：本地未命中 → Redis → Supabase，查到后回写两级。
+- 每个用户一个 hash：quota:{kind}:{user_id} → {used, total, plan}，kind 为 "embed" / "detect"
+- 套餐变更（支付发货 / 续费 / 管理员改套餐）时 delete 清除，避免旧 total 继续拒绝请求
+- 本地查库后的回写（store）不会压低其他 worker 已写入的 used
+- 乐观扣减用 HINCRBY（Lua 中先判断 key 存在，避免过期后生成没有 TTL 的残缺 hash），多个 worker 的计数不会互相覆盖
+- 与 stats_cache 共用同一个 Redis 客户端；未配置 REDIS_URL 时所有函数直接返回 None，行为与之前一致
+- Redis 任何异常都只记录日志并当作未命中，不影响接口可用性
+"""
+import logging
+from typing import Optional
+
+from app.utils.stats_cache import get_redis
+
+logger = logging.getLogger("app")
+
+_KEY_PREFIX = "quota"
+
+# 回写：key 不存在时整体写入并设置 TTL；已存在时只把 used 抬高到 max(used, n)，
+# total / plan 以已有值为准（HSETNX），也不续期，避免覆盖其他 worker 刚写入的更高已用量
+_STORE_SCRIPT = """
+local created = redis.call('EXISTS', KEYS[1]) == 0
+redis.call('HSETNX', KEYS[1], 'total', ARGV[2])
+redis.call('HSETNX', KEYS[1], 'plan', ARGV[3])
+local cur = tonumber(redis.call('HGET', KEYS[1], 'used'))
+if cur == nil or tonumber(ARGV[1]) > cur then
+  redis.call('HSET', KEYS[1], 'used', ARGV[1])
+end
+if created then
+  redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+return 1
+"""
+
+# key 存在时 used += delta，返回新值；不存在返回 nil
+_INCR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return redis.call('HINCRBY', KEYS[1], 'used', ARGV[1])
+end
+return false
+"""
+
+# key 存在时 used = max(used, n)，返回新值；不存在返回 nil
+_RAISE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  local cur = tonumber(redis.call('HGET', KEYS[1], 'used')) or 0
+  local n = tonumber(ARGV[1])
+  if n > cur then
+    redis.call('HSET', KEYS[1], 'used', n)
+    return n
+  end
+  return cur
+end
+return false
+"""
+
+
+def enabled() -> bool:
+    """是否配置了 Redis；未配置时进程内缓存就是唯一一级（单 worker 部署）"""
+    return get_redis() is not None
+
+
+def _key(kind: str, user_id: str) -> str:
+    return f"{_KEY_PREFIX}:{kind}:{user_id}"
+
+
+async def get(kind: str, user_id: str) -> Optional[dict]:
+    """读取共享额度，返回 {"used": int, "total": int, "plan": str}；未命中或 Redis 不可用返回 None"""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        raw = await client.hgetall(_key(kind, user_id))
+        if not raw or "used" not in raw or "total" not in raw:
+            return None
+        return {"used": int(raw["used"]), "total": int(raw["total"]), "plan": raw.get("plan") or "free"}
+    except Exception as e:
+        logger.warning(f"Quota cache read failed ({kind}:{user_id}): {e}")
+        return None
+
+
+async def store(kind: str, user_id: str, used: int, total: int, plan: str, ttl: int) -> None:
+    """回写共享额度：不存在时写入并设置过期时间；已存在时 used 只增不减，total / plan 不覆盖"""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        await client.eval(_STORE_SCRIPT, 1, _key(kind, user_id), int(used), int(total), plan or "free", int(ttl))
+    except Exception as e:
+        logger.warning(f"Quota cache write failed ({kind}:{user_id}): {e}")
+
+
+async def delete(kind: str, user_id: str) -> None:
+    """删除共享额度（套餐变更后调用，下次请求重新查 Supabase）"""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        await client.delete(_key(kind, user_id))
+    except Exception as e:
+        logger.warning(f"Quota cache delete failed ({kind}:{user_id}): {e}")
+
+
+async def incr(kind: str, user_id: str, delta: int = 1) -> Optional[int]:
+    """乐观扣减：共享缓存存在时原子 used += delta，返回新值；不存在或 Redis 不可用返回 None"""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        value = await client.eval(_INCR_SCRIPT, 1, _key(kind, user_id), int(delta))
+        return int(value) if value is not None else None
+    except Exception as e:
+        logger.warning(f"Quota cache incr failed ({kind}:{user_id}): {e}")
+        return None
+
+
+async def raise_used(kind: str, user_id: str, used: int) -> Optional[int]:
+    """用落库后的已用量向上修正共享缓存（只增不减，保留其他 worker 尚未落库的乐观计数）"""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        value = await client.eval(_RAISE_SCRIPT, 1, _key(kind, user_id), int(used))
+        return int(value) if value is not None else None
+    except Exception as e:
+        logger.warning(f"Quota cache update failed ({kind}:{user_id}): {e}")
+        return None
@@ -0,0 +1,36 @@
+"""
+JSON 响应类
+
+旧版 FastAPI 的默认路径是 jsonable_encoder + json.dumps，响应体较大时序列化占比明显，
+改用 orjson 可直接输出 UTF-8 字节。新版 FastAPI 对声明了返回类型的接口会直接由
+pydantic-core 序列化为 JSON 字节（仅在未指定 response_class 时生效），比 orjson 路径更快，
+此时保持默认即可。
+"""
+import inspect
+
+from fastapi.datastructures import Default
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+try:
+    import orjson
+    _ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    _ORJSON_AVAILABLE = False
+
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (datetime / UUID supported natively)."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+# FastAPI 是否已内置返回值直出 JSON 字节的快速路径
+_FASTAPI_DUMPS_JSON = "dump_json" in inspect.signature(serialize_response).parameters
+
+# 供 FastAPI(...) / APIRouter(default_response_class=...) 使用
+DEFAULT_RESPONSE_CLASS = (
+    ORJSONResponse if _ORJSON_AVAILABLE and not _FASTAPI_DUMPS_JSON else Default(JSONResponse)
+)
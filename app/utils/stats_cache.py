@@ -0,0 +1,114 @@
+"""
+管理后台统计数据缓存（进程内 + 可选 Redis 两级）
+
+查找顺序：进程内缓存 → Redis → fetch_fn()，取到后回写两级缓存。
+- 进程内缓存 TTL 较短，只用于吸收同一 worker 的重复刷新
+- Redis 在多个 worker 之间共享同一份结果；未配置 REDIS_URL 或未安装 redis 时自动跳过
+- Redis 任何异常都只记录日志并回退到直接查询，不影响接口可用性
+"""
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from app.core.config import settings
+
+try:
+    import redis.asyncio as aioredis
+    _REDIS_AVAILABLE = True
+except ImportError:
+    aioredis = None
+    _REDIS_AVAILABLE = False
+
+logger = logging.getLogger("app")
+
+_LOCAL_CACHE_TTL = 15  # 秒，进程内缓存上限（不超过调用方给的 ttl）
+
+_local_cache: dict = {}  # {key: {"value": Any, "expires": float}}
+_redis_client = None
+
+
+def get_redis():
+    """Return the shared async Redis client (singleton), or None if not configured."""
+    global _redis_client
+    if _redis_client is not None:
+        return _redis_client
+    if not _REDIS_AVAILABLE or not settings.REDIS_URL:
+        return None
+    try:
+        _redis_client = aioredis.from_url(
+            settings.REDIS_URL,
+            decode_responses=True,
+            socket_timeout=0.5,
+            socket_connect_timeout=0.5,
+        )
+    except Exception as e:
+        logger.warning(f"Redis cache disabled: {e}")
+        return None
+    return _redis_client
+
+
+async def get_or_set(key: str, ttl: int, fetch_fn: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    读取缓存，未命中时调用 fetch_fn 并回写
+
+    Args:
+        key: 缓存键（调用方负责把查询参数编码进键）
+        ttl: Redis 中的过期秒数；进程内缓存取 min(ttl, 15)
+        fetch_fn: 无参协程函数，返回可 JSON 序列化的结果
+
+    Returns:
+        缓存或新查询的结果
+    """
+    now = time.time()
+    entry = _local_cache.get(key)
+    if entry and entry["expires"] > now:
+        return entry["value"]
+
+    client = get_redis()
+    if client is not None:
+        try:
+            raw = await client.get(key)
+            if raw is not None:
+                value = json.loads(raw)
+                _local_cache[key] = {"value": value, "expires": now + min(ttl, _LOCAL_CACHE_TTL)}
+                return value
+        except Exception as e:
+            logger.warning(f"Redis cache read failed ({key}): {e}")
+
+    value = await fetch_fn()
+
+    _local_cache[key] = {"value": value, "expires": time.time() + min(ttl, _LOCAL_CACHE_TTL)}
+    if client is not None:
+        try:
+            await client.set(key, json.dumps(value, ensure_ascii=False, default=str), ex=ttl)
+        except Exception as e:
+            logger.warning(f"Redis cache write failed ({key}): {e}")
+    return value
+
+
+async def invalidate(prefix: str) -> None:
+    """清除以 prefix 开头的缓存（本进程 + Redis；其他 worker 的进程内缓存最多再保留 15 秒）"""
+    for k in [k for k in _local_cache if k.startswith(prefix)]:
+        _local_cache.pop(k, None)
+
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        keys = [k async for k in client.scan_iter(match=f"{prefix}*", count=100)]
+        if keys:
+            await client.delete(*keys)
+    except Exception as e:
+        logger.warning(f"Redis cache invalidate failed ({prefix}): {e}")
+
+
+async def close_stats_cache() -> None:
+    """Close the Redis client (called on app shutdown)."""
+    global _redis_client
+    if _redis_client is not None:
+        try:
+            await _redis_client.aclose()
+        except Exception:
+            pass
+        _redis_client = None
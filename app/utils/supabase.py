@@ -1,12 +1,55 @@
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from app.core.config import settings
+import httpx
+import inspect
 import logging
 
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
 logger = logging.getLogger("app")
 
+# 旧版 supabase-py 的 ClientOptions 不支持传入自定义 httpx.Client
+_CLIENT_OPTIONS_ACCEPTS_HTTPX = "httpx_client" in inspect.signature(ClientOptions).parameters
+
+# ---- 连接池参数 ----
+# 同步客户端由线程池中的接口/后台任务并发使用（anyio 默认 40 个线程），空闲连接上限需覆盖这个并发，
+# 否则高峰后多出的连接被关闭、下一波请求重新握手；httpx 默认 5 秒即回收空闲连接，
+# 低流量时几乎每次跨区域请求都要重新 TCP/TLS 握手，这里延长到 60 秒
+_POOL_LIMITS = httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60.0)
+
 # ---- 单例缓存：避免每次调用都重新创建 Supabase 客户端 ----
 _cached_client: Client = None
 _cached_service_client: Client = None
+_cached_http_client: httpx.AsyncClient = None
+_cached_sync_http_client: httpx.Client = None
+
+
+def _get_sync_http_client() -> httpx.Client:
+    """Shared httpx.Client for the supabase-py clients (singleton).
+
+    PostgREST / Storage / Auth of both the anon and the service client send their
+    own URL and headers per request, so one pool with explicit limits serves them all.
+    Timeout keeps PostgREST's default (120s).
+    """
+    global _cached_sync_http_client
+    if _cached_sync_http_client is None:
+        _cached_sync_http_client = httpx.Client(
+            timeout=120.0,
+            follow_redirects=True,
+            http2=_HTTP2_AVAILABLE,
+            limits=_POOL_LIMITS,
+        )
+    return _cached_sync_http_client
+
+
+def _client_options():
+    if not _CLIENT_OPTIONS_ACCEPTS_HTTPX:
+        return None
+    return ClientOptions(httpx_client=_get_sync_http_client())
 
 
 def get_supabase_client() -> Client:
@@ -19,7 +62,7 @@ def get_supabase_client() -> Client:
         logger.warning("Supabase credentials missing in environment variables.")
         return None
     try:
-        _cached_client = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+        _cached_client = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY, options=_client_options())
         return _cached_client
     except Exception as e:
         logger.error(f"Failed to initialize Supabase client: {e}")
@@ -44,8 +87,40 @@ def get_supabase_service_client() -> Client:
     try:
         if not settings.SUPABASE_SERVICE_ROLE_KEY:
             logger.warning("SUPABASE_SERVICE_ROLE_KEY missing, falling back to SUPABASE_KEY.")
-        _cached_service_client = create_client(url, key)
+        _cached_service_client = create_client(url, key, options=_client_options())
         return _cached_service_client
     except Exception as e:
         logger.error(f"Failed to initialize Supabase service client: {e}")
         return None
+
+
+def get_supabase_http_client() -> httpx.AsyncClient:
+    """Return a shared AsyncClient bound to SUPABASE_URL (singleton).
+
+    Reusing one client keeps TCP/TLS connections to Supabase alive across
+    requests instead of paying a fresh handshake for every Auth call.
+    HTTP/2 is enabled when h2 is installed so concurrent calls share one connection.
+    """
+    global _cached_http_client
+    if _cached_http_client is not None and not _cached_http_client.is_closed:
+        return _cached_http_client
+
+    if not settings.SUPABASE_URL:
+        logger.warning("Supabase credentials missing in environment variables.")
+        return None
+
+    _cached_http_client = httpx.AsyncClient(
+        base_url=settings.SUPABASE_URL.rstrip("/"),
+        timeout=8.0,
+        http2=_HTTP2_AVAILABLE,
+        limits=_POOL_LIMITS,
+    )
+    return _cached_http_client
+
+
+async def close_supabase_http_client() -> None:
+    """Close the shared AsyncClient (called on app shutdown)."""
+    global _cached_http_client
+    if _cached_http_client is not None:
+        await _cached_http_client.aclose()
+        _cached_http_client = None
@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.schedules import crontab
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
 
@@ -17,4 +18,11 @@ celery_app.conf.update(
     timezone="Asia/Shanghai",
     enable_utc=True,
     worker_concurrency=4,  # Adjust for CPU bound watermark tasks
+    beat_schedule={
+        # 每小时整点批量降级过期订阅（需同时运行 celery beat）
+        "downgrade-expired-subscriptions": {
+            "task": "app.workers.tasks.downgrade_expired_subscriptions",
+            "schedule": crontab(minute=0),
+        },
+    },
 )
@@ -5,19 +5,24 @@ from datetime import datetime
 from app.workers.celery_app import celery_app
 from app.service.watermark import WatermarkService
 from app.utils.supabase import get_supabase_service_client
-import base64
 
 logger = logging.getLogger("celery.task")
 
+# 批量任务的上传暂存目录：API 进程写入，worker 读取后删除（多机部署时需指向共享卷）
+BATCH_INCOMING_DIR = os.environ.get("BATCH_INCOMING_DIR", os.path.abspath(os.path.join("outputs", "incoming")))
+
 @celery_app.task(bind=True, max_retries=3)
-def process_watermark_batch(self, b64_files: list, filenames: list, user_id: str, author_name: str, strength: float):
+def process_watermark_batch(self, file_paths: list, filenames: list, user_id: str, author_name: str, strength: float):
     """
     处理大批量图片打水印任务
+
+    file_paths 为 BATCH_INCOMING_DIR 下的暂存文件（消息里只传路径，不再传 base64 内容），处理完即删除
     """
     results = []
     sb = None
     embed_used = 0
     embed_total = 0
+    embedded = 0
     assets_to_insert = []
     
     logger.info(f"====== 开始执行批量水印任务: {len(filenames)} 张图 by user: {user_id} ======")
@@ -38,15 +43,16 @@ def process_watermark_batch(self, b64_files: list, filenames: list, user_id: str
                 embed_used = _safe_int(user_data.get("quota_embed_used"), _safe_int(user_data.get("quota_used"), 0))
                 embed_total = _safe_int(user_data.get("quota_embed_total"), 50)
 
-    for i, b64_str in enumerate(b64_files):
+    for i, file_path in enumerate(file_paths):
         filename = filenames[i]
         try:
             if user_id != "guest" and sb and embed_total > 0 and embed_used >= embed_total:
                 logger.warning(f"Quota exceeded for {user_id} on {filename}")
                 results.append({"filename": filename, "status": "failed", "error": "额度不足"})
                 continue
-                    
-            file_bytes = base64.b64decode(b64_str)
+
+            with open(file_path, "rb") as f:
+                file_bytes = f.read()
             res = WatermarkService.embed_watermark(
                 file_bytes=file_bytes,
                 filename=filename,
@@ -74,6 +80,7 @@ def process_watermark_batch(self, b64_files: list, filenames: list, user_id: str
                     "asset_type": "image"
                 })
                 embed_used += 1
+                embedded += 1
 
             results.append({
                 "filename": filename,
@@ -85,6 +92,11 @@ def process_watermark_batch(self, b64_files: list, filenames: list, user_id: str
         except Exception as e:
             logger.error(f"Failed processing {filename}: {e}")
             results.append({"filename": filename, "status": "failed", "error": str(e)})
+        finally:
+            try:
+                os.unlink(file_path)
+            except OSError:
+                pass
 
     if user_id != "guest" and sb:
         if assets_to_insert:
@@ -92,14 +104,27 @@ def process_watermark_batch(self, b64_files: list, filenames: list, user_id: str
             for j in range(0, len(assets_to_insert), chunk_size):
                 sb.table("watermarked_assets").insert(assets_to_insert[j:j + chunk_size]).execute()
 
-        if embed_total > 0:
-            sb.table("profiles").update({
-                "quota_embed_used": embed_used,
-                "quota_used": embed_used,
-            }).eq("id", user_id).execute()
+        if embedded:
+            # 原子自增（见 supabase_migration_quota_increment_rpc.sql），任务执行期间的其他嵌入不会被覆盖
+            sb.rpc("increment_quota_embed", {"p_user_id": user_id, "p_delta": embedded}).execute()
 
     return results
 
+@celery_app.task
+def downgrade_expired_subscriptions():
+    """
+    订阅到期降级（celery beat 定时执行，见 celery_app.beat_schedule）
+
+    一次 RPC 批量降级所有已过期的 active 订阅；嵌入/检测接口只信任 plan 字段，不再逐请求判断到期
+    """
+    sb = get_supabase_service_client()
+    if not sb:
+        return 0
+    count = sb.rpc("downgrade_expired_subscriptions", {}).execute().data or 0
+    if count:
+        logger.info(f"已将 {count} 个过期订阅降级为免费版")
+    return count
+
 @celery_app.task
 def run_infringement_crawler(target_keyword: str, platform: str = "all"):
     """
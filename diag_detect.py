@@ -67,12 +67,12 @@ print(f"新嵌入提取后指纹强度: {strength_new}")
 # 先看看 block_positions 数量
 h, w = img.shape[:2]
 bs = 8
-positions = engine._block_positions(h, w, bs, 256)
+rows, cols = engine._block_positions(h, w, bs, 256)
 print(f"\n=== 块位置分析 ===")
 print(f"图像: {h}x{w}, 块大小: {bs}")
-print(f"请求 256 个块, 实际可用: {len(positions)}")
-if len(positions) < 256:
-    print(f"⚠️ 块数不足! 只有 {len(positions)} 个块，需要 256 个块才能提取完整指纹")
+print(f"请求 256 个块, 实际可用: {len(rows)}")
+if len(rows) < 256:
+    print(f"⚠️ 块数不足! 只有 {len(rows)} 个块，需要 256 个块才能提取完整指纹")
 
 # 7. 尝试不同的 QIM_STEP 提取
 print(f"\n=== QIM_STEP 敏感性测试 ===")
@@ -0,0 +1,32 @@
+-- 管理后台分页查询的复合索引（增量更新，可重复执行）
+-- 对应查询形如：.eq("user_id", ...).order("created_at", desc=True).range(...)
+-- 有了 (过滤列, created_at DESC) 索引，分页由顺序扫描变为索引扫描，行数增长后仍保持稳定
+
+-- 资产：/admin/users/{id}/assets、时间线
+CREATE INDEX IF NOT EXISTS ix_wa_user_created
+ON public.watermarked_assets (user_id, created_at DESC);
+
+-- 资产按类型筛选：/admin/users/{id}/assets?asset_type=...
+CREATE INDEX IF NOT EXISTS ix_wa_user_type_created
+ON public.watermarked_assets (user_id, asset_type, created_at DESC);
+
+-- 资产全局列表：/admin/assets、/admin/summary
+CREATE INDEX IF NOT EXISTS ix_wa_created
+ON public.watermarked_assets (created_at DESC);
+
+-- 检测记录：(user_id, created_at DESC) 已由 scripts/create_detection_records_table.sql 创建
+-- 按是否命中筛选：/admin/users/{id}/detection-records?has_watermark=...
+CREATE INDEX IF NOT EXISTS ix_dr_user_hw_created
+ON public.detection_records (user_id, has_watermark, created_at DESC);
+
+-- 侵权举报：/admin/users/{id}/infringement-reports、时间线
+CREATE INDEX IF NOT EXISTS ix_ir_reporter_created
+ON public.infringement_reports (reporter_id, created_at DESC);
+
+-- 用户列表：/admin/summary 按注册时间取最新用户
+CREATE INDEX IF NOT EXISTS ix_profiles_created
+ON public.profiles (created_at DESC);
+
+-- 执行后可用 EXPLAIN ANALYZE 确认走索引，例如：
+-- EXPLAIN ANALYZE SELECT id FROM public.watermarked_assets
+--   WHERE user_id = '<uuid>' ORDER BY created_at DESC LIMIT 20 OFFSET 0;
@@ -0,0 +1,46 @@
+-- 管理后台摘要 RPC：一次调用返回用户数、资产数、最新用户、最新资产（含上传者）
+-- 后端调用：sb.rpc("admin_summary", {"_limit_users": 10, "_limit_assets": 10})
+-- 字段与 admin.py 中 PROFILE_LIST_COLS / ASSET_LIST_COLS 保持一致
+
+CREATE OR REPLACE FUNCTION public.admin_summary(_limit_users INT DEFAULT 10, _limit_assets INT DEFAULT 10)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT jsonb_build_object(
+    'users_count', (SELECT count(*) FROM public.profiles),
+    'assets_count', (SELECT count(*) FROM public.watermarked_assets),
+    'users', COALESCE((
+      SELECT jsonb_agg(u ORDER BY u.created_at DESC)
+      FROM (
+        SELECT id, username, display_name, role, plan, quota_used, quota_total,
+               subscription_status, subscription_expires_at, created_at
+        FROM public.profiles
+        ORDER BY created_at DESC
+        LIMIT _limit_users
+      ) u
+    ), '[]'::jsonb),
+    'assets', COALESCE((
+      SELECT jsonb_agg(a ORDER BY a.created_at DESC)
+      FROM (
+        SELECT w.id, w.user_id, w.filename, w.asset_type, w.created_at, w.output_path,
+               w.fingerprint, w.timestamp, w.psnr, w.tx_hash,
+               CASE WHEN p.id IS NULL THEN NULL
+                    ELSE jsonb_build_object('username', p.username, 'display_name', p.display_name)
+               END AS uploader
+        FROM public.watermarked_assets w
+        LEFT JOIN public.profiles p ON p.id = w.user_id
+        ORDER BY w.created_at DESC
+        LIMIT _limit_assets
+      ) a
+    ), '[]'::jsonb)
+  );
+$$;
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.admin_summary(INT, INT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.admin_summary(INT, INT) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,70 @@
+-- 管理员调整套餐 RPC：在同一事务内 SELECT ... FOR UPDATE 并更新，返回更新后的 profiles 行
+-- 后端调用：sb.rpc("admin_update_user_plan", {"_uid": ..., "_plan": ..., "_period": ...})
+-- 规则与原 admin.py update_user_plan 一致：
+--   - 仅在显式传入 month/year 时续费/顺延；未到期的 active 订阅在原到期时间基础上延长
+--   - 额度 total 取套餐额度与已用量的较大值
+--   - free 套餐清除订阅信息
+-- 用户不存在时返回 NULL
+
+CREATE OR REPLACE FUNCTION public.admin_update_user_plan(_uid UUID, _plan TEXT, _period TEXT DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  _row public.profiles%ROWTYPE;
+  _now TIMESTAMPTZ := NOW();
+  _effective_period TEXT := CASE WHEN _period IN ('month', 'year') THEN _period ELSE NULL END;
+  _base TIMESTAMPTZ;
+  _expires TIMESTAMPTZ := NULL;
+  _quota_total INT := CASE _plan WHEN 'free' THEN 10 WHEN 'personal' THEN 500 WHEN 'pro' THEN 2000 WHEN 'enterprise' THEN 9999999 ELSE 10 END;
+  _embed_total INT := CASE _plan WHEN 'free' THEN 50 WHEN 'personal' THEN 500 WHEN 'pro' THEN 2000 WHEN 'enterprise' THEN 9999999 ELSE 50 END;
+  _detect_total INT := CASE _plan WHEN 'free' THEN 20 WHEN 'personal' THEN 200 WHEN 'pro' THEN 1000 WHEN 'enterprise' THEN 9999999 ELSE 20 END;
+BEGIN
+  SELECT * INTO _row FROM public.profiles WHERE id = _uid FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  IF _effective_period IS NOT NULL AND _plan <> 'free' THEN
+    _base := _now;
+    IF _row.subscription_status = 'active' AND _row.subscription_expires_at > _now THEN
+      _base := _row.subscription_expires_at;
+    END IF;
+    _expires := _base + CASE WHEN _effective_period = 'month' THEN INTERVAL '30 days' ELSE INTERVAL '365 days' END;
+  END IF;
+
+  UPDATE public.profiles SET
+    plan = _plan,
+    quota_total = GREATEST(_quota_total, COALESCE(_row.quota_used, 0)),
+    quota_embed_total = GREATEST(_embed_total, COALESCE(_row.quota_embed_used, 0)),
+    quota_detect_total = GREATEST(_detect_total, COALESCE(_row.quota_detect_used, 0)),
+    subscription_period = CASE
+      WHEN _plan = 'free' THEN NULL
+      WHEN _effective_period IS NOT NULL THEN _effective_period
+      ELSE subscription_period END,
+    subscription_status = CASE
+      WHEN _plan = 'free' THEN 'inactive'
+      WHEN _effective_period IS NOT NULL THEN 'active'
+      ELSE subscription_status END,
+    subscription_started_at = CASE
+      WHEN _plan = 'free' THEN NULL
+      WHEN _effective_period IS NOT NULL THEN _now
+      ELSE subscription_started_at END,
+    subscription_expires_at = CASE
+      WHEN _plan = 'free' THEN NULL
+      WHEN _expires IS NOT NULL THEN _expires
+      ELSE subscription_expires_at END
+  WHERE id = _uid
+  RETURNING * INTO _row;
+
+  RETURN to_jsonb(_row);
+END;
+$$;
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.admin_update_user_plan(UUID, TEXT, TEXT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.admin_update_user_plan(UUID, TEXT, TEXT) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
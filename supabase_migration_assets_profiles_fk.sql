@@ -0,0 +1,18 @@
+-- watermarked_assets.user_id 增加指向 profiles.id 的外键（增量更新，不会丢失现有数据）
+-- 用途：PostgREST 可直接嵌入上传者信息，管理后台一次查询即可拿到
+--       select("..., uploader:profiles(username, display_name)")
+-- profiles.id 与 auth.users.id 一一对应，原有指向 auth.users 的外键保持不变
+
+ALTER TABLE public.watermarked_assets
+DROP CONSTRAINT IF EXISTS watermarked_assets_user_id_profiles_fkey;
+
+ALTER TABLE public.watermarked_assets
+ADD CONSTRAINT watermarked_assets_user_id_profiles_fkey
+FOREIGN KEY (user_id) REFERENCES public.profiles(id) ON DELETE CASCADE
+NOT VALID;  -- 不扫描历史数据，避免长时间锁表
+
+-- 可在低峰期补做校验
+-- ALTER TABLE public.watermarked_assets VALIDATE CONSTRAINT watermarked_assets_user_id_profiles_fkey;
+
+-- 刷新 PostgREST schema 缓存，使新关系立即可用于嵌入查询
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,90 @@
+-- 额度检查 + 扣减 RPC：一个事务内完成 锁定 → 到期降级 → 套餐上限纠偏 → 额度判断 → 已用量 +1
+-- 替代文本/视频嵌入与检测接口中 "SELECT profiles → (UPDATE total) → 处理 → increment_quota_*" 的多次往返，
+-- 并发请求在 FOR UPDATE 上排队，不会同时通过 used < total 的判断
+-- 后端调用（app/api/endpoints/watermark.py _consume_quota）：
+--   sb.rpc("check_and_consume_quota", {"p_user_id": ..., "p_kind": "embed" | "detect",
+--                                     "p_plan_totals": {"free": 50, ...}, "p_default_total": 50})
+-- 返回 {"allowed": bool, "reason": "ok" | "exhausted" | "no_profile", "used": int, "total": int, "plan": text}
+--   - allowed = true 时已扣减，used 为扣减后的值；处理失败时由后端调用 increment_quota_*(p_delta => -1) 退回
+--   - 用户 profiles 行不存在时不限制（与原逻辑一致），reason = 'no_profile'
+
+CREATE OR REPLACE FUNCTION public.check_and_consume_quota(
+  p_user_id UUID,
+  p_kind TEXT,
+  p_plan_totals JSONB DEFAULT '{}'::jsonb,
+  p_default_total INT DEFAULT 0
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  _row public.profiles%ROWTYPE;
+  _plan TEXT;
+  _total INT;
+  _used INT;
+BEGIN
+  IF p_kind NOT IN ('embed', 'detect') THEN
+    RAISE EXCEPTION 'invalid quota kind: %', p_kind;
+  END IF;
+
+  SELECT * INTO _row FROM public.profiles WHERE id = p_user_id FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN jsonb_build_object('allowed', true, 'reason', 'no_profile');
+  END IF;
+
+  -- 订阅已过期但定时降级任务尚未执行：就地降级（内容与 downgrade_expired_subscriptions 一致）
+  IF _row.subscription_status = 'active' AND _row.subscription_expires_at < NOW() THEN
+    UPDATE public.profiles SET
+      plan = 'free',
+      quota_total = 10,
+      quota_embed_total = 50,
+      quota_detect_total = 20,
+      subscription_status = 'expired',
+      subscription_period = NULL,
+      subscription_expires_at = NULL
+    WHERE id = p_user_id
+    RETURNING * INTO _row;
+  END IF;
+
+  _plan := COALESCE(_row.plan, 'free');
+  _total := COALESCE((p_plan_totals ->> _plan)::INT, p_default_total);
+
+  IF p_kind = 'embed' THEN
+    _used := COALESCE(_row.quota_embed_used, 0);
+    IF _used >= _total THEN
+      IF _row.quota_embed_total IS DISTINCT FROM _total THEN
+        UPDATE public.profiles SET quota_embed_total = _total WHERE id = p_user_id;
+      END IF;
+      RETURN jsonb_build_object('allowed', false, 'reason', 'exhausted', 'used', _used, 'total', _total, 'plan', _plan);
+    END IF;
+    -- quota_used 为旧版合并计数，与 quota_embed_used 保持一致
+    UPDATE public.profiles SET
+      quota_embed_used = _used + 1,
+      quota_used = _used + 1,
+      quota_embed_total = _total
+    WHERE id = p_user_id;
+  ELSE
+    _used := COALESCE(_row.quota_detect_used, 0);
+    IF _used >= _total THEN
+      IF _row.quota_detect_total IS DISTINCT FROM _total THEN
+        UPDATE public.profiles SET quota_detect_total = _total WHERE id = p_user_id;
+      END IF;
+      RETURN jsonb_build_object('allowed', false, 'reason', 'exhausted', 'used', _used, 'total', _total, 'plan', _plan);
+    END IF;
+    UPDATE public.profiles SET
+      quota_detect_used = _used + 1,
+      quota_detect_total = _total
+    WHERE id = p_user_id;
+  END IF;
+
+  RETURN jsonb_build_object('allowed', true, 'reason', 'ok', 'used', _used + 1, 'total', _total, 'plan', _plan);
+END;
+$$;
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.check_and_consume_quota(UUID, TEXT, JSONB, INT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.check_and_consume_quota(UUID, TEXT, JSONB, INT) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,38 @@
+-- 订阅到期批量降级 RPC：一条 UPDATE 把所有已过期的 active 订阅降为免费版，返回降级的用户数
+-- 由 Celery beat 定时调用（app/workers/tasks.py downgrade_expired_subscriptions）；
+-- 图片嵌入/检测接口在额度缓存未命中、且查到的订阅已过期时也会调用一次（未部署 beat 时兜底）
+-- 后端调用：sb.rpc("downgrade_expired_subscriptions", {})
+-- 降级内容与原 watermark.py 中的逐请求降级一致：额度 total 恢复免费版、清除订阅信息，已用量不变
+
+CREATE OR REPLACE FUNCTION public.downgrade_expired_subscriptions()
+RETURNS INT
+LANGUAGE sql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  WITH expired AS (
+    UPDATE public.profiles SET
+      plan = 'free',
+      quota_total = 10,
+      quota_embed_total = 50,
+      quota_detect_total = 20,
+      subscription_status = 'expired',
+      subscription_period = NULL,
+      subscription_expires_at = NULL
+    WHERE subscription_status = 'active'
+      AND subscription_expires_at < NOW()
+    RETURNING 1
+  )
+  SELECT COUNT(*)::INT FROM expired;
+$$;
+
+-- 只索引 active 订阅：定时扫描走索引，不随免费用户数增长
+CREATE INDEX IF NOT EXISTS ix_profiles_active_expires
+ON public.profiles (subscription_expires_at)
+WHERE subscription_status = 'active';
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.downgrade_expired_subscriptions() FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.downgrade_expired_subscriptions() TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,35 @@
+-- 图片下载权限 RPC：一次往返同时返回「是否管理员」与「资产归属」，替代 /api/image 中的两次查询
+-- 后端调用（app/api/endpoints/watermark.py get_image）：
+--   sb.rpc("check_image_access", {"p_user_id": ..., "p_filename": ...})
+-- 返回 {"is_admin": bool, "asset_found": bool, "owner_id": uuid|null}
+
+CREATE OR REPLACE FUNCTION public.check_image_access(p_user_id UUID, p_filename TEXT)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT jsonb_build_object(
+    'is_admin', EXISTS (
+      SELECT 1 FROM public.profiles WHERE id = p_user_id AND role IN ('admin', '行政')
+    ),
+    'asset_found', a.user_id IS NOT NULL,
+    'owner_id', a.user_id
+  )
+  FROM (
+    SELECT (SELECT user_id FROM public.watermarked_assets WHERE filename = p_filename LIMIT 1) AS user_id
+  ) AS a;
+$$;
+
+-- 按文件名查归属：覆盖索引（INCLUDE user_id），归属判断走 index-only scan，不回表
+-- 替换早期版本中只含 filename 的 ix_wa_filename
+DROP INDEX IF EXISTS public.ix_wa_filename;
+CREATE INDEX IF NOT EXISTS ix_wa_filename_user
+ON public.watermarked_assets (filename) INCLUDE (user_id);
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.check_image_access(UUID, TEXT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.check_image_access(UUID, TEXT) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,60 @@
+-- 指纹相似度匹配 RPC：在数据库内计算汉明相似度，只返回最相近的一条资产
+-- 替代 /detect/video 中"拉取全部 watermarked_assets 到后端逐条比对"的写法（传输量随资产数线性增长）
+-- 后端调用（app/api/endpoints/watermark.py detect_video_watermark）：
+--   sb.rpc("match_fingerprint", {"p_fingerprint": <64 位十六进制>, "p_threshold": 0.60})
+-- 相似度 = 1 - 不同位数 / 256，与 FingerprintEngine.fingerprint_similarity 对 64 字符指纹的结果一致
+-- p_fingerprint 必须是 64 位十六进制（后端调用前校验）；依赖 PostgreSQL 14+ 的 bit_count(bit)
+
+-- 256 位指纹的位串形式：由 fingerprint 自动生成，插入/更新资产时无需后端额外写入
+-- 不是 64 位十六进制的指纹（如文本水印的短指纹）为 NULL，不参与比对
+ALTER TABLE public.watermarked_assets
+ADD COLUMN IF NOT EXISTS fingerprint_bits BIT(256)
+GENERATED ALWAYS AS (
+  CASE WHEN fingerprint ~ '^[0-9a-fA-F]{64}$' THEN ('x' || fingerprint)::BIT(256) END
+) STORED;
+
+-- 汉明距离没有可用的 B-tree / GIN 索引；只索引非 NULL 行，扫描时跳过文本等短指纹资产
+CREATE INDEX IF NOT EXISTS ix_wa_fingerprint_bits
+ON public.watermarked_assets (id)
+INCLUDE (fingerprint_bits)
+WHERE fingerprint_bits IS NOT NULL;
+
+-- 返回列有变化时 CREATE OR REPLACE 无法修改，先删除旧版本
+DROP FUNCTION IF EXISTS public.match_fingerprint(TEXT, FLOAT8);
+
+-- author_name 取自 profiles.display_name（LEFT JOIN，作者资料缺失时为 NULL），后端无需再单独查询作者
+CREATE OR REPLACE FUNCTION public.match_fingerprint(p_fingerprint TEXT, p_threshold FLOAT8 DEFAULT 0.60)
+RETURNS TABLE (
+  id BIGINT,
+  user_id UUID,
+  filename TEXT,
+  fingerprint TEXT,
+  "timestamp" TEXT,
+  asset_type TEXT,
+  similarity FLOAT8,
+  author_name TEXT
+)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT a.id, a.user_id, a.filename, a.fingerprint, a."timestamp", a.asset_type, m.similarity, p.display_name
+  FROM (
+    SELECT w.id, 1 - bit_count(w.fingerprint_bits # q.bits)::FLOAT8 / 256 AS similarity
+    FROM public.watermarked_assets w,
+         (SELECT ('x' || p_fingerprint)::BIT(256) AS bits) AS q
+    WHERE w.fingerprint_bits IS NOT NULL
+    ORDER BY bit_count(w.fingerprint_bits # q.bits)
+    LIMIT 1
+  ) AS m
+  JOIN public.watermarked_assets a ON a.id = m.id
+  LEFT JOIN public.profiles p ON p.id = a.user_id
+  WHERE m.similarity >= p_threshold;
+$$;
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.match_fingerprint(TEXT, FLOAT8) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.match_fingerprint(TEXT, FLOAT8) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,108 @@
+-- 支付发货 / 续费 RPC：读取、计算到期时间、写回在同一事务内完成（SELECT ... FOR UPDATE），返回更新后的 profiles 行
+-- 后端调用（app/api/endpoints/pay.py）：
+--   sb.rpc("apply_subscription_upgrade", {"p_plan": ..., "p_period": ..., "p_username": ..., "p_user_id": ...})
+--   sb.rpc("renew_subscription", {"p_user_id": ..., "p_period": ...})
+-- 规则与原 pay.py 中的 Python 实现一致：
+--   - 不重置 quota_used / quota_embed_used / quota_detect_used
+--   - 未到期的 active 订阅在原到期时间基础上顺延，否则从现在开始
+--   - 非 month/year 的周期按 month 处理；free 套餐清除订阅信息
+
+-- 发货：按 p_user_id 或 p_username 定位用户；两者都传时必须属于同一用户（登录用户只能给自己发货）
+-- 用户不存在或不匹配时返回 NULL
+CREATE OR REPLACE FUNCTION public.apply_subscription_upgrade(
+  p_plan TEXT,
+  p_period TEXT DEFAULT NULL,
+  p_username TEXT DEFAULT NULL,
+  p_user_id UUID DEFAULT NULL
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  _row public.profiles%ROWTYPE;
+  _now TIMESTAMPTZ := NOW();
+  _period TEXT := CASE WHEN p_period IN ('month', 'year') THEN p_period ELSE 'month' END;
+  _quota_total INT := CASE p_plan WHEN 'free' THEN 10 WHEN 'personal' THEN 500 WHEN 'pro' THEN 2000 WHEN 'enterprise' THEN 9999999 ELSE 10 END;
+  _embed_total INT := CASE p_plan WHEN 'free' THEN 50 WHEN 'personal' THEN 500 WHEN 'pro' THEN 2000 WHEN 'enterprise' THEN 9999999 ELSE 50 END;
+  _detect_total INT := CASE p_plan WHEN 'free' THEN 20 WHEN 'personal' THEN 200 WHEN 'pro' THEN 1000 WHEN 'enterprise' THEN 9999999 ELSE 20 END;
+BEGIN
+  IF p_user_id IS NULL AND p_username IS NULL THEN
+    RETURN NULL;
+  END IF;
+
+  SELECT * INTO _row FROM public.profiles
+  WHERE (p_user_id IS NULL OR id = p_user_id)
+    AND (p_username IS NULL OR username = p_username)
+  LIMIT 1
+  FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  UPDATE public.profiles SET
+    plan = p_plan,
+    quota_total = _quota_total,
+    quota_embed_total = _embed_total,
+    quota_detect_total = _detect_total,
+    subscription_period = CASE WHEN p_plan = 'free' THEN NULL ELSE _period END,
+    subscription_status = CASE WHEN p_plan = 'free' THEN 'inactive' ELSE 'active' END,
+    subscription_started_at = CASE WHEN p_plan = 'free' THEN NULL ELSE _now END,
+    subscription_expires_at = CASE
+      WHEN p_plan = 'free' THEN NULL
+      -- 未到期的 active 订阅从原到期时间顺延，否则从现在开始（GREATEST 忽略 NULL）
+      ELSE GREATEST(CASE WHEN subscription_status = 'active' THEN subscription_expires_at END, _now)
+        + make_interval(days => CASE WHEN _period = 'year' THEN 365 ELSE 30 END)
+    END
+  WHERE id = _row.id
+  RETURNING * INTO _row;
+
+  RETURN to_jsonb(_row);
+END;
+$$;
+
+-- 续费：保持当前套餐，只顺延订阅；free 套餐不修改，只返回 id/plan（由后端返回 400）
+-- 用户不存在时返回 NULL
+CREATE OR REPLACE FUNCTION public.renew_subscription(p_user_id UUID, p_period TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  _row public.profiles%ROWTYPE;
+  _plan TEXT;
+  _now TIMESTAMPTZ := NOW();
+BEGIN
+  -- 只读取判断所需的 plan；到期时间直接在 UPDATE 中由原值计算
+  SELECT plan INTO _plan
+  FROM public.profiles WHERE id = p_user_id FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  IF COALESCE(_plan, 'free') = 'free' THEN
+    RETURN jsonb_build_object('id', p_user_id, 'plan', COALESCE(_plan, 'free'));
+  END IF;
+
+  UPDATE public.profiles SET
+    subscription_status = 'active',
+    subscription_period = p_period,
+    subscription_started_at = _now,
+    subscription_expires_at = GREATEST(CASE WHEN subscription_status = 'active' THEN subscription_expires_at END, _now)
+      + make_interval(days => CASE WHEN p_period = 'year' THEN 365 ELSE 30 END)
+  WHERE id = p_user_id
+  RETURNING * INTO _row;
+
+  RETURN to_jsonb(_row);
+END;
+$$;
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.apply_subscription_upgrade(TEXT, TEXT, TEXT, UUID) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.apply_subscription_upgrade(TEXT, TEXT, TEXT, UUID) TO service_role;
+REVOKE EXECUTE ON FUNCTION public.renew_subscription(UUID, TEXT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.renew_subscription(UUID, TEXT) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,91 @@
+-- 支付订单幂等：记录已发货的 out_trade_no，支付宝异步通知重试 / 同步回跳重复到达时不再二次顺延订阅
+-- 依赖 supabase_migration_pay_subscription_rpc.sql（本文件替换其中的 apply_subscription_upgrade）
+-- 后端调用：sb.rpc("apply_subscription_upgrade", {..., "p_out_trade_no": out_trade_no})
+
+CREATE TABLE IF NOT EXISTS public.payment_orders (
+  out_trade_no TEXT PRIMARY KEY,
+  user_id UUID REFERENCES public.profiles(id) ON DELETE CASCADE,
+  plan TEXT NOT NULL,
+  period TEXT,
+  processed_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()) NOT NULL
+);
+
+-- 仅后端 service_role 可访问（启用 RLS 且不创建任何 policy）
+ALTER TABLE public.payment_orders ENABLE ROW LEVEL SECURITY;
+
+-- 新增 p_out_trade_no 参数：先删除旧签名，避免 PostgREST 遇到重载函数无法选择
+DROP FUNCTION IF EXISTS public.apply_subscription_upgrade(TEXT, TEXT, TEXT, UUID);
+
+-- 传入 p_out_trade_no 时：订单已处理过则不修改，直接返回当前 profiles 行
+CREATE OR REPLACE FUNCTION public.apply_subscription_upgrade(
+  p_plan TEXT,
+  p_period TEXT DEFAULT NULL,
+  p_username TEXT DEFAULT NULL,
+  p_user_id UUID DEFAULT NULL,
+  p_out_trade_no TEXT DEFAULT NULL
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  _row public.profiles%ROWTYPE;
+  _uid UUID;
+  _now TIMESTAMPTZ := NOW();
+  _period TEXT := CASE WHEN p_period IN ('month', 'year') THEN p_period ELSE 'month' END;
+  _quota_total INT := CASE p_plan WHEN 'free' THEN 10 WHEN 'personal' THEN 500 WHEN 'pro' THEN 2000 WHEN 'enterprise' THEN 9999999 ELSE 10 END;
+  _embed_total INT := CASE p_plan WHEN 'free' THEN 50 WHEN 'personal' THEN 500 WHEN 'pro' THEN 2000 WHEN 'enterprise' THEN 9999999 ELSE 50 END;
+  _detect_total INT := CASE p_plan WHEN 'free' THEN 20 WHEN 'personal' THEN 200 WHEN 'pro' THEN 1000 WHEN 'enterprise' THEN 9999999 ELSE 20 END;
+BEGIN
+  IF p_user_id IS NULL AND p_username IS NULL THEN
+    RETURN NULL;
+  END IF;
+
+  -- 只锁定并取回 id；到期时间直接在 UPDATE 中由原值计算，已用量等字段不读取也不回写
+  SELECT id INTO _uid
+  FROM public.profiles
+  WHERE (p_user_id IS NULL OR id = p_user_id)
+    AND (p_username IS NULL OR username = p_username)
+  LIMIT 1
+  FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  IF p_out_trade_no IS NOT NULL THEN
+    INSERT INTO public.payment_orders (out_trade_no, user_id, plan, period)
+    VALUES (p_out_trade_no, _uid, p_plan, _period)
+    ON CONFLICT (out_trade_no) DO NOTHING;
+    IF NOT FOUND THEN
+      SELECT * INTO _row FROM public.profiles WHERE id = _uid;
+      RETURN to_jsonb(_row);
+    END IF;
+  END IF;
+
+  UPDATE public.profiles SET
+    plan = p_plan,
+    quota_total = _quota_total,
+    quota_embed_total = _embed_total,
+    quota_detect_total = _detect_total,
+    subscription_period = CASE WHEN p_plan = 'free' THEN NULL ELSE _period END,
+    subscription_status = CASE WHEN p_plan = 'free' THEN 'inactive' ELSE 'active' END,
+    subscription_started_at = CASE WHEN p_plan = 'free' THEN NULL ELSE _now END,
+    subscription_expires_at = CASE
+      WHEN p_plan = 'free' THEN NULL
+      -- 未到期的 active 订阅从原到期时间顺延，否则从现在开始（GREATEST 忽略 NULL）
+      ELSE GREATEST(CASE WHEN subscription_status = 'active' THEN subscription_expires_at END, _now)
+        + make_interval(days => CASE WHEN _period = 'year' THEN 365 ELSE 30 END)
+    END
+  WHERE id = _uid
+  RETURNING * INTO _row;
+
+  RETURN to_jsonb(_row);
+END;
+$$;
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.apply_subscription_upgrade(TEXT, TEXT, TEXT, UUID, TEXT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.apply_subscription_upgrade(TEXT, TEXT, TEXT, UUID, TEXT) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,40 @@
+-- 额度计数原子自增 RPC：单条 UPDATE ... SET used = used + delta RETURNING，
+-- 替代后端"先 SELECT 再 UPDATE 为 used + 1"的写法（并发批量任务下会丢失计数），同时省去一次往返
+-- 后端调用（app/api/endpoints/watermark.py）：
+--   sb.rpc("increment_quota_embed", {"p_user_id": ..., "p_delta": 1})
+--   sb.rpc("increment_quota_detect", {"p_user_id": ..., "p_delta": 1})
+-- 返回自增后的已用量；用户不存在时返回 NULL
+
+CREATE OR REPLACE FUNCTION public.increment_quota_embed(p_user_id UUID, p_delta INT DEFAULT 1)
+RETURNS INT
+LANGUAGE sql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  -- quota_used 为旧版合并计数，与 quota_embed_used 保持一致
+  UPDATE public.profiles SET
+    quota_embed_used = COALESCE(quota_embed_used, 0) + p_delta,
+    quota_used = COALESCE(quota_embed_used, 0) + p_delta
+  WHERE id = p_user_id
+  RETURNING quota_embed_used;
+$$;
+
+CREATE OR REPLACE FUNCTION public.increment_quota_detect(p_user_id UUID, p_delta INT DEFAULT 1)
+RETURNS INT
+LANGUAGE sql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  UPDATE public.profiles SET
+    quota_detect_used = COALESCE(quota_detect_used, 0) + p_delta
+  WHERE id = p_user_id
+  RETURNING quota_detect_used;
+$$;
+
+-- SECURITY DEFINER 会绕过 RLS，仅允许后端 service_role 调用
+REVOKE EXECUTE ON FUNCTION public.increment_quota_embed(UUID, INT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.increment_quota_embed(UUID, INT) TO service_role;
+REVOKE EXECUTE ON FUNCTION public.increment_quota_detect(UUID, INT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.increment_quota_detect(UUID, INT) TO service_role;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,41 @@
+-- 用户时间线视图：合并资产、检测、举报记录（管理后台 /admin/users/{id}/timeline 使用）
+-- 由数据库完成 UNION + 排序 + 分页，后端只取当前页，深分页也正确
+-- 三张表的 id 类型不同，统一转为 TEXT
+
+CREATE OR REPLACE VIEW public.user_timeline_v AS
+SELECT
+  user_id,
+  'asset'::TEXT AS type,
+  COALESCE(asset_type, 'image') AS subtype,
+  id::TEXT AS id,
+  filename AS title,
+  created_at AS timestamp,
+  NULL::FLOAT AS confidence
+FROM public.watermarked_assets
+UNION ALL
+SELECT
+  user_id,
+  'detection'::TEXT AS type,
+  CASE WHEN has_watermark THEN 'hit' ELSE 'miss' END AS subtype,
+  id::TEXT AS id,
+  input_filename AS title,
+  created_at AS timestamp,
+  confidence::FLOAT AS confidence
+FROM public.detection_records
+UNION ALL
+SELECT
+  reporter_id AS user_id,
+  'report'::TEXT AS type,
+  COALESCE(status, 'pending') AS subtype,
+  id::TEXT AS id,
+  CASE WHEN COALESCE(infringing_url, '') <> '' THEN LEFT(infringing_url, 50) || '...' ELSE '侵权举报' END AS title,
+  created_at AS timestamp,
+  NULL::FLOAT AS confidence
+FROM public.infringement_reports;
+
+-- 视图以所有者身份执行（绕过 RLS），仅允许后端 service_role 读取
+REVOKE ALL ON public.user_timeline_v FROM anon, authenticated;
+GRANT SELECT ON public.user_timeline_v TO service_role;
+
+-- 刷新 PostgREST schema 缓存
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,130 @@
+"""
+支付宝 RSA2 签名 / 验签回归测试
+
+pay.py 用预加载的 cryptography 密钥替代了 SDK 的签名与验签，这里用临时生成的密钥对
+校验：签名可被验签、订单串与 AliPay.api_alipay_trade_page_pay 逐字节一致、篡改参数与错误 sign_type 被拒绝
+"""
+import base64
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+import alipay as alipay_sdk
+from app.api.endpoints import pay
+
+
+class _FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 1, 2, 3, 4, 5)
+
+
+@pytest.fixture
+def alipay_keys(monkeypatch):
+    """生成临时 RSA 密钥对写入支付宝环境变量，并冻结下单时间；返回私钥（测试中也用它签出"支付宝回调"）"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    ).decode()
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode()
+
+    monkeypatch.setenv("ALIPAY_APP_ID", "2021000000000000")
+    monkeypatch.setenv("ALIPAY_PRIVATE_KEY", private_pem)
+    monkeypatch.setenv("ALIPAY_PUBLIC_KEY", public_pem)
+    monkeypatch.setattr(pay, "datetime", _FrozenDatetime)
+    monkeypatch.setattr(alipay_sdk, "datetime", _FrozenDatetime)
+    pay.reset_alipay_cache()
+    yield private_key
+    pay.reset_alipay_cache()
+
+
+def _sign(private_key, params: dict) -> str:
+    message = "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+    return base64.b64encode(private_key.sign(message.encode(), padding.PKCS1v15(), hashes.SHA256())).decode()
+
+
+def _notify_params() -> dict:
+    return {
+        "app_id": "2021000000000000",
+        "out_trade_no": "alice_pro_month_1a2b3c4d",
+        "total_amount": "99.00",
+        "trade_no": "2026010222001400000000000001",
+        "trade_status": "TRADE_SUCCESS",
+    }
+
+
+def test_verify_accepts_valid_signature(alipay_keys):
+    """用配对私钥签出的回调参数应验签通过"""
+    params = _notify_params()
+    assert pay._verify_alipay_signature(params, _sign(alipay_keys, params))
+    assert pay._verify_alipay_signature(params, _sign(alipay_keys, params), "RSA2")
+
+
+def test_verify_matches_sdk(alipay_keys):
+    """验签结果与 SDK 的 AliPay.verify 一致"""
+    params = _notify_params()
+    sign = _sign(alipay_keys, params)
+    assert pay.get_alipay().verify(dict(params), sign) is True
+    assert pay._verify_alipay_signature(params, sign) is True
+
+
+def test_verify_rejects_tampered_param(alipay_keys):
+    """签名后篡改任一参数（如金额）应验签失败"""
+    params = _notify_params()
+    sign = _sign(alipay_keys, params)
+    tampered = {**params, "total_amount": "0.01"}
+    assert not pay._verify_alipay_signature(tampered, sign)
+
+
+def test_verify_rejects_wrong_sign_type(alipay_keys):
+    """sign_type 不是 RSA2 时即使签名正确也应拒绝（与 SDK 行为一致）"""
+    params = _notify_params()
+    sign = _sign(alipay_keys, params)
+    assert not pay._verify_alipay_signature(params, sign, "RSA")
+    with pytest.raises(alipay_sdk.AliPayException):
+        pay.get_alipay().verify({**params, "sign_type": "RSA"}, sign)
+
+
+def test_verify_rejects_garbage_signature(alipay_keys):
+    """非 base64 / 长度不对的签名返回 False 而不是抛异常"""
+    params = _notify_params()
+    assert not pay._verify_alipay_signature(params, "not-a-signature")
+    assert not pay._verify_alipay_signature(params, base64.b64encode(b"x" * 256).decode())
+
+
+@pytest.mark.parametrize("subject, total_amount", [
+    ("AIGC Guard - PRO 计划 (月付)", 99.0),
+    ("AIGC Guard - ENTERPRISE 计划 (年付)", 2999.0),
+    ("A&B=C + 空格/符号?", 0.01),
+])
+def test_page_pay_order_string_matches_sdk(alipay_keys, subject, total_amount):
+    """订单查询串与 AliPay.api_alipay_trade_page_pay 逐字节一致"""
+    out_trade_no = "alice_pro_month_1a2b3c4d"
+    expected = pay.get_alipay().api_alipay_trade_page_pay(
+        out_trade_no=out_trade_no,
+        total_amount=total_amount,
+        subject=subject,
+        return_url=f"{pay._BACKEND_URL}/api/pay/alipay-return",
+        notify_url=f"{pay._BACKEND_URL}/api/pay/alipay-notify",
+    )
+    actual = pay._page_pay_order_string(subject=subject, out_trade_no=out_trade_no, total_amount=total_amount)
+    assert actual == expected
+
+
+def test_page_pay_order_string_signature_verifies(alipay_keys):
+    """订单串中的签名可用配对公钥验过（待签内容为除 sign 外的全部参数）"""
+    order_string = pay._page_pay_order_string(
+        subject="AIGC Guard - PERSONAL 计划 (月付)", out_trade_no="bob_personal_month_deadbeef", total_amount=29.0
+    )
+    params = dict(parse_qsl(order_string, keep_blank_values=True))
+    sign = params.pop("sign")
+    assert params["sign_type"] == "RSA2"
+    assert pay._verify_alipay_signature(params, sign)
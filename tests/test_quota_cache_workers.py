@@ -0,0 +1,229 @@
+"""
+多 worker 额度缓存一致性：两个 worker 各有自己的进程内缓存，共用一个 Redis
+
+- 一个 worker 上处理支付 / 改套餐（invalidate_quota_caches）后，另一个 worker 不会继续按旧 total 拒绝
+- 配置 Redis 时进程内条目最多保留 _SHARED_LOCAL_QUOTA_TTL 秒
+- 查库后的回写不会压低其他 worker 已写入的 used
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.api.endpoints import watermark
+from app.utils import quota_cache
+
+USER_ID = "22222222-2222-2222-2222-222222222222"
+
+
+class _FakeRedis:
+    """只实现 quota_cache 用到的命令；Lua 脚本按脚本常量分派到等价的 Python 实现"""
+
+    def __init__(self):
+        self.hashes: dict = {}
+        self.ttls: dict = {}
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.ttls.pop(key, None)
+
+    async def eval(self, script, numkeys, key, *args):
+        h = self.hashes.get(key)
+        if script == quota_cache._STORE_SCRIPT:
+            used, total, plan, ttl = args
+            if h is None:
+                h = self.hashes[key] = {}
+                self.ttls[key] = int(ttl)
+            h.setdefault("total", str(total))
+            h.setdefault("plan", str(plan))
+            if "used" not in h or int(used) > int(h["used"]):
+                h["used"] = str(used)
+            return 1
+        if h is None:
+            return None
+        if script == quota_cache._INCR_SCRIPT:
+            h["used"] = str(int(h.get("used", 0)) + int(args[0]))
+            return int(h["used"])
+        if script == quota_cache._RAISE_SCRIPT:
+            h["used"] = str(max(int(h.get("used", 0)), int(args[0])))
+            return int(h["used"])
+        raise AssertionError("unexpected script")
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class _ProfilesQuery:
+    def __init__(self, db: dict):
+        self._db = db
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def eq(self, *args, **kwargs):
+        return self
+
+    def execute(self):
+        self._db["reads"] += 1
+        return _Result([dict(self._db["row"])])
+
+
+class _StubSupabase:
+    def __init__(self, db: dict):
+        self._db = db
+
+    def table(self, name):
+        assert name == "profiles"
+        return _ProfilesQuery(self._db)
+
+
+class _Worker:
+    """一个 uvicorn worker 的进程内额度缓存"""
+
+    def __init__(self):
+        self.embed: dict = {}
+        self.detect: dict = {}
+
+
+@pytest.fixture
+def env(monkeypatch):
+    redis = _FakeRedis()
+    db = {
+        "reads": 0,
+        "row": {
+            "plan": "free",
+            "quota_embed_used": 50,
+            "quota_embed_total": 50,
+            "quota_detect_used": 0,
+            "quota_detect_total": 20,
+            "subscription_status": "inactive",
+            "subscription_expires_at": None,
+        },
+    }
+    monkeypatch.setattr(quota_cache, "get_redis", lambda: redis)
+    monkeypatch.setattr(watermark, "get_supabase_service_client", lambda: _StubSupabase(db))
+
+    def use(worker: _Worker):
+        monkeypatch.setattr(watermark, "_quota_cache", worker.embed)
+        monkeypatch.setattr(watermark, "_detect_quota_cache", worker.detect)
+
+    return redis, db, use
+
+
+async def _load_embed(user_id=USER_ID):
+    try:
+        return await watermark._load_embed_quota(user_id)
+    except HTTPException as e:
+        return e.status_code
+
+
+def test_invalidation_on_one_worker_unblocks_the_other(env):
+    redis, db, use = env
+    worker_a, worker_b = _Worker(), _Worker()
+
+    async def scenario():
+        use(worker_a)
+        assert await _load_embed() == 402          # 查库后回写 Redis
+        use(worker_b)
+        assert await _load_embed() == 402          # Redis 命中，写入 B 的本地缓存
+        assert db["reads"] == 1
+        assert worker_b.embed[USER_ID]["embed_total"] == 50
+
+        # 用户在 A 上完成支付：库中套餐升级，A 清除本地与 Redis
+        db["row"].update(plan="pro", quota_embed_total=2000)
+        use(worker_a)
+        await watermark.invalidate_quota_caches(USER_ID)
+        assert f"quota:embed:{USER_ID}" not in redis.hashes
+
+        # B 的本地条目仍在 TTL 内且显示已用完，但拒绝前会以 Redis / Supabase 为准
+        use(worker_b)
+        assert USER_ID in worker_b.embed
+        assert await _load_embed() == (50, 2000)
+        assert db["reads"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_local_entries_are_short_lived_when_redis_is_shared(env):
+    redis, db, use = env
+    db["row"].update(plan="pro", quota_embed_used=10, quota_embed_total=2000)
+    worker_a, worker_b = _Worker(), _Worker()
+
+    async def scenario():
+        use(worker_b)
+        assert await _load_embed() == (10, 2000)
+        entry = worker_b.embed[USER_ID]
+        assert entry["expires"] - watermark.time.time() <= watermark._SHARED_LOCAL_QUOTA_TTL
+
+        # 管理员在 A 上把用户降为免费版
+        db["row"].update(plan="free", quota_embed_used=60, quota_embed_total=50)
+        use(worker_a)
+        await watermark.invalidate_quota_caches(USER_ID)
+
+        # B 的本地条目过期后（最多 _SHARED_LOCAL_QUOTA_TTL 秒）即按新套餐拒绝
+        use(worker_b)
+        entry["expires"] = 0
+        assert await _load_embed() == 402
+
+    asyncio.run(scenario())
+
+
+def test_local_ttl_unchanged_without_redis(monkeypatch):
+    monkeypatch.setattr(quota_cache, "get_redis", lambda: None)
+    assert watermark._local_quota_ttl(watermark._QUOTA_CACHE_TTL) == watermark._QUOTA_CACHE_TTL
+
+
+def test_store_does_not_lower_used(env):
+    redis, _, _ = env
+
+    async def scenario():
+        await quota_cache.store("embed", USER_ID, 5, 50, "free", 600)
+        assert await quota_cache.incr("embed", USER_ID) == 6
+        # 另一个 worker 用较早读到的值回写：used 不被压低，total / plan 不被覆盖
+        await quota_cache.store("embed", USER_ID, 5, 2000, "pro", 600)
+        assert await quota_cache.get("embed", USER_ID) == {"used": 6, "total": 50, "plan": "free"}
+        await quota_cache.store("embed", USER_ID, 9, 50, "free", 600)
+        assert (await quota_cache.get("embed", USER_ID))["used"] == 9
+
+    asyncio.run(scenario())
+
+
+class _RpcResult:
+    def execute(self):
+        return _Result(1)
+
+
+def test_expired_subscription_downgrade_invalidates_both_kinds(env, monkeypatch):
+    """嵌入查询触发过期降级后，检测额度的本地与 Redis 缓存也被清除，不再沿用旧套餐的 total"""
+    redis, db, use = env
+    worker = _Worker()
+    db["row"].update(
+        plan="pro",
+        quota_embed_used=10,
+        quota_embed_total=2000,
+        quota_detect_total=1000,
+        subscription_status="active",
+        subscription_expires_at="2020-01-01T00:00:00+00:00",
+    )
+    rpcs = []
+    monkeypatch.setattr(_StubSupabase, "rpc", lambda self, name, params: rpcs.append(name) or _RpcResult(), raising=False)
+
+    async def scenario():
+        use(worker)
+        watermark._set_detect_quota_cache(USER_ID, 0, 1000, "pro")
+        await quota_cache.store("detect", USER_ID, 0, 1000, "pro", 600)
+
+        assert await _load_embed() == (10, 50)
+        assert rpcs == ["downgrade_expired_subscriptions"]
+        assert USER_ID not in worker.detect
+        assert f"quota:detect:{USER_ID}" not in redis.hashes
+        assert worker.embed[USER_ID]["embed_total"] == 50
+        assert redis.hashes[f"quota:embed:{USER_ID}"]["total"] == "50"
+
+    asyncio.run(scenario())
@@ -0,0 +1,136 @@
+"""
+文本/视频接口额度依赖（require_embed_quota / require_detect_quota）的扣减与退回约定
+
+进入接口前调用 check_and_consume_quota 扣减 1 次；接口抛出任何异常（含请求体校验 422）时
+调用 increment_quota_*(p_delta=-1) 退回；游客与未配置 Supabase 时不访问额度 RPC
+"""
+import pytest
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+from app.api.endpoints import watermark
+
+USER_ID = "11111111-1111-1111-1111-111111111111"
+
+
+class _StubQuery:
+    def __init__(self, calls: list, name: str, params: dict, data):
+        self._calls, self._name, self._params, self._data = calls, name, params, data
+
+    def execute(self):
+        self._calls.append((self._name, self._params))
+
+        class _Result:
+            data = self._data
+        return _Result()
+
+
+class _StubSupabase:
+    """只记录 rpc 调用；allowed=False 模拟额度已用完"""
+
+    def __init__(self, allowed: bool = True):
+        self.calls: list = []
+        self.allowed = allowed
+
+    def rpc(self, name: str, params: dict):
+        if name == "check_and_consume_quota":
+            data = {"allowed": self.allowed, "reason": "ok" if self.allowed else "exhausted", "used": 3, "total": 50}
+        else:
+            data = 2
+        return _StubQuery(self.calls, name, params, data)
+
+    @property
+    def rpc_names(self) -> list:
+        return [name for name, _ in self.calls]
+
+
+class _Body(BaseModel):
+    mode: str
+
+
+def _build_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/embed")
+    def embed(body: _Body, quota: tuple = Depends(watermark.require_embed_quota)):
+        sb, final_user_id = quota
+        if body.mode == "boom":
+            raise HTTPException(status_code=500, detail="embed failed")
+        if body.mode == "crash":
+            raise RuntimeError("unexpected")
+        return {"user": final_user_id}
+
+    @app.post("/detect")
+    def detect(quota: tuple = Depends(watermark.require_detect_quota)):
+        return {"user": quota[1]}
+
+    return app
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    def _make(sb, user_id=USER_ID):
+        monkeypatch.setattr(watermark, "get_supabase_service_client", lambda: sb)
+        app = _build_app()
+        app.dependency_overrides[watermark.get_optional_user] = lambda: user_id
+        return TestClient(app, raise_server_exceptions=False)
+    return _make
+
+
+def test_success_consumes_only(make_client):
+    sb = _StubSupabase()
+    res = make_client(sb).post("/embed", json={"mode": "ok"})
+    assert res.status_code == 200
+    assert res.json() == {"user": USER_ID}
+    assert sb.rpc_names == ["check_and_consume_quota"]
+    assert sb.calls[0][1]["p_kind"] == "embed"
+    assert sb.calls[0][1]["p_user_id"] == USER_ID
+
+
+def test_http_500_refunds(make_client):
+    sb = _StubSupabase()
+    res = make_client(sb).post("/embed", json={"mode": "boom"})
+    assert res.status_code == 500
+    assert sb.calls == [
+        ("check_and_consume_quota", sb.calls[0][1]),
+        ("increment_quota_embed", {"p_user_id": USER_ID, "p_delta": -1}),
+    ]
+
+
+def test_unhandled_exception_refunds(make_client):
+    sb = _StubSupabase()
+    res = make_client(sb).post("/embed", json={"mode": "crash"})
+    assert res.status_code == 500
+    assert sb.rpc_names == ["check_and_consume_quota", "increment_quota_embed"]
+
+
+def test_request_validation_error_refunds(make_client):
+    """请求体校验在依赖之后进行：422 时也要退回已扣减的额度"""
+    sb = _StubSupabase()
+    res = make_client(sb).post("/embed", json={})
+    assert res.status_code == 422
+    assert sb.rpc_names == ["check_and_consume_quota", "increment_quota_embed"]
+
+
+def test_exhausted_quota_returns_402_without_refund(make_client):
+    sb = _StubSupabase(allowed=False)
+    res = make_client(sb).post("/embed", json={"mode": "ok"})
+    assert res.status_code == 402
+    assert sb.rpc_names == ["check_and_consume_quota"]
+
+
+def test_detect_dependency_uses_detect_kind(make_client):
+    sb = _StubSupabase()
+    res = make_client(sb).post("/detect")
+    assert res.status_code == 200
+    assert sb.rpc_names == ["check_and_consume_quota"]
+    assert sb.calls[0][1]["p_kind"] == "detect"
+
+
+@pytest.mark.parametrize("mode, status", [("ok", 200), ("boom", 500)])
+def test_guest_never_touches_quota(make_client, mode, status):
+    sb = _StubSupabase()
+    res = make_client(sb, user_id=None).post("/embed", json={"mode": mode})
+    assert res.status_code == status
+    assert sb.calls == []
@@ -32,7 +32,7 @@ interface AppContextType {
     setTextResult: (res: any) => void;
     setVideoResult: (res: any) => void;
 
-    setMonitorResult: (res: any) => void;
+    setMonitorResult: (res: any | ((prev: any) => any)) => void;
     setMonitorBatchFiles: (files: any[] | ((prev: any[]) => any[])) => void;
     setMonitorTextResult: (res: any) => void;
     setMonitorVideoResult: (res: any) => void;
@@ -108,7 +108,7 @@ export const AppProvider: React.FC<{ children: React.ReactNode }> = ({ children
     const setFingerprintAuthor = (author: string) => setState(prev => ({ ...prev, fingerprintAuthor: author }));
     const setFingerprintTextInput = (text: string) => setState(prev => ({ ...prev, fingerprintTextInput: text }));
 
-    const setMonitorResult = (res: any) => setState(prev => ({ ...prev, monitorResult: res }));
+    const setMonitorResult = (res: any | ((prev: any) => any)) => setState(prev => ({ ...prev, monitorResult: typeof res === 'function' ? res(prev.monitorResult) : res }));
     const setMonitorBatchFiles = (files: any[] | ((prev: any[]) => any[])) => setState(prev => ({ ...prev, monitorBatchFiles: typeof files === 'function' ? files(prev.monitorBatchFiles) : files }));
     const setMonitorTextResult = (res: any) => setState(prev => ({ ...prev, monitorTextResult: res }));
     const setMonitorVideoResult = (res: any) => setState(prev => ({ ...prev, monitorVideoResult: res }));
@@ -388,6 +388,13 @@ const Monitor: React.FC = () => {
         localStorage.setItem(storageKey, JSON.stringify(updated));
     };
 
+    // 五维评分报告由后端在 /detect 响应之后生成：凭 report_id 轮询取回并合并；无 report_id / 超时则原样返回
+    const withDetectReport = async (detectRes: any) => {
+        if (!detectRes?.report_id) return detectRes;
+        const report = await watermark.waitForDetectReport(detectRes.report_id).catch(() => null);
+        return report ? { ...detectRes, ...report, report_ready: true } : detectRes;
+    };
+
     const mergeDetectionHistory = (incoming: any[]) => {
         const userId = getCurrentUserId();
         const storageKey = `detection_history_${userId}`;
@@ -903,39 +910,48 @@ const Monitor: React.FC = () => {
 
         try {
             setDetectStatusText('正在完成检测...');
-            const res: any = await watermark.detect(formData);
+            const detectRes: any = await watermark.detect(formData);
 
-            setResult(res);
+            // 检测结果立即展示；五维评分报告就绪后再合并到结果与检测记录（不阻塞检测完成）
+            setResult(detectRes);
             syncCloudDetectionRecords({ silent: true });
             window.dispatchEvent(new Event('quota-updated'));
             pushToast('检测完成', 'success');
             clearDetectionSession(); // 清除检测会话状态
-            
-            // 保存检测记录（兼容 matched_asset / best_match）
-            const matchedAsset = res.matched_asset || (res.best_match ? {
-                id: res.best_match.author_id || res.best_match.id,
-                user_id: res.best_match.author_id,
-                author_name: res.best_match.author_name || '未知',
-                filename: res.best_match.filename || '',
-                timestamp: res.best_match.creation_time || '',
-                similarity: res.best_match.similarity || 0,
-            } : null);
-            const confidence = res.confidence || (res.best_match?.similarity ? res.best_match.similarity / 100 : 0);
-            saveDetectionRecord({
-                type: 'image',
-                filename: file.name,
-                hasWatermark: res.has_watermark,
-                matchedAsset,
-                confidence,
-                message: res.message,
-                five_dim_score: res.five_dim_score,
-                confidence_level: res.confidence_level,
-                legal_description: res.legal_description,
-                legal_assessment: res.legal_assessment,
-                visualizations: res.visualizations,
-                // 新增：保存分析结论和证据强度
-                analysis: res.analysis,
-                match_summary: res.match_summary,
+
+            const fileName = file.name;
+            withDetectReport(detectRes).then((res: any) => {
+                if (res !== detectRes) {
+                    // 期间用户可能已发起新的检测，只合并到同一次检测的结果上
+                    setResult((prev: any) => (prev?.report_id === detectRes.report_id ? res : prev));
+                }
+
+                // 保存检测记录（兼容 matched_asset / best_match）
+                const matchedAsset = res.matched_asset || (res.best_match ? {
+                    id: res.best_match.author_id || res.best_match.id,
+                    user_id: res.best_match.author_id,
+                    author_name: res.best_match.author_name || '未知',
+                    filename: res.best_match.filename || '',
+                    timestamp: res.best_match.creation_time || '',
+                    similarity: res.best_match.similarity || 0,
+                } : null);
+                const confidence = res.confidence || (res.best_match?.similarity ? res.best_match.similarity / 100 : 0);
+                saveDetectionRecord({
+                    type: 'image',
+                    filename: fileName,
+                    hasWatermark: res.has_watermark,
+                    matchedAsset,
+                    confidence,
+                    message: res.message,
+                    five_dim_score: res.five_dim_score,
+                    confidence_level: res.confidence_level,
+                    legal_description: res.legal_description,
+                    legal_assessment: res.legal_assessment,
+                    visualizations: res.visualizations,
+                    // 新增：保存分析结论和证据强度
+                    analysis: res.analysis,
+                    match_summary: res.match_summary,
+                });
             });
         } catch (err: any) {
             console.error(err);
@@ -1860,35 +1876,42 @@ const Monitor: React.FC = () => {
                 formData.append('image', item.file);
 
                 try {
-                    const res: any = await watermark.detect(formData);
-                    const anyRes: any = res;
+                    const detectRes: any = await watermark.detect(formData);
+                    // 检测完成即标记 done；五维评分报告就绪后再合并到该文件的结果与检测记录
                     setMonitorBatchFiles((prev: BatchFile[]) =>
-                        prev.map((f) => (f.id === item.id ? { ...f, status: 'done', result: res } : f))
+                        prev.map((f) => (f.id === item.id ? { ...f, status: 'done', result: detectRes } : f))
                     );
-                    // 同步写入本地检测记录（兼容 matched_asset / best_match）
-                    const batchMatchedAsset = anyRes?.matched_asset || (anyRes?.best_match ? {
-                        id: anyRes.best_match.author_id || anyRes.best_match.id,
-                        user_id: anyRes.best_match.author_id,
-                        author_name: anyRes.best_match.author_name || '未知',
-                        filename: anyRes.best_match.filename || '',
-                        timestamp: anyRes.best_match.creation_time || '',
-                        similarity: anyRes.best_match.similarity || 0,
-                    } : null);
-                    const batchConfidence = anyRes?.confidence || (anyRes?.best_match?.similarity ? anyRes.best_match.similarity / 100 : 0);
-                    saveDetectionRecord({
-                        type: 'image',
-                        filename: item.file?.name,
-                        hasWatermark: anyRes?.has_watermark,
-                        matchedAsset: batchMatchedAsset,
-                        confidence: batchConfidence,
-                        message: anyRes?.message,
-                        five_dim_score: anyRes?.five_dim_score,
-                        confidence_level: anyRes?.confidence_level,
-                        legal_description: anyRes?.legal_description,
-                        legal_assessment: anyRes?.legal_assessment,
-                        visualizations: anyRes?.visualizations,
-                        analysis: anyRes?.analysis,
-                        match_summary: anyRes?.match_summary,
+                    withDetectReport(detectRes).then((anyRes: any) => {
+                        if (anyRes !== detectRes) {
+                            setMonitorBatchFiles((prev: BatchFile[]) =>
+                                prev.map((f) => (f.id === item.id ? { ...f, result: anyRes } : f))
+                            );
+                        }
+                        // 同步写入本地检测记录（兼容 matched_asset / best_match）
+                        const batchMatchedAsset = anyRes?.matched_asset || (anyRes?.best_match ? {
+                            id: anyRes.best_match.author_id || anyRes.best_match.id,
+                            user_id: anyRes.best_match.author_id,
+                            author_name: anyRes.best_match.author_name || '未知',
+                            filename: anyRes.best_match.filename || '',
+                            timestamp: anyRes.best_match.creation_time || '',
+                            similarity: anyRes.best_match.similarity || 0,
+                        } : null);
+                        const batchConfidence = anyRes?.confidence || (anyRes?.best_match?.similarity ? anyRes.best_match.similarity / 100 : 0);
+                        saveDetectionRecord({
+                            type: 'image',
+                            filename: item.file?.name,
+                            hasWatermark: anyRes?.has_watermark,
+                            matchedAsset: batchMatchedAsset,
+                            confidence: batchConfidence,
+                            message: anyRes?.message,
+                            five_dim_score: anyRes?.five_dim_score,
+                            confidence_level: anyRes?.confidence_level,
+                            legal_description: anyRes?.legal_description,
+                            legal_assessment: anyRes?.legal_assessment,
+                            visualizations: anyRes?.visualizations,
+                            analysis: anyRes?.analysis,
+                            match_summary: anyRes?.match_summary,
+                        });
                     });
                     syncCloudDetectionRecords({ silent: true });
                     window.dispatchEvent(new Event('quota-updated'));
@@ -202,6 +202,20 @@ export const watermark = {
         });
         return res.data;
     },
+    // 五维评分报告由后端后台生成：轮询 /detect/report/{id}，就绪后返回报告字段；不存在或超时返回 null
+    waitForDetectReport: async (reportId: string, timeoutMs: number = 15000) => {
+        const deadline = Date.now() + timeoutMs;
+        while (Date.now() < deadline) {
+            try {
+                const res = await api.get(`/detect/report/${reportId}`);
+                if (res.data?.ready) return res.data;
+            } catch (err: any) {
+                if (err?.response?.status === 404) return null;
+            }
+            await new Promise((resolve) => setTimeout(resolve, 400));
+        }
+        return null;
+    },
     getAssets: async () => {
         const res = await api.get<Asset[]>('/assets');
         return res.data;